@@ -0,0 +1,319 @@
+'''
+Stage-by-stage benchmark of FermiFilters on synthetic weekly files (see core/synthetic.py).
+
+Every stage is timed and memory-profiled at each scale: merge, select, mktime,
+ecliptic_cut, plot, metadata and zip. The cold import time of the blueprint (in a fresh
+interpreter) is measured too. Everything runs offline: the filters run on the
+native engine backend and the Fermitools runner is replaced by one that refuses to start them.
+
+    python benchmark.py --weeks 1,10,52 --output results.json
+    python benchmark.py --weeks 1,10 --baseline results.json --max-regression 0.25
+
+With --baseline, --thresholds or both, the exit status is 1 if a stage is slower (or
+uses more memory) than allowed. Thresholds files map scales to stage limits, and
+'import' to the import limit, e.g.
+{"10": {"select": {"seconds": 2.0, "peak_mb": 300}}, "import": {"seconds": 0.5}}.
+'''
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import subprocess
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent))
+import numpy as np
+from astropy.io import fits
+from core import mktime
+from core.archive import archive_files, stream_zip
+from core.config import PARALLEL_WORKERS
+from core.engine import FiltersEngine
+from core.skymap import count_map_path
+from core.synthetic import make_weeks
+from core.tools import ToolError
+from core.utils import FitsReader, Plotter
+
+RESULTS_VERSION = 1
+STAGES = ('merge', 'select', 'mktime', 'ecliptic_cut', 'plot', 'metadata', 'zip')
+SELECT_DICT = {'ra': 83.63, 'dec': 22.01, 'radius': 30, 'energy': [100, 100000], 'zenith_angle': [0, 90]}
+MAKETIME_DICT = {'filter_expr': '(DATA_QUAL>0)&&(LAT_CONFIG==1)', 'roicut': 'no'}
+ECLIPTIC_CUT_DICT = {'eclipticradius': 20, 'eclipticoperator': 'gt'}
+# Differences below this many seconds (or MB) are never reported as regressions.
+MIN_SECONDS = 0.05
+MIN_MB = 5.0
+
+
+class OfflineToolRunner:
+    '''
+    Tool runner of the benchmark engines: no Fermitools executable is ever started.
+    '''
+
+    def run(self, tool, params=None, cwd=None, timeout=None):
+        raise ToolError(f"{tool} is not available offline")
+
+
+def _remove(path):
+    '''
+    Removes a file and its sidecar files (statistics, columnar cache, count maps).
+    '''
+    directory, name = os.path.split(path)
+    for file_name in os.listdir(directory):
+        if file_name == name or file_name.startswith(name + '.'):
+            os.remove(os.path.join(directory, file_name))
+
+
+class Scale:
+    '''
+    Inputs and outputs of the stages at one scale, in a work directory of its own.
+    '''
+
+    def __init__(self, work_dir, ft1_list, ft2_list, workers):
+        self.work_dir = work_dir
+        self.ft1_list = ft1_list
+        self.ft2_list = ft2_list
+        self.engine = FiltersEngine(backend='native', tool_runner=OfflineToolRunner(), workers=workers)
+        self.workers = workers
+        self.merged_ft1 = os.path.join(work_dir, 'merged_photon.fits')
+        self.merged_ft2 = os.path.join(work_dir, 'merged_spacecraft.fits')
+        self.outputs = {name: os.path.join(work_dir, f'{name}_merged_photon.fits') for name in ('select', 'mktime', 'ecliptic_cut')}
+        self.plot_file = os.path.join(work_dir, 'plot.png')
+        self.zip_file = os.path.join(work_dir, 'results.zip')
+
+    def setup(self, stage):
+        '''
+        Removes the outputs of a stage and the caches it would reuse, so every run is cold.
+        '''
+        mktime._gti_cache.clear()
+        if stage == 'merge':
+            for path in (self.merged_ft1, self.merged_ft2):
+                if os.path.exists(path):
+                    _remove(path)
+        elif stage in self.outputs:
+            if os.path.exists(self.outputs[stage]):
+                _remove(self.outputs[stage])
+        elif stage == 'plot':
+            for path in [self.merged_ft1] + list(self.outputs.values()):
+                if os.path.exists(count_map_path(path)):
+                    os.remove(count_map_path(path))
+        elif stage == 'zip' and os.path.exists(self.zip_file):
+            os.remove(self.zip_file)
+
+    def run(self, stage):
+        '''
+        Runs a stage, returns the number of rows (or bytes for the archive) it produced.
+        '''
+        if stage == 'merge':
+            if not self.engine.gtmerge(self.ft1_list, self.merged_ft1, self.work_dir):
+                raise RuntimeError("gtmerge failed")
+            self.engine.ft2_merge(self.ft2_list, self.merged_ft2)
+            return _n_rows(self.merged_ft1)
+        if stage == 'select':
+            ok = self.engine.gtselect(SELECT_DICT, self.merged_ft1, self.outputs['select'])
+        elif stage == 'mktime':
+            ok = self.engine.gtmktime(MAKETIME_DICT, self.merged_ft1, self.merged_ft2, self.outputs['mktime'])
+        elif stage == 'ecliptic_cut':
+            ok = self.engine.ecliptic_cut(ECLIPTIC_CUT_DICT, self.merged_ft1, self.merged_ft2, self.outputs['ecliptic_cut'])
+        elif stage == 'plot':
+            plots_list = [self.merged_ft1] + [path for path in self.outputs.values() if os.path.exists(path)]
+            Plotter(workers=self.workers).plot_ft_data(plots_list, x='RA', y='DEC', plot_filename=self.plot_file,
+                                                        coord='G', projection='mollweide')
+            return None
+        elif stage == 'metadata':
+            FitsReader().read_info_from_ft1(self.merged_ft1)
+            FitsReader().read_info_from_ft2(self.merged_ft2)
+            return None
+        elif stage == 'zip':
+            files = [path for path in archive_files(self.work_dir) if path != self.zip_file]
+            return sum(len(chunk) for chunk in stream_zip(files, self.zip_file))
+        if not ok:
+            raise RuntimeError(f"{stage} failed")
+        return _n_rows(self.outputs[stage])
+
+
+def _n_rows(ft1_file):
+    with fits.open(ft1_file, memmap=True) as hdul:
+        return hdul['EVENTS'].header['NAXIS2']
+
+
+def measure(scale, stage, repeat):
+    '''
+    Times a stage repeat times, then runs it once more under tracemalloc for its peak memory.
+
+    Returns:
+    -------
+        Dictionary with 'seconds' (best run), 'runs', 'peak_mb' and 'output'.
+    '''
+    runs = []
+    for _ in range(repeat):
+        scale.setup(stage)
+        gc.collect()
+        start = time.perf_counter()
+        output = scale.run(stage)
+        runs.append(time.perf_counter() - start)
+    scale.setup(stage)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        scale.run(stage)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(runs), 'runs': runs, 'peak_mb': peak / 1024 ** 2, 'output': output}
+
+
+def measure_import(repeat, module='FermiFilters.fermi_select') -> dict:
+    '''
+    Times the import of a module in fresh interpreters, repeat times.
+
+    Returns:
+    -------
+        Dictionary with 'module', 'seconds' (best run) and 'runs'.
+    '''
+    repo_dir = Path(__file__).resolve().parent
+    with tempfile.TemporaryDirectory(prefix='fermifilters_import_') as path_dir:
+        # The blueprint imports the package as FermiFilters, whatever the checkout is named.
+        if repo_dir.name == 'FermiFilters':
+            path_dir = str(repo_dir.parent)
+        else:
+            os.symlink(repo_dir, os.path.join(path_dir, 'FermiFilters'))
+        code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([path_dir, os.environ.get('PYTHONPATH', '')]))
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, '-c', code], env=env, cwd=path_dir, check=True,
+                                    capture_output=True, text=True).stdout
+            runs.append(float(output.split()[-1]))
+    return {'module': module, 'seconds': min(runs), 'runs': runs}
+
+
+def run_benchmark(weeks_list, events_per_week, work_dir, repeat=1, workers=PARALLEL_WORKERS, stages=STAGES) -> dict:
+    '''
+    Runs the stages at every scale. Synthetic files are generated once per
+    events_per_week in work_dir and reused by the later runs.
+    '''
+    data_dir = os.path.join(work_dir, f'data_{events_per_week}')
+    results = {
+        'version': RESULTS_VERSION,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'workers': workers,
+        'events_per_week': events_per_week,
+        'repeat': repeat,
+        'scales': {},
+    }
+    results['import'] = measure_import(max(repeat, 3))
+    print(f"import {results['import']['module']:<28} {results['import']['seconds']:9.3f} s", flush=True)
+    for weeks in weeks_list:
+        start = time.perf_counter()
+        ft1_list, ft2_list = make_weeks(data_dir, weeks, events_per_week)
+        generate_seconds = time.perf_counter() - start
+        scale_dir = os.path.join(work_dir, f'weeks_{weeks}')
+        shutil.rmtree(scale_dir, ignore_errors=True)
+        os.makedirs(scale_dir)
+        scale = Scale(scale_dir, ft1_list, ft2_list, workers)
+        stage_results = {}
+        for stage in STAGES:
+            if stage not in stages and stage != 'merge':
+                continue
+            stage_results[stage] = measure(scale, stage, repeat)
+            print(f"{weeks:>4} weeks  {stage:<13} {stage_results[stage]['seconds']:9.3f} s {stage_results[stage]['peak_mb']:9.1f} MB", flush=True)
+        results['scales'][str(weeks)] = {'events': weeks * events_per_week,
+                                         'generate_seconds': generate_seconds,
+                                         'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                                         'stages': stage_results}
+    return results
+
+
+def compare(results, baseline=None, thresholds=None, max_regression=0.25) -> list:
+    '''
+    Lists the stages of results slower, or using more memory, than allowed.
+
+    Parameters:
+    ----------
+        results: Results of run_benchmark.
+        baseline: Optional earlier results: a stage regresses when it takes more than
+            (1 + max_regression) times its baseline seconds or peak_mb.
+        thresholds: Optional dictionary of absolute limits, per scale and stage.
+        max_regression: Allowed relative increase over the baseline.
+
+    Returns:
+    -------
+        List of messages, empty if there is no regression.
+    '''
+    failures = []
+    measured = results.get('import')
+    if measured is not None:
+        reference = (baseline or {}).get('import')
+        allowed = reference['seconds'] * (1 + max_regression) if reference else None
+        if reference and measured['seconds'] > allowed and measured['seconds'] - reference['seconds'] > MIN_SECONDS:
+            failures.append(f"import: seconds {measured['seconds']:.3f} > {allowed:.3f} (baseline {reference['seconds']:.3f})")
+        limit = (thresholds or {}).get('import', {}).get('seconds')
+        if limit is not None and measured['seconds'] > limit:
+            failures.append(f"import: seconds {measured['seconds']:.3f} > threshold {limit:.3f}")
+    for weeks, scale in results['scales'].items():
+        for stage, measured in scale['stages'].items():
+            reference = (baseline or {}).get('scales', {}).get(weeks, {}).get('stages', {}).get(stage)
+            if reference is not None:
+                for key, floor in (('seconds', MIN_SECONDS), ('peak_mb', MIN_MB)):
+                    allowed = reference[key] * (1 + max_regression)
+                    if measured[key] > allowed and measured[key] - reference[key] > floor:
+                        failures.append(f"{weeks} weeks {stage}: {key} {measured[key]:.3f} > {allowed:.3f} (baseline {reference[key]:.3f})")
+            limits = (thresholds or {}).get(weeks, {}).get(stage, {})
+            for key, limit in limits.items():
+                if measured.get(key) is not None and measured[key] > limit:
+                    failures.append(f"{weeks} weeks {stage}: {key} {measured[key]:.3f} > threshold {limit:.3f}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--weeks', default='1,10,52', help="Comma-separated numbers of weeks (default: 1,10,52)")
+    parser.add_argument('--events-per-week', type=int, default=200000, help="Events of each synthetic photon file")
+    parser.add_argument('--stages', default=','.join(STAGES), help="Comma-separated stages to run (merge always runs)")
+    parser.add_argument('--repeat', type=int, default=1, help="Timed runs of each stage, the best is kept")
+    parser.add_argument('--workers', type=int, default=PARALLEL_WORKERS, help="Worker processes of the event masks")
+    parser.add_argument('--work-dir', help="Directory of the synthetic files and outputs (default: a temporary directory)")
+    parser.add_argument('--output', help="Path of the JSON results")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare with")
+    parser.add_argument('--thresholds', help="JSON file of absolute limits per scale and stage")
+    parser.add_argument('--max-regression', type=float, default=0.25, help="Allowed relative increase over the baseline")
+    args = parser.parse_args()
+
+    stages = [stage for stage in args.stages.split(',') if stage]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {sorted(unknown)}")
+    weeks_list = [int(weeks) for weeks in args.weeks.split(',') if weeks]
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='fermifilters_bench_')
+    results = run_benchmark(weeks_list, args.events_per_week, work_dir, args.repeat, args.workers, stages)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = thresholds = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if args.thresholds:
+        with open(args.thresholds) as f:
+            thresholds = json.load(f)
+    failures = compare(results, baseline, thresholds, args.max_regression)
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
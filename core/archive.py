@@ -0,0 +1,170 @@
+import os
+import uuid
+import hashlib
+import logging
+import zipfile
+from .config import ARCHIVE_CHUNK_SIZE
+
+# Output stages of a workspace, recognized by the prefix of the file name.
+STAGE_PREFIXES = (('ecliptic_cut', 'ecliptic_cut_'), ('mktime', 'mktime_'), ('select', 'select_'), ('merged', 'merged_'), ('sweep', 'sweep_'))
+ARCHIVE_STAGES = ('input', 'merged', 'select', 'mktime', 'ecliptic_cut', 'sweep', 'plot')
+# Formats that do not gain from deflate: FITS data is mostly float noise, PNG is already compressed.
+STORED_EXTENSIONS = ('.fits', '.fit', '.fz', '.gz', '.png')
+ARCHIVE_PREFIX = 'fermi_results_'
+
+
+def file_stage(file_name):
+    '''
+    Returns the stage that produced a workspace file ('plot' for the plots, 'input'
+    for the downloaded files, 'sweep' for the sweep outputs and summaries) or None
+    if the file is not part of the results.
+    '''
+    if file_name.endswith('.png'):
+        return 'plot'
+    if file_name.startswith('sweep_') and file_name.endswith('.csv'):
+        return 'sweep'
+    if not file_name.endswith('.fits'):
+        return None
+    for stage, prefix in STAGE_PREFIXES:
+        if file_name.startswith(prefix):
+            return stage
+    return 'input'
+
+
+def archive_files(user_path, stages=None) -> list:
+    '''
+    Lists the result files of a workspace, sorted by name.
+
+    Parameters:
+    ----------
+        user_path: Workspace directory.
+        stages: Optional iterable of stages to include (see ARCHIVE_STAGES), default all.
+
+    Returns:
+    -------
+        List of file paths.
+    '''
+    stages = set(stages) if stages else set(ARCHIVE_STAGES)
+    return [os.path.join(user_path, file_name) for file_name in sorted(os.listdir(user_path))
+            if file_stage(file_name) in stages and os.path.isfile(os.path.join(user_path, file_name))]
+
+
+def archive_path(user_path, files, zip64=False) -> str:
+    '''
+    Path of the completed archive of a list of files, named after a hash of their
+    names, sizes and modification times so that any change produces a new archive.
+    '''
+    digest = hashlib.sha1(str(bool(zip64)).encode())
+    for path in files:
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return os.path.join(user_path, f"{ARCHIVE_PREFIX}{digest.hexdigest()[:16]}.zip")
+
+
+def remove_archives(user_path, keep=None) -> int:
+    '''
+    Removes the saved archives of a workspace (see archive_path), except keep.
+
+    Returns:
+    -------
+        Number of archives removed.
+    '''
+    removed = 0
+    for file_name in os.listdir(user_path):
+        if file_name.startswith(ARCHIVE_PREFIX) and file_name.endswith('.zip') and file_name != os.path.basename(keep or ''):
+            try:
+                os.remove(os.path.join(user_path, file_name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+class _StreamSink:
+    '''
+    Write-only, non-seekable file object collecting the bytes written by zipfile,
+    optionally copying them to a file on disk.
+    '''
+
+    def __init__(self, tee_file=None):
+        self._chunks = []
+        self._tee_file = tee_file
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        if self._tee_file is not None:
+            self._tee_file.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _drain(sink):
+    data = sink.drain()
+    if data:
+        yield data
+
+
+def stream_zip(files, output_file=None, zip64=False, chunk_size=ARCHIVE_CHUNK_SIZE):
+    '''
+    Generates a ZIP archive of files chunk by chunk, as its entries are read.
+
+    FITS files and plots are stored without compression, the other files deflated.
+    ZIP64 records are written for the entries that need them, or for all the entries
+    if zip64 is True. Memory stays proportional to chunk_size whatever the size of the files.
+
+    Parameters:
+    ----------
+        files: List of file paths, stored under their base name.
+        output_file: Optional path where a copy of the archive is written. The copy is
+            written to a temporary file, renamed to output_file only if the archive
+            is completed, and removed otherwise (e.g. if the client disconnects).
+            Once it is completed, the other archives saved next to it are removed
+            (see remove_archives), so a workspace keeps a single archive.
+        zip64: If True, ZIP64 records are forced for every entry.
+        chunk_size: Size in bytes of the reads from the files.
+
+    Yields:
+    ------
+        Bytes of the archive.
+    '''
+    tmp_file = f"{output_file}.{uuid.uuid4().hex}.part" if output_file else None
+    tee_file = open(tmp_file, 'wb') if tmp_file else None
+    completed = False
+    try:
+        sink = _StreamSink(tee_file)
+        with zipfile.ZipFile(sink, 'w', allowZip64=True) as zipf:
+            for path in files:
+                info = zipfile.ZipInfo.from_file(path, arcname=os.path.basename(path))
+                if path.lower().endswith(STORED_EXTENSIONS):
+                    info.compress_type = zipfile.ZIP_STORED
+                else:
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                with open(path, 'rb') as src, zipf.open(info, 'w', force_zip64=zip64) as dest:
+                    while True:
+                        chunk = src.read(chunk_size)
+                        if not chunk:
+                            break
+                        dest.write(chunk)
+                        yield from _drain(sink)
+                yield from _drain(sink)
+        yield from _drain(sink)
+        completed = True
+    finally:
+        if tee_file is not None:
+            tee_file.close()
+            if completed:
+                os.replace(tmp_file, output_file)
+                logging.info(" archive: saved %s", output_file)
+                removed = remove_archives(os.path.dirname(output_file) or '.', keep=output_file)
+                if removed:
+                    logging.info(" archive: removed %d superseded archives", removed)
+            else:
+                os.remove(tmp_file)
@@ -0,0 +1,262 @@
+import os
+import json
+import logging
+import threading
+from contextlib import contextmanager
+import numpy as np
+from .config import CHUNK_SIZE, SPATIAL_INDEX_NSIDE
+from .kernels import raw_columns
+from .lazy import LazyModule
+from .spatial import SpatialIndex, build_index, hp
+from .stats import file_fingerprint
+from .workspace import atomic_output
+
+fits = LazyModule('astropy.io.fits')
+
+COLUMNS_VERSION = 2
+
+
+def columns_meta_path(ft_file) -> str:
+    return f"{ft_file}.columns.json"
+
+
+def column_path(ft_file, extension, name) -> str:
+    return f"{ft_file}.columns.{extension}.{name}.npy"
+
+
+def index_paths(ft_file, extension, nside):
+    '''
+    Paths of the row and offset arrays of the spatial index of an extension.
+    '''
+    prefix = f"{ft_file}.columns.{extension}.hpx{nside}"
+    return f"{prefix}.rows.npy", f"{prefix}.offsets.npy"
+
+
+class ColumnarTable:
+    '''
+    Read-only view of a table extension converted by update_columns.
+
+    Columns are contiguous native-endian arrays, memory-mapped on first access, so that
+    slicing them never swaps bytes or decodes rows. Tables support len(), 'name in table'
+    and table['NAME'], like the raw record arrays accepted by the kernels (see
+    kernels.raw_columns): values are the decoded FITS values, except for bit ('X') columns
+    which keep their packed bytes. Events tables may have a spatial index (see spatial.SpatialIndex).
+    '''
+
+    def __init__(self, ft_file, extension, meta):
+        self.ft_file = ft_file
+        self.extension = extension
+        self.n_rows = meta['n_rows']
+        self.names = tuple(meta['columns'])
+        self._header = meta['header']
+        self._index = meta.get('index')
+        self._arrays = {}
+
+    def __len__(self):
+        return self.n_rows
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            if name not in self.names:
+                raise KeyError(name)
+            self._arrays[name] = np.load(column_path(self.ft_file, self.extension, name), mmap_mode='r')
+        return self._arrays[name]
+
+    @property
+    def header(self):
+        return fits.Header.fromstring(self._header)
+
+    @property
+    def spatial_index(self):
+        if self._index is None:
+            return None
+        if 'index' not in self._arrays:
+            rows_path, offsets_path = index_paths(self.ft_file, self.extension, self._index['nside'])
+            self._arrays['index'] = SpatialIndex(self._index['nside'], np.load(rows_path, mmap_mode='r'), np.load(offsets_path))
+        return self._arrays['index']
+
+
+def _column_values(column, table_data, raw, start, stop) -> np.ndarray:
+    if column.format.endswith('L'):
+        return raw[column.name][start:stop] == ord('T')
+    if column.bscale is not None or column.bzero is not None:
+        return np.asarray(table_data[start:stop][column.name])
+    return raw[column.name][start:stop]
+
+
+def build_columns(ft_file, chunk_size=CHUNK_SIZE) -> dict:
+    '''
+    Converts every binary table extension of a FITS file into one .npy file per column,
+    written chunk by chunk next to the file (see column_path). Tables with RA and DEC
+    columns get a spatial index too (see spatial.build_index), when healpy is available
+    and SPATIAL_INDEX_NSIDE is not 0.
+
+    Parameters:
+    ----------
+        ft_file: Input FT1 or FT2 file.
+        chunk_size: Number of rows converted at once.
+
+    Returns:
+    -------
+        Dictionary with the keys 'version', 'key' (see stats.file_fingerprint) and
+        'extensions' (per extension name 'n_rows', 'header', 'columns' and 'index').
+    '''
+    key = file_fingerprint(ft_file)
+    extensions = {}
+    with fits.open(ft_file, memmap=True) as hdul:
+        for hdu in hdul[1:]:
+            if not isinstance(hdu, fits.BinTableHDU) or int(hdu.header.get('PCOUNT', 0)) != 0:
+                continue
+            raw = raw_columns(hdu.data)
+            n_rows = len(raw)
+            columns = {}
+            for column in hdu.columns:
+                sample = _column_values(column, hdu.data, raw, 0, 1)
+                dtype = sample.dtype.newbyteorder('=')
+                with atomic_output(column_path(ft_file, hdu.name, column.name)) as tmp_path:
+                    array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(n_rows,) + sample.shape[1:])
+                    for start in range(0, n_rows, chunk_size):
+                        stop = min(start + chunk_size, n_rows)
+                        array[start:stop] = _column_values(column, hdu.data, raw, start, stop)
+                    array.flush()
+                    del array
+                columns[column.name] = {'dtype': dtype.str, 'shape': list(sample.shape[1:])}
+            extensions[hdu.name] = {'n_rows': n_rows, 'header': hdu.header.tostring(), 'columns': columns, 'index': None}
+            if hp is not None and SPATIAL_INDEX_NSIDE and 'RA' in columns and 'DEC' in columns:
+                rows_path, offsets_path = index_paths(ft_file, hdu.name, SPATIAL_INDEX_NSIDE)
+                ra = np.load(column_path(ft_file, hdu.name, 'RA'), mmap_mode='r')
+                dec = np.load(column_path(ft_file, hdu.name, 'DEC'), mmap_mode='r')
+                with atomic_output(rows_path) as tmp_rows_path, atomic_output(offsets_path) as tmp_offsets_path:
+                    offsets = build_index(ra, dec, n_rows, tmp_rows_path, SPATIAL_INDEX_NSIDE, chunk_size)
+                    with open(tmp_offsets_path, 'wb') as f:
+                        np.save(f, offsets)
+                extensions[hdu.name]['index'] = {'nside': SPATIAL_INDEX_NSIDE}
+    return {'version': COLUMNS_VERSION, 'key': key, 'extensions': extensions}
+
+
+def update_columns(ft_file) -> dict:
+    '''
+    Builds the columnar cache of a file and saves its metadata, which makes it valid.
+    Called when a file is downloaded or written by a merge.
+    '''
+    meta = build_columns(ft_file)
+    with atomic_output(columns_meta_path(ft_file)) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+    _remember(ft_file, meta)
+    return meta
+
+
+_meta_cache = {}
+_meta_cache_lock = threading.Lock()
+
+
+def _file_id(ft_file):
+    stat = os.stat(ft_file)
+    return (os.path.abspath(ft_file), stat.st_size, stat.st_mtime_ns)
+
+
+def _remember(ft_file, meta):
+    with _meta_cache_lock:
+        _meta_cache[os.path.abspath(ft_file)] = (_file_id(ft_file), meta)
+
+
+def _load_meta(ft_file):
+    '''
+    Returns the metadata of the columnar cache of a file, or None if it is missing or stale.
+    Validated metadata is kept in memory while the size and mtime of the file do not change.
+    '''
+    file_id = _file_id(ft_file)
+    with _meta_cache_lock:
+        cached = _meta_cache.get(file_id[0])
+    if cached is not None and cached[0] == file_id:
+        return cached[1]
+    try:
+        with open(columns_meta_path(ft_file)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != COLUMNS_VERSION or meta.get('key') != file_fingerprint(ft_file):
+        return None
+    with _meta_cache_lock:
+        _meta_cache[file_id[0]] = (file_id, meta)
+    return meta
+
+
+def load_columns(ft_file) -> dict:
+    '''
+    Returns the metadata of the columnar cache of a file, converting the file
+    when the cache is missing or does not match its current content.
+    '''
+    meta = _load_meta(ft_file)
+    if meta is None:
+        logging.info(" columns: converting %s", ft_file)
+        meta = update_columns(ft_file)
+    return meta
+
+
+def open_table(ft_file, extension, build=False):
+    '''
+    Opens an extension of the columnar cache of a file.
+
+    Parameters:
+    ----------
+        ft_file: FITS file.
+        extension: Extension name, e.g. 'EVENTS', 'GTI' or 'SC_DATA', or index (1 for the first extension).
+        build: If True, a missing or stale cache is rebuilt first.
+
+    Returns:
+    -------
+        ColumnarTable, or None if the file has no valid cache (or no such extension).
+    '''
+    meta = load_columns(ft_file) if build else _load_meta(ft_file)
+    if meta is None:
+        return None
+    if isinstance(extension, int):
+        names = list(meta['extensions'])
+        if not 0 < extension <= len(names):
+            return None
+        extension = names[extension - 1]
+    if extension not in meta['extensions']:
+        return None
+    return ColumnarTable(ft_file, extension, meta['extensions'][extension])
+
+
+def read_columns(ft_file, hdu):
+    '''
+    Columns of an open table extension of ft_file: the columnar cache when it is valid,
+    the raw records of the memory-mapped table otherwise (see kernels.raw_columns).
+    '''
+    table = open_table(ft_file, hdu.name)
+    return table if table is not None else raw_columns(hdu.data)
+
+
+@contextmanager
+def table_columns(ft_file, extension, decoded=False):
+    '''
+    Context manager yielding the columns of a table extension of ft_file: the columnar
+    cache when it is valid, else the memory-mapped table of the FITS file, as raw records
+    (see kernels.raw_columns) or, with decoded=True, as its FITS_rec.
+    '''
+    table = open_table(ft_file, extension)
+    if table is not None:
+        yield table
+        return
+    with fits.open(ft_file, memmap=True) as hdul:
+        data = hdul[extension].data
+        yield data if decoded else raw_columns(data)
+
+
+def read_table_gti(ft_file):
+    '''
+    Returns the (start, stop) float64 arrays of the GTI extension from the columnar cache,
+    or None if the file has no valid cache.
+    '''
+    table = open_table(ft_file, 'GTI')
+    if table is None:
+        return None
+    return (np.asarray(table['START'], dtype=np.float64),
+            np.asarray(table['STOP'], dtype=np.float64))
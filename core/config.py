@@ -1,11 +1,79 @@
 import os
-import uuid
 import sys
+import tempfile
 
 
 DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, DIR)
 USERNAME = os.getenv('USER', 'unknown_user')
 STATIC_DIR = 'static'
-uuid_str = str(uuid.uuid4())
-TMP_DIR = os.path.join(DIR, STATIC_DIR, USERNAME + '_' + uuid_str + '_tmp')
\ No newline at end of file
+# Root of the user workspaces; plots are served from /static, so it should stay under STATIC_DIR
+TMP_ROOT = os.getenv('FERMIFILTERS_TMP_ROOT', os.path.join(DIR, STATIC_DIR))
+
+# Workspaces: disk budget of all the workspaces and quota of the workspaces of each user, in bytes (0 disables them)
+WORKSPACE_BUDGET = int(os.getenv('FERMIFILTERS_WORKSPACE_BUDGET', 100 * 1024 ** 3))
+WORKSPACE_USER_QUOTA = int(os.getenv('FERMIFILTERS_WORKSPACE_USER_QUOTA', 20 * 1024 ** 3))
+# Seconds a workspace is kept after its last use at least, and between two eviction passes
+WORKSPACE_MIN_IDLE = float(os.getenv('FERMIFILTERS_WORKSPACE_MIN_IDLE', 3600))
+WORKSPACE_EVICTION_INTERVAL = float(os.getenv('FERMIFILTERS_WORKSPACE_EVICTION_INTERVAL', 300))
+
+# Downloads
+DOWNLOAD_WORKERS = int(os.getenv('FERMIFILTERS_DOWNLOAD_WORKERS', 4))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('FERMIFILTERS_DOWNLOAD_CHUNK_SIZE', 1024 * 1024))
+DOWNLOAD_TIMEOUT = float(os.getenv('FERMIFILTERS_DOWNLOAD_TIMEOUT', 60))
+DOWNLOAD_RETRIES = int(os.getenv('FERMIFILTERS_DOWNLOAD_RETRIES', 3))
+
+# Filtering engine
+ENGINE_BACKEND = os.getenv('FERMIFILTERS_ENGINE_BACKEND', 'native')
+CHUNK_SIZE = int(os.getenv('FERMIFILTERS_CHUNK_SIZE', 1000000))
+MKTIME_CACHE_SIZE = int(os.getenv('FERMIFILTERS_MKTIME_CACHE_SIZE', 64))
+
+# Sky maps
+PLOT_BACKEND = os.getenv('FERMIFILTERS_PLOT_BACKEND', 'healpix')
+HEALPIX_NSIDE = int(os.getenv('FERMIFILTERS_HEALPIX_NSIDE', 128))
+# Lowest resolution of the sky maps drawn by the browser (the first one loaded)
+SKYMAP_PREVIEW_NSIDE = int(os.getenv('FERMIFILTERS_SKYMAP_PREVIEW_NSIDE', 16))
+
+# Background jobs
+JOB_WORKERS = int(os.getenv('FERMIFILTERS_JOB_WORKERS', 4))
+JOB_RETENTION = float(os.getenv('FERMIFILTERS_JOB_RETENTION', 3600))
+
+# Archives
+ARCHIVE_CHUNK_SIZE = int(os.getenv('FERMIFILTERS_ARCHIVE_CHUNK_SIZE', 1024 * 1024))
+
+# External tools (Fermitools)
+TOOL_WORKERS = int(os.getenv('FERMIFILTERS_TOOL_WORKERS', os.cpu_count() or 1))
+TOOL_TIMEOUT = float(os.getenv('FERMIFILTERS_TOOL_TIMEOUT', 3600))
+# Installation prefix of the Fermitools (e.g. their conda environment): the tools directory
+# and the calibration data default to its layout, else to PATH and the server environment
+FERMITOOLS_PREFIX = os.getenv('FERMIFILTERS_FERMITOOLS_PREFIX')
+_FERMITOOLS_DATA = os.path.join(FERMITOOLS_PREFIX, 'share', 'fermitools') if FERMITOOLS_PREFIX else None
+TOOLS_DIR = os.getenv('FERMIFILTERS_TOOLS_DIR', os.path.join(FERMITOOLS_PREFIX, 'bin') if FERMITOOLS_PREFIX else None)
+CALDB = os.getenv('FERMIFILTERS_CALDB', os.path.join(_FERMITOOLS_DATA, 'data', 'caldb') if _FERMITOOLS_DATA else None)
+CALDBCONFIG = os.getenv('FERMIFILTERS_CALDBCONFIG', os.path.join(CALDB, 'software', 'tools', 'caldb.config') if CALDB else None)
+REFDATA = os.getenv('FERMIFILTERS_REFDATA', os.path.join(_FERMITOOLS_DATA, 'refdata') if _FERMITOOLS_DATA else None)
+# Environment variables set for the tool processes only
+TOOL_ENV = {name: value for name, value in (('CALDB', CALDB), ('CALDBCONFIG', CALDBCONFIG), ('REFDATA', REFDATA)) if value}
+
+# Stage memoization
+STAGE_CACHE_BUDGET = int(os.getenv('FERMIFILTERS_STAGE_CACHE_BUDGET', 4 * 1024 ** 3))
+
+# Shared weekly-file store (an empty FERMIFILTERS_STORE_DIR disables it)
+STORE_DIR = os.getenv('FERMIFILTERS_STORE_DIR', os.path.join(DIR, STATIC_DIR, '.weekly_store'))
+STORE_BUDGET = int(os.getenv('FERMIFILTERS_STORE_BUDGET', 50 * 1024 ** 3))
+
+# Columnar cache of the FT1/FT2 tables, built when files are downloaded or merged
+COLUMNAR_CACHE = os.getenv('FERMIFILTERS_COLUMNAR_CACHE', '1').lower() not in ('0', 'false', 'no', '')
+# NESTED HEALPix resolution of the spatial index of the events (0 disables it)
+SPATIAL_INDEX_NSIDE = int(os.getenv('FERMIFILTERS_SPATIAL_INDEX_NSIDE', 64))
+
+# Worker processes of the event-level kernels (1 runs them in the calling thread)
+PARALLEL_WORKERS = int(os.getenv('FERMIFILTERS_PARALLEL_WORKERS', 1))
+
+# Metrics: request traces kept for /metrics/requests/<id>, and the cProfile dumps of ?profile=1
+METRICS_TRACES = int(os.getenv('FERMIFILTERS_METRICS_TRACES', 200))
+PROFILE_DIR = os.getenv('FERMIFILTERS_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'fermifilters_profiles'))
+
+# Startup: preload the lazily imported modules (astropy frames, matplotlib fonts) when the
+# blueprint is registered (see lazy.warm_up)
+WARMUP = os.getenv('FERMIFILTERS_WARMUP', '0').lower() in ('1', 'true', 'yes')
@@ -0,0 +1,210 @@
+import os
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .config import DOWNLOAD_WORKERS, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_TIMEOUT, DOWNLOAD_RETRIES
+from .lazy import LazyModule
+
+requests = LazyModule('requests')
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DownloadManager:
+    '''
+    Downloads files concurrently through a shared HTTP session.
+
+    Every transfer is streamed chunk by chunk into a ``.part`` file next to the
+    destination. An existing ``.part`` file is resumed with an HTTP Range request,
+    and the file is renamed to its final name only after its size (and checksum,
+    when one is given) has been verified.
+
+    With a WeeklyFileStore, files are downloaded once into the shared store and
+    linked into the destination directory.
+    '''
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, max_workers=DOWNLOAD_WORKERS, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                 timeout=DOWNLOAD_TIMEOUT, retries=DOWNLOAD_RETRIES,
+                 session=None, progress_callback=None, store=None):
+        '''
+        Parameters:
+        ----------
+            max_workers: Maximum number of concurrent transfers.
+            chunk_size: Size in bytes of the chunks written to disk.
+            timeout: Connect/read timeout in seconds for each request.
+            retries: Number of attempts for each file before giving up.
+            session: Optional requests.Session shared by all transfers.
+            progress_callback: Optional callable(file_name, bytes_done, bytes_total),
+                called after every chunk. bytes_total is None when unknown.
+            store: Optional WeeklyFileStore shared by all the downloads.
+        '''
+        self.max_workers = max(1, int(max_workers))
+        self.chunk_size = int(chunk_size)
+        self.timeout = timeout
+        self.retries = max(1, int(retries))
+        self.progress_callback = progress_callback
+        self.store = store
+        self.session = session if session is not None else self._make_session()
+        self._lock = threading.Lock()
+
+    def _make_session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def download(self, tasks) -> dict:
+        '''
+        Downloads a batch of files with a bounded pool of workers.
+
+        Parameters:
+        ----------
+            tasks: Iterable of (url, output_file_path) tuples or dicts with the keys
+                'url', 'path' and optionally 'size' and 'checksum'.
+
+        Returns:
+        -------
+            Dictionary mapping each output path to True if it was downloaded
+            (or already present) and verified, False otherwise.
+        '''
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            for task in tasks:
+                if not isinstance(task, dict):
+                    url, path = task
+                    task = {'url': url, 'path': path}
+                future = executor.submit(self._download_task, task)
+                futures[task['path']] = future
+            for path, future in futures.items():
+                results[path] = future.result()
+        return results
+
+    def _download_task(self, task) -> bool:
+        try:
+            if self.store is not None:
+                self.store.fetch(os.path.basename(task['path']), task['path'],
+                                 lambda path: self.download_file(task['url'], path, task.get('size'), task.get('checksum')),
+                                 task.get('checksum'))
+            else:
+                self.download_file(task['url'], task['path'], task.get('size'), task.get('checksum'))
+        except Exception as e:
+            self.logger.error(f" Error downloading file from {task['url']}: {e}")
+            return False
+        return True
+
+    def download_file(self, url, output_file_path, expected_size=None, checksum=None):
+        '''
+        Streams a single file to disk, resuming a previous partial transfer if any.
+
+        Parameters:
+        ----------
+            url: URL of the file.
+            output_file_path: Destination path.
+            expected_size: Optional expected size in bytes.
+            checksum: Optional checksum as 'algorithm:hexdigest' (e.g. 'md5:...').
+
+        Returns:
+        -------
+            The output file path.
+
+        Raises:
+        ------
+            DownloadError if the file could not be downloaded or verified.
+        '''
+        if os.path.exists(output_file_path):
+            self.logger.info(f" File already exists: {output_file_path}, skipping download.")
+            return output_file_path
+        part_path = output_file_path + '.part'
+        last_error = None
+        for attempt in range(1, self.retries + 1):
+            try:
+                total = self._fetch(url, part_path, expected_size)
+                self._verify(part_path, total, checksum)
+                os.replace(part_path, output_file_path)
+                self.logger.info(f" Download completed: {output_file_path}")
+                return output_file_path
+            except requests.HTTPError as e:
+                status = e.response.status_code if e.response is not None else None
+                if status is not None and 400 <= status < 500 and status not in (408, 429):
+                    raise DownloadError(f"{url} returned {status}") from e
+                last_error = e
+                self.logger.warning(f" Attempt {attempt}/{self.retries} failed for {url}: {e}")
+            except (requests.RequestException, OSError) as e:
+                last_error = e
+                self.logger.warning(f" Attempt {attempt}/{self.retries} failed for {url}: {e}")
+            except DownloadError as e:
+                # A corrupted partial file cannot be resumed: start again from scratch.
+                last_error = e
+                self.logger.warning(f" Attempt {attempt}/{self.retries} failed for {url}: {e}")
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+        raise DownloadError(f"giving up on {url} after {self.retries} attempts: {last_error}")
+
+    def _fetch(self, url, part_path, expected_size=None):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if expected_size is not None and offset == expected_size:
+            return expected_size
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        file_name = os.path.basename(part_path[:-len('.part')])
+        self.logger.info(f" Starting download from {url} to {part_path[:-len('.part')]}" + (f" (resuming at {offset} bytes)" if offset else ''))
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 416:
+                # The partial file already holds the whole content.
+                return offset
+            response.raise_for_status()
+            if offset and response.status_code != 206:
+                # The server ignored the Range header and sends the whole file.
+                offset = 0
+            total = self._total_size(response, offset)
+            if expected_size is not None:
+                if total is not None and total != expected_size:
+                    raise DownloadError(f"server reports {total} bytes, expected {expected_size}")
+                total = expected_size
+            done = offset
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    if not chunk:
+                        continue
+                    f.write(chunk)
+                    done += len(chunk)
+                    self._report(file_name, done, total)
+        return total if total is not None else done
+
+    @staticmethod
+    def _total_size(response, offset):
+        content_range = response.headers.get('Content-Range')
+        if content_range and '/' in content_range:
+            total = content_range.rsplit('/', 1)[1]
+            if total.isdigit():
+                return int(total)
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit():
+            return int(content_length) + offset
+        return None
+
+    def _verify(self, part_path, total, checksum):
+        size = os.path.getsize(part_path)
+        if total is not None and size != total:
+            if size < total:
+                # Truncated transfer: keep the partial file so that the next attempt resumes it.
+                raise requests.ConnectionError(f"incomplete transfer, {size} of {total} bytes")
+            raise DownloadError(f"size mismatch, got {size} bytes, expected {total}")
+        if checksum:
+            algorithm, _, expected = checksum.partition(':')
+            digest = hashlib.new(algorithm.lower())
+            with open(part_path, 'rb') as f:
+                for block in iter(lambda: f.read(self.chunk_size), b''):
+                    digest.update(block)
+            if digest.hexdigest().lower() != expected.strip().lower():
+                raise DownloadError(f"{algorithm} checksum mismatch for {part_path}")
+
+    def _report(self, file_name, done, total):
+        if self.progress_callback is not None:
+            with self._lock:
+                self.progress_callback(file_name, done, total)
@@ -1,32 +1,83 @@
 import os
+import uuid
 import logging
-from astropy.io import fits
-from astropy.coordinates import SkyCoord
-from scipy.interpolate import interp1d
-import astropy.units as u
 import numpy as np
-import gt_apps
+from .columnar import read_columns, table_columns, update_columns
+from .config import ENGINE_BACKEND, CHUNK_SIZE, COLUMNAR_CACHE, PARALLEL_WORKERS
+from .fitsio import clean_header, update_select_dss_keywords, write_ft1, make_gti_hdu
+from .kernels import select_params, selection_mask, SEPARATION_OPERATORS, SunTrack, sun_cut_mask, mean_sun_direction, max_separation
+from .lazy import LazyModule
+from .merge import merge_ft1, merge_ft2
+from .metrics import current_span, traced
+from .mktime import ft2_gti, intersect_gtis, read_gti, roi_from_header, time_mask
+from .parallel import parallel_mask
+from .spatial import indexed_selection_mask
+from .stats import update_stats
+from .tools import ToolError, default_runner
 
-# Ensure Fermi tools are in PATH
-fermi_bin = '/home/adelfio/miniconda3/envs/fermi/bin'
-if fermi_bin not in os.environ.get('PATH', ''):
-    os.environ['PATH'] = fermi_bin + ':' + os.environ.get('PATH', '')
-
-# Set CALDB environment variables
-os.environ['CALDB'] = '/home/adelfio/miniconda3/envs/fermi/share/fermitools/data/caldb'
-os.environ['CALDBCONFIG'] = '/home/adelfio/miniconda3/envs/fermi/share/fermitools/data/caldb/software/tools/caldb.config'
-os.environ['REFDATA'] = '/home/adelfio/miniconda3/envs/fermi/share/fermitools/refdata'
-from astropy.table import Table, vstack
+fits = LazyModule('astropy.io.fits')
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
 
 
 class FiltersEngine:
+    BACKENDS = ('native', 'gtapps')
+
+    def __init__(self, backend=ENGINE_BACKEND, chunk_size=CHUNK_SIZE, tool_runner=None, workers=PARALLEL_WORKERS):
+        '''
+        Parameters:
+        ----------
+            backend: 'native' to run the event selections in-process with NumPy,
+                'gtapps' to run them through the Fermitools (kept for validation).
+            chunk_size: Number of events processed at once by the native kernels.
+            tool_runner: ToolRunner of the Fermitools invocations, defaults to the
+                one shared by the process (see tools.default_runner).
+            workers: Number of processes evaluating the event masks (see parallel.map_chunks).
+        '''
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown engine backend '{backend}', expected one of {self.BACKENDS}.")
+        self.backend = backend
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.tool_runner = tool_runner if tool_runner is not None else default_runner()
+
+    def _run_tool(self, tool, params, output_file) -> bool:
+        '''
+        Runs a Fermitools executable through the tool runner, with its own parameters.
+
+        Returns:
+        -------
+            True if the tool exited with code 0 and wrote output_file, False otherwise.
+        '''
+        try:
+            result = self.tool_runner.run(tool, params, cwd=os.path.dirname(output_file) or None)
+        except ToolError as e:
+            logging.error("Error during %s: %s", tool, e)
+            return False
+        if not result.ok:
+            logging.error("Error during %s: %s", tool, 'timed out' if result.timed_out else f"exit code {result.returncode}")
+            return False
+        if not os.path.exists(output_file):
+            logging.error("Error during %s: %s was not written", tool, output_file)
+            return False
+        logging.info(" %s: completed in %.1f s", tool, result.elapsed)
+        # The tool writes from its own process, out of reach of the thread measurements.
+        current_span().count(written_bytes=os.path.getsize(output_file))
+        return True
+
+    def _mask(self, kernel, ft1_file, columns, *args):
+        '''
+        Evaluates a row kernel on the EVENTS table of ft1_file, on self.workers processes.
+        '''
+        return parallel_mask(kernel, ft1_file, 'EVENTS', len(columns), *args, columns=columns,
+                             chunk_size=self.chunk_size, workers=self.workers)
 
+    @traced('engine.ft2_merge')
     def ft2_merge(self, ft2_file_list, output_file):
         """
-        Merges multiple FT2 (spacecraft) files into a single sorted FT2 file using Astropy.
+        Merges multiple FT2 (spacecraft) files into a single FT2 file sorted by START,
+        dropping the rows repeated where weekly files overlap (see merge.merge_ft2).
 
         Parameters
         ----------
@@ -41,32 +92,17 @@ class FiltersEngine:
             True if the merge and sort succeeded, False otherwise.
         """
         try:
-            all_tables = []
-
-            for ft2_file in ft2_file_list:
-                with fits.open(ft2_file) as hdul:
-                    sc_data = Table(hdul['SC_DATA'].data)
-                    all_tables.append(sc_data)
-
-            # Merge and sort the tables
-            merged_table = vstack(all_tables)
-            merged_table.sort('START')
-
-            # Create output HDU list
-            primary_hdu = fits.PrimaryHDU()
-            sc_data_hdu = fits.BinTableHDU(merged_table, name='SC_DATA')
-            hdul_out = fits.HDUList([primary_hdu, sc_data_hdu])
-
             os.makedirs(os.path.dirname(output_file), exist_ok=True)
-            hdul_out.writeto(output_file, overwrite=True)
-
-            logging.info("Successfully merged FT2 files into %s", output_file)
-            return True
-
+            n_rows = merge_ft2(ft2_file_list, output_file, self.chunk_size)
+            logging.info("Successfully merged FT2 files into %s (%d rows)", output_file, n_rows)
+            current_span().count(events_out=n_rows)
         except Exception as e:
             logging.error("Error during pure Python spacecraft merge: %s", e)
             return False
+        self._index(output_file)
+        return True
 
+    @traced('engine.gtmerge')
     def gtmerge(self, ft1_file_list, output_file, user_path) -> bool:
         '''
         Merges multiple FT1 files into a single FT1 file.
@@ -81,32 +117,71 @@ class FiltersEngine:
         -------
             True if the merge was successful, False otherwise.
         '''
-        infile_path = os.path.join(user_path, 'ft1_to_be_merged.txt')
-        with open(infile_path, 'w') as f:
-            for ft1_file in ft1_file_list:
-                f.write(ft1_file + '\n')
-        logging.info(" gtmerge: %s", ft1_file_list)
-        gt_apps.filter['infile'] = infile_path
-        gt_apps.filter['evclass'] = 128
-        gt_apps.filter['evtable'] = "EVENTS"
-        gt_apps.filter['evtype'] = 3
-        gt_apps.filter['outfile'] = output_file
-        gt_apps.filter['zmax'] = '180'
-        gt_apps.filter['zmin'] = '0'
-        gt_apps.filter['emin'] = '30'
-        gt_apps.filter['emax'] = '300000'
-        gt_apps.filter['ra'] = '0'
-        gt_apps.filter['dec'] = '0'
-        gt_apps.filter['rad'] = '180'
-        logging.info(" gtmerge: running with following parameters \n - infile: %s\n - outfile: %s", gt_apps.filter['infile'], gt_apps.filter['outfile'])
+        if self.backend == 'native':
+            merged = self._gtmerge_native(ft1_file_list, output_file)
+        else:
+            merged = self._gtmerge_gtapps(ft1_file_list, output_file, user_path)
+        if merged:
+            self._index(output_file)
+        return merged
+
+    def _index(self, output_file):
+        '''
+        Builds the statistics index (see stats.update_stats) and the columnar cache
+        (see columnar.update_columns) of a merged file.
+        '''
+        try:
+            update_stats(output_file)
+        except Exception as e:
+            logging.warning(" stats: could not index %s: %s", output_file, e)
+        if COLUMNAR_CACHE:
+            try:
+                update_columns(output_file)
+            except Exception as e:
+                logging.warning(" columns: could not convert %s: %s", output_file, e)
+
+    def _gtmerge_native(self, ft1_file_list, output_file) -> bool:
+        '''
+        Streams the events of the input files into the output with a k-way merge on TIME
+        (see merge.merge_ft1), without applying any selection.
+        '''
+        logging.info(" gtmerge (native): %s", ft1_file_list)
         try:
-            gt_apps.filter.run(print_command=False)
-            # os.remove('gtselect.par')
+            n_events = merge_ft1(ft1_file_list, output_file, self.chunk_size)
         except Exception as e:
             logging.error("Error during gtmerge: %s", e)
             return False
+        logging.info(" gtmerge (native): wrote %d events to %s", n_events, output_file)
+        current_span().count(events_out=n_events)
         return True
 
+    def _gtmerge_gtapps(self, ft1_file_list, output_file, user_path) -> bool:
+        infile_path = os.path.join(user_path, f'ft1_to_be_merged_{uuid.uuid4().hex}.txt')
+        with open(infile_path, 'w') as f:
+            for ft1_file in ft1_file_list:
+                f.write(ft1_file + '\n')
+        logging.info(" gtmerge: %s", ft1_file_list)
+        params = {
+            'infile': infile_path,
+            'evclass': 128,
+            'evtable': "EVENTS",
+            'evtype': 3,
+            'outfile': output_file,
+            'zmax': '180',
+            'zmin': '0',
+            'emin': '30',
+            'emax': '300000',
+            'ra': '0',
+            'dec': '0',
+            'rad': '180',
+        }
+        logging.info(" gtmerge: running with following parameters \n - infile: %s\n - outfile: %s", params['infile'], params['outfile'])
+        try:
+            return self._run_tool('gtselect', params, output_file)
+        finally:
+            os.remove(infile_path)
+
+    @traced('engine.gtselect')
     def gtselect(self, select_dict, ft1_file, output_file) -> bool:
         '''
         Selects events from the input FT1 file based on the input selection criteria.
@@ -122,27 +197,55 @@ class FiltersEngine:
             True if the selection was successful, False otherwise.
         '''
         logging.info(" gtselect: %s", select_dict)
-        gt_apps.filter['infile'] = ft1_file
-        gt_apps.filter['evclass'] = 128
-        gt_apps.filter['evtable'] = "EVENTS"
-        gt_apps.filter['evtype'] = 3
-        gt_apps.filter['outfile'] = output_file
-        gt_apps.filter['zmax'] = select_dict['zenith_angle'][1] if 'zenith_angle' in select_dict else 180
-        gt_apps.filter['zmin'] = select_dict['zenith_angle'][0] if 'zenith_angle' in select_dict else 0
-        gt_apps.filter['emin'] = select_dict['energy'][0] if 'energy' in select_dict else 30
-        gt_apps.filter['emax'] = select_dict['energy'][1] if 'energy' in select_dict else 300000
-        gt_apps.filter['ra'] = select_dict['ra'] if 'ra' in select_dict else 'INDEF'
-        gt_apps.filter['dec'] = select_dict['dec'] if 'dec' in select_dict else 'INDEF'
-        gt_apps.filter['rad'] = select_dict['radius'] if 'radius' in select_dict else 'INDEF'
-        logging.info(" gtselect: running with following parameters \n - infile: %s\n - outfile: %s\n - zmax: %s\n - zmin: %s\n - emin: %s\n - emax: %s\n - ra: %s\n - dec: %s\n - rad: %s", gt_apps.filter['infile'], gt_apps.filter['outfile'], gt_apps.filter['zmax'], gt_apps.filter['zmin'], gt_apps.filter['emin'], gt_apps.filter['emax'], gt_apps.filter['ra'], gt_apps.filter['dec'], gt_apps.filter['rad'])
+        if self.backend == 'native':
+            return self._gtselect_native(select_dict, ft1_file, output_file)
+        return self._gtselect_gtapps(select_dict, ft1_file, output_file)
+
+    def _gtselect_native(self, select_dict, ft1_file, output_file) -> bool:
+        '''
+        In-process equivalent of gtselect: applies the energy, zenith-angle, event class/type
+        and cone cuts on the EVENTS columns (see columnar.read_columns) and writes the DSS
+        keywords that gtselect would write. The GTI extension is copied unchanged.
+        Cone cuts on files with a spatial index only visit the events in the cone
+        (see spatial.indexed_selection_mask).
+        '''
+        params = select_params(select_dict)
+        logging.info(" gtselect (native): running with following parameters \n - infile: %s\n - outfile: %s\n - zmax: %s\n - zmin: %s\n - emin: %s\n - emax: %s\n - ra: %s\n - dec: %s\n - rad: %s", ft1_file, output_file, params['zmax'], params['zmin'], params['emin'], params['emax'], params['ra'], params['dec'], params['rad'])
         try:
-            gt_apps.filter.run(print_command=False)
-            # os.remove('gtselect.par')
+            with fits.open(ft1_file, memmap=True) as hdul:
+                columns = read_columns(ft1_file, hdul['EVENTS'])
+                mask = indexed_selection_mask(columns, params, len(columns), self.chunk_size)
+                if mask is None:
+                    mask = self._mask(selection_mask, ft1_file, columns, params)
+                events_header = clean_header(hdul['EVENTS'].header)
+                update_select_dss_keywords(events_header, params)
+                write_ft1(output_file, hdul, mask, events_header)
         except Exception as e:
             logging.error("Error during gtselect: %s", e)
             return False
+        logging.info(" gtselect (native): kept %d of %d events", np.count_nonzero(mask), len(mask))
+        current_span().count(events_in=len(mask), events_out=np.count_nonzero(mask))
         return True
 
+    def _gtselect_gtapps(self, select_dict, ft1_file, output_file) -> bool:
+        params = {
+            'infile': ft1_file,
+            'evclass': 128,
+            'evtable': "EVENTS",
+            'evtype': 3,
+            'outfile': output_file,
+            'zmax': select_dict['zenith_angle'][1] if 'zenith_angle' in select_dict else 180,
+            'zmin': select_dict['zenith_angle'][0] if 'zenith_angle' in select_dict else 0,
+            'emin': select_dict['energy'][0] if 'energy' in select_dict else 30,
+            'emax': select_dict['energy'][1] if 'energy' in select_dict else 300000,
+            'ra': select_dict['ra'] if 'ra' in select_dict else 'INDEF',
+            'dec': select_dict['dec'] if 'dec' in select_dict else 'INDEF',
+            'rad': select_dict['radius'] if 'radius' in select_dict else 'INDEF',
+        }
+        logging.info(" gtselect: running with following parameters \n - infile: %s\n - outfile: %s\n - zmax: %s\n - zmin: %s\n - emin: %s\n - emax: %s\n - ra: %s\n - dec: %s\n - rad: %s", params['infile'], params['outfile'], params['zmax'], params['zmin'], params['emin'], params['emax'], params['ra'], params['dec'], params['rad'])
+        return self._run_tool('gtselect', params, output_file)
+
+    @traced('engine.gtmktime')
     def gtmktime(self, maketime_dict, ft1_file, ft2_file, output_file) -> bool:
         '''
         Creates a GTI extension for the input FT1 file based on the input maketime criteria.
@@ -159,37 +262,67 @@ class FiltersEngine:
             True if the maketime was successful, False otherwise.
         '''
         logging.info(" gtmktime: %s", maketime_dict)
-        gt_apps.maketime['scfile'] = ft2_file
-        gt_apps.maketime['sctable'] = "SC_DATA"
-        gt_apps.maketime['filter'] = maketime_dict['filter_expr'] if 'filter_expr' in maketime_dict else ''
-        gt_apps.maketime['roicut'] = maketime_dict['roicut'] if 'roicut' in maketime_dict else False
-        gt_apps.maketime['evfile'] = ft1_file
-        gt_apps.maketime['evtable'] = "EVENTS"
-        gt_apps.maketime['outfile'] = output_file
-        gt_apps.maketime['apply_filter'] = "yes"
-        gt_apps.maketime['overwrite'] = "no"
-        gt_apps.maketime['header_obstimes'] = "yes"
-        gt_apps.maketime['tstart'] = 0.0
-        gt_apps.maketime['tstop'] = 0.0
-        gt_apps.maketime['gtifile'] = "default"
-        gt_apps.maketime['chatter'] = 2
-        gt_apps.maketime['clobber'] = "yes"
-        gt_apps.maketime['debug'] = "no"
-        gt_apps.maketime['gui'] = "no"
-        gt_apps.maketime['mode'] = "ql"
-        logging.info(" gtmktime: running with following parameters \n - scfile: %s\n - evfile: %s\n - outfile: %s\n - filter: %s", gt_apps.maketime['scfile'], gt_apps.maketime['evfile'], gt_apps.maketime['outfile'], gt_apps.maketime['filter'])
+        if self.backend == 'native':
+            return self._gtmktime_native(maketime_dict, ft1_file, ft2_file, output_file)
+        return self._gtmktime_gtapps(maketime_dict, ft1_file, ft2_file, output_file)
+
+    def _gtmktime_native(self, maketime_dict, ft1_file, ft2_file, output_file) -> bool:
+        '''
+        In-process equivalent of gtmktime: evaluates the filter expression on the FT2 rows,
+        merges the passing rows into GTIs, intersects them with the FT1 GTIs and keeps
+        the events inside the result (see core/mktime.py).
+        '''
+        filter_expr = maketime_dict['filter_expr'] if 'filter_expr' in maketime_dict else ''
+        roicut = str(maketime_dict.get('roicut', False)).lower() in ('true', 'yes', 'on', '1')
+        logging.info(" gtmktime (native): running with following parameters \n - scfile: %s\n - evfile: %s\n - outfile: %s\n - filter: %s\n - roicut: %s", ft2_file, ft1_file, output_file, filter_expr, roicut)
         try:
-            gt_apps.maketime.run(print_command=False)
-            # os.remove('gtmktime.par')
+            with fits.open(ft1_file, memmap=True) as hdul:
+                columns = read_columns(ft1_file, hdul['EVENTS'])
+                events_header = clean_header(hdul['EVENTS'].header)
+                roi = roi_from_header(events_header) if roicut else None
+                gti = intersect_gtis(ft2_gti(ft2_file, filter_expr, roi), read_gti(hdul['GTI']))
+                mask = self._mask(time_mask, ft1_file, columns, gti)
+                write_ft1(output_file, hdul, mask, events_header, make_gti_hdu(gti[0], gti[1], hdul['GTI'].header))
         except Exception as e:
             logging.error("Error during gtmktime: %s", e)
             return False
+        logging.info(" gtmktime (native): %d GTIs, kept %d of %d events", len(gti[0]), np.count_nonzero(mask), len(mask))
+        current_span().count(events_in=len(mask), events_out=np.count_nonzero(mask))
         return True
 
+    def _gtmktime_gtapps(self, maketime_dict, ft1_file, ft2_file, output_file) -> bool:
+        params = {
+            'scfile': ft2_file,
+            'sctable': "SC_DATA",
+            'filter': maketime_dict['filter_expr'] if 'filter_expr' in maketime_dict else '',
+            'roicut': maketime_dict['roicut'] if 'roicut' in maketime_dict else False,
+            'evfile': ft1_file,
+            'evtable': "EVENTS",
+            'outfile': output_file,
+            'apply_filter': "yes",
+            'overwrite': "no",
+            'header_obstimes': "yes",
+            'tstart': 0.0,
+            'tstop': 0.0,
+            'gtifile': "default",
+            'chatter': 2,
+            'clobber': "yes",
+            'debug': "no",
+            'gui': "no",
+            'mode': "h",
+        }
+        logging.info(" gtmktime: running with following parameters \n - scfile: %s\n - evfile: %s\n - outfile: %s\n - filter: %s", params['scfile'], params['evfile'], params['outfile'], params['filter'])
+        return self._run_tool('gtmktime', params, output_file)
+
+    @traced('engine.ecliptic_cut')
     def ecliptic_cut(self, ecliptic_cut_dict, ft1_file, ft2_file, output_file) -> bool:
         '''
         Applies an ecliptic cut to the input FT1 file based on the input FT2 file.
 
+        The Sun position at each event time is interpolated from the FT2 RA_SUN/DEC_SUN
+        columns and the events are processed in chunks of self.chunk_size rows
+        (see kernels.SunTrack and kernels.sun_separation).
+
         Parameters:
         ----------
             ecliptic_cut_dict: Dictionary containing the ecliptic cut criteria.
@@ -197,61 +330,33 @@ class FiltersEngine:
             ft2_file: Input FT2 file.
             output_file: Output FT1 file.
         '''
-        with fits.open(ft1_file) as hdul:
-            ft1_events = hdul['EVENTS'].data
-            ft1_header_events = hdul['EVENTS'].header
-            ft1_header_primary = hdul['PRIMARY'].header
-            ft1_gti = hdul['GTI'].copy()
-
-            evt_time = ft1_events['TIME']
-            evt_ra = ft1_events['RA']
-            evt_dec = ft1_events['DEC']
-
-        with fits.open(ft2_file) as hdul2:
-            sc_data = hdul2[1].data
-            sc_time = sc_data['START']
-            sc_ra_sun = sc_data['RA_SUN']
-            sc_dec_sun = sc_data['DEC_SUN']
-
-        interp_ra = interp1d(sc_time, sc_ra_sun, kind='linear', fill_value='extrapolate')
-        interp_dec = interp1d(sc_time, sc_dec_sun, kind='linear', fill_value='extrapolate')
-
-        sun_ra_evt = interp_ra(evt_time)
-        sun_dec_evt = interp_dec(evt_time)
-
-        evt_coords = SkyCoord(evt_ra * u.deg, evt_dec * u.deg, frame='icrs')
-        sun_coords_evt = SkyCoord(sun_ra_evt * u.deg, sun_dec_evt * u.deg, frame='icrs')
-        sep = evt_coords.separation(sun_coords_evt)
         degree_sep = float(ecliptic_cut_dict['eclipticradius']) if 'eclipticradius' in ecliptic_cut_dict else 0
-        operator = ecliptic_cut_dict['eclipticoperator'] if 'eclipticoperator' in ecliptic_cut_dict else '>'
-        if operator == 'lt':
-            mask = sep < degree_sep * u.deg
-        elif operator == 'gt':
-            mask = sep > degree_sep * u.deg
-        elif operator == 'lte':
-            mask = sep <= degree_sep * u.deg
-        elif operator == 'gte':
-            mask = sep >= degree_sep * u.deg
-        filtered_events = ft1_events[mask]
-
-        primary_hdu = fits.PrimaryHDU(header=ft1_header_primary)
-        events_hdu = fits.BinTableHDU(data=filtered_events, header=ft1_header_events, name='EVENTS')
-        gti_hdu = ft1_gti
-        hdul_out = fits.HDUList([primary_hdu, events_hdu, gti_hdu])
+        operator = ecliptic_cut_dict['eclipticoperator'] if 'eclipticoperator' in ecliptic_cut_dict else 'gt'
+        if operator not in SEPARATION_OPERATORS:
+            logging.error("Error during ecliptic_cut: unknown operator '%s'", operator)
+            return False
         logging.info(" ecliptic_cut: running with following parameters \n - ft1: %s\n - ft2: %s\n - radius: %s\n - operator: %s", ft1_file, ft2_file, degree_sep, operator)
         try:
-            hdul_out.writeto(output_file, overwrite=True)
+            with table_columns(ft2_file, 'SC_DATA', decoded=True) as sc_data:
+                sun_track = SunTrack.from_ft2(sc_data)
+
+            with fits.open(ft1_file, memmap=True) as hdul:
+                columns = read_columns(ft1_file, hdul['EVENTS'])
+                n_events = len(columns)
+                mask = self._mask(sun_cut_mask, ft1_file, columns, sun_track, degree_sep, operator)
+                write_ft1(output_file, hdul, mask)
+                if operator in ['lt', 'lte'] and mask.any():
+                    sun_ra_mean, sun_dec_mean = mean_sun_direction(columns, sun_track, n_events, self.chunk_size)
+                    degree_sep_mean = float(np.ceil(max_separation(columns, sun_ra_mean, sun_dec_mean, n_events, self.chunk_size, mask)))
         except Exception as e:
             logging.error("Error during ecliptic_cut: %s", e)
             return False
-        if operator in ['lt', 'lte']:
-            sun_ra_mean, sun_dec_mean = np.mean(sun_ra_evt), np.mean(sun_dec_evt)
-            sun_coords_mean = SkyCoord(sun_ra_mean * u.deg, sun_dec_mean * u.deg, frame='icrs')
-            evt_coords = SkyCoord(filtered_events['RA'] * u.deg, filtered_events['DEC'] * u.deg, frame='icrs')
-            sep_mean = evt_coords.separation(sun_coords_mean)
-            degree_sep_mean = float(np.ceil(max(sep_mean.deg)))
+        logging.info(" ecliptic_cut: kept %d of %d events", np.count_nonzero(mask), n_events)
+        current_span().count(events_in=n_events, events_out=np.count_nonzero(mask))
+        if operator in ['lt', 'lte'] and mask.any():
             select_dict = {'ra': sun_ra_mean, 'dec': sun_dec_mean, 'radius': degree_sep_mean}
-            self.gtselect(select_dict, output_file, f'select_{output_file}')
+            output_dir, output_name = os.path.split(output_file)
+            self.gtselect(select_dict, output_file, os.path.join(output_dir, f'select_{output_name}'))
         return True
     
 if __name__ == "__main__":
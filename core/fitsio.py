@@ -0,0 +1,357 @@
+import io
+import re
+import gzip
+import numpy as np
+from .config import CHUNK_SIZE
+from .kernels import raw_columns
+from .lazy import LazyModule
+from .workspace import AtomicOutput
+
+fits = LazyModule('astropy.io.fits')
+
+FITS_BLOCK_SIZE = 2880
+
+# Keywords that become stale as soon as the content of an HDU changes.
+STALE_KEYWORDS = ('CHECKSUM', 'DATASUM')
+DSS_PREFIXES = ('DSTYP', 'DSUNI', 'DSVAL', 'DSREF')
+# Keywords describing one column of a table, suffixed with its index.
+COLUMN_KEYWORD = re.compile(r'^(TTYPE|TFORM|TUNIT|TNULL|TSCAL|TZERO|TDISP|TDIM|TLMIN|TLMAX|TDMIN|TDMAX'
+                            r'|TCTYP|TCUNI|TCRPX|TCRVL|TCDLT|TCROT|TRPOS)(\d+)$')
+
+
+def clean_header(header):
+    '''
+    Returns a copy of the input header without the keywords invalidated by a rewrite.
+
+    Parameters:
+    ----------
+        header: astropy.io.fits.Header to be copied.
+
+    Returns:
+    -------
+        The cleaned copy of the header.
+    '''
+    header = header.copy()
+    for keyword in STALE_KEYWORDS:
+        header.remove(keyword, ignore_missing=True, remove_all=True)
+    return header
+
+
+def read_dss_keywords(header) -> list:
+    '''
+    Reads the Data Subspace (DSS) keywords of a FITS header.
+
+    Parameters:
+    ----------
+        header: astropy.io.fits.Header.
+
+    Returns:
+    -------
+        List of dictionaries with the 'type', 'unit', 'value' and 'ref' of each DSS keyword,
+        in the order of their index.
+    '''
+    keywords = []
+    for i in range(1, int(header.get('NDSKEYS', 0)) + 1):
+        if f'DSTYP{i}' not in header:
+            continue
+        keywords.append({
+            'type': header[f'DSTYP{i}'],
+            'unit': header.get(f'DSUNI{i}', ''),
+            'value': header.get(f'DSVAL{i}', ''),
+            'ref': header.get(f'DSREF{i}'),
+        })
+    return keywords
+
+
+def write_dss_keywords(header, keywords):
+    '''
+    Replaces all the DSS keywords of a FITS header, renumbering them from 1.
+
+    Parameters:
+    ----------
+        header: astropy.io.fits.Header, modified in place.
+        keywords: List of dictionaries as returned by read_dss_keywords.
+    '''
+    pattern = re.compile(r'^(%s)\d+$' % '|'.join(DSS_PREFIXES))
+    for keyword in [k for k in header.keys() if pattern.match(k)]:
+        header.remove(keyword, ignore_missing=True, remove_all=True)
+    header['NDSKEYS'] = len(keywords)
+    for i, keyword in enumerate(keywords, start=1):
+        header[f'DSTYP{i}'] = keyword['type']
+        header[f'DSUNI{i}'] = keyword.get('unit', '')
+        header[f'DSVAL{i}'] = keyword['value']
+        if keyword.get('ref'):
+            header[f'DSREF{i}'] = keyword['ref']
+
+
+def update_dss_keyword(header, dstyp, dsuni, dsval, dsref=None):
+    '''
+    Sets a DSS keyword, replacing an existing keyword of the same type
+    (for BIT_MASK keywords, of the same column) as gtselect does.
+
+    Parameters:
+    ----------
+        header: astropy.io.fits.Header, modified in place.
+        dstyp: Type of the keyword, e.g. 'ENERGY' or 'POS(RA,DEC)'.
+        dsuni: Unit of the keyword.
+        dsval: Value of the keyword, e.g. '30:300000'.
+        dsref: Optional reference, e.g. ':GTI'.
+    '''
+    keywords = read_dss_keywords(header)
+    new_keyword = {'type': dstyp, 'unit': dsuni, 'value': dsval, 'ref': dsref}
+    for i, keyword in enumerate(keywords):
+        if _dss_kind(keyword['type']) == _dss_kind(dstyp):
+            keywords[i] = new_keyword
+            break
+    else:
+        keywords.append(new_keyword)
+    write_dss_keywords(header, keywords)
+
+
+def _dss_kind(dstyp):
+    match = re.match(r'^BIT_MASK\(([^,]+),', dstyp)
+    if match:
+        return 'BIT_MASK', match.group(1).strip()
+    return dstyp.strip()
+
+
+def pass_version(header, default='P8R3'):
+    '''
+    Returns the event-class pass version declared by the BIT_MASK DSS keywords of a header.
+    '''
+    for keyword in read_dss_keywords(header):
+        match = re.match(r'^BIT_MASK\([^,]+,[^,]+,([^)]+)\)$', keyword['type'])
+        if match:
+            return match.group(1).strip()
+    return default
+
+
+def update_select_dss_keywords(header, params):
+    '''
+    Writes the DSS keywords of a gtselect run.
+
+    Parameters:
+    ----------
+        header: EVENTS header, modified in place.
+        params: Dictionary as returned by kernels.select_params.
+    '''
+    evclass_pass = pass_version(header)
+    update_dss_keyword(header, f"BIT_MASK(EVENT_CLASS,{params['evclass']},{evclass_pass})", 'DIMENSIONLESS', '1:1')
+    update_dss_keyword(header, f"BIT_MASK(EVENT_TYPE,{params['evtype']},{evclass_pass})", 'DIMENSIONLESS', '1:1')
+    if params['rad'] is not None:
+        update_dss_keyword(header, 'POS(RA,DEC)', 'deg', f"CIRCLE({params['ra']:g},{params['dec']:g},{params['rad']:g})")
+    update_dss_keyword(header, 'TIME', 's', 'TABLE', ':GTI')
+    update_dss_keyword(header, 'ENERGY', 'MeV', f"{params['emin']:g}:{params['emax']:g}")
+    update_dss_keyword(header, 'ZENITH_ANGLE', 'deg', f"{params['zmin']:g}:{params['zmax']:g}")
+
+
+def project_header(header, names):
+    '''
+    Returns a copy of a binary table header restricted to some of its columns.
+
+    The keywords of the kept columns are renumbered in the order of the table, the
+    keywords of the other columns are dropped and all the other keywords are kept.
+
+    Parameters:
+    ----------
+        header: astropy.io.fits.Header of a binary table.
+        names: Names of the columns to keep.
+
+    Returns:
+    -------
+        The projected header. NAXIS1 is left to the writer (see StreamingTableWriter).
+
+    Raises:
+    ------
+        ValueError if a column does not exist.
+    '''
+    table_names = [header[f'TTYPE{i}'] for i in range(1, int(header['TFIELDS']) + 1)]
+    unknown = set(names) - set(table_names)
+    if unknown:
+        raise ValueError(f"Unknown columns {sorted(unknown)}, expected some of {table_names}.")
+    indices = {i: j for j, i in enumerate((i for i, name in enumerate(table_names, start=1) if name in names), start=1)}
+    projected = fits.Header()
+    for card in header.cards:
+        match = COLUMN_KEYWORD.match(card.keyword)
+        if match is None:
+            projected.append((card.keyword, card.value, card.comment), bottom=True)
+        elif int(match.group(2)) in indices:
+            projected.append((f"{match.group(1)}{indices[int(match.group(2))]}", card.value, card.comment), bottom=True)
+    projected['TFIELDS'] = len(indices)
+    return projected
+
+
+def write_ft1(output_file, hdul, mask, events_header=None, gti_hdu=None, columns=None, compress=False, chunk_size=CHUNK_SIZE):
+    '''
+    Writes the events of an open FT1 file selected by a boolean mask.
+
+    The selected rows are copied chunk by chunk from the (memory-mapped) EVENTS table
+    through a StreamingTableWriter, so memory stays proportional to chunk_size whatever
+    the size of the input. The output is written atomically.
+
+    Parameters:
+    ----------
+        output_file: Output FT1 file.
+        hdul: Open HDUList of the input FT1 file.
+        mask: Boolean mask of the EVENTS rows to keep.
+        events_header: Optional EVENTS header, defaults to a clean copy of the input one.
+        gti_hdu: Optional GTI HDU, defaults to a copy of the input one.
+        columns: Optional names of the EVENTS columns to keep, defaults to all of them.
+        compress: If True, the output is gzip-compressed (see StreamingTableWriter).
+        chunk_size: Number of input rows copied at once.
+
+    Returns:
+    -------
+        Number of events written.
+    '''
+    if events_header is None:
+        events_header = clean_header(hdul['EVENTS'].header)
+    if gti_hdu is None:
+        gti_hdu = fits.BinTableHDU(data=hdul['GTI'].data, header=clean_header(hdul['GTI'].header), name='GTI')
+    rows = raw_columns(hdul['EVENTS'].data)
+    dtype = rows.dtype
+    if columns is not None:
+        events_header = project_header(events_header, columns)
+        dtype = np.dtype([(name, rows.dtype.fields[name][0]) for name in rows.dtype.names if name in columns])
+    with StreamingTableWriter(output_file, hdul['PRIMARY'].header, events_header, dtype,
+                              n_rows=int(np.count_nonzero(mask)), compress=compress) as writer:
+        writer.extra_hdus.append(gti_hdu)
+        for start in range(0, len(rows), chunk_size):
+            selected = rows[start:start + chunk_size][mask[start:start + chunk_size]]
+            if columns is not None:
+                projected = np.empty(len(selected), dtype=dtype)
+                for name in dtype.names:
+                    projected[name] = selected[name]
+                selected = projected
+            writer.write(selected)
+        return writer.n_rows
+
+
+def make_gti_hdu(start, stop, header=None):
+    '''
+    Builds a GTI extension from interval bounds.
+
+    Parameters:
+    ----------
+        start, stop: Bounds of the intervals, in seconds.
+        header: Optional header to copy the non-structural keywords from.
+
+    Returns:
+    -------
+        The GTI BinTableHDU. Its ONTIME keyword, if present, is updated.
+    '''
+    columns = [
+        fits.Column(name='START', format='D', unit='s', array=start),
+        fits.Column(name='STOP', format='D', unit='s', array=stop),
+    ]
+    header = clean_header(header) if header is not None else None
+    gti_hdu = fits.BinTableHDU.from_columns(columns, header=header, name='GTI')
+    if 'ONTIME' in gti_hdu.header:
+        gti_hdu.header['ONTIME'] = float((stop - start).sum())
+    return gti_hdu
+
+
+class StreamingTableWriter:
+    '''
+    Writes a FITS file with a binary table extension whose rows are appended incrementally.
+
+    The table header is written first and, unless the number of rows is given upfront,
+    patched with the final NAXIS2 when the writer is closed, so memory stays proportional
+    to the rows passed to each write() call. Rows must be raw FITS records
+    (see kernels.raw_columns) with the dtype of the table. Extensions that are only known
+    at the end (e.g. GTI) are appended on close. The file is written under a temporary
+    name and renamed to output_file on close (see workspace.AtomicOutput), so that it
+    never appears partially written.
+
+    With compress=True the whole file is gzip-compressed as it is written, which astropy
+    and the Fermitools (cfitsio) read transparently; the number of rows must then be
+    given upfront, as the header cannot be patched. Compressed files cannot be
+    memory-mapped, so intermediate outputs read by other stages should not be compressed.
+
+    Usage:
+    -----
+        with StreamingTableWriter(path, primary_header, events_header, dtype) as writer:
+            writer.write(rows)
+            writer.extra_hdus.append(gti_hdu)
+    '''
+
+    def __init__(self, output_file, primary_header, table_header, dtype, n_rows=None, compress=False):
+        if int(table_header.get('PCOUNT', 0)) != 0:
+            raise ValueError("Streaming tables with a heap (variable-length columns) is not supported.")
+        if compress and n_rows is None:
+            raise ValueError("Compressed tables need their number of rows upfront.")
+        self.output_file = output_file
+        self.dtype = np.dtype(dtype)
+        self.expected_rows = n_rows
+        self.table_header = clean_header(table_header)
+        self.table_header['NAXIS1'] = self.dtype.itemsize
+        self.table_header['NAXIS2'] = n_rows or 0
+        self.n_rows = 0
+        self.extra_hdus = []
+        self._output = AtomicOutput(output_file)
+        self._file = gzip.open(self._output.tmp_path, 'wb', compresslevel=6) if compress else open(self._output.tmp_path, 'wb')
+        primary = fits.PrimaryHDU(header=clean_header(primary_header))
+        self._file.write(primary.header.tostring().encode('ascii'))
+        self._header_offset = self._file.tell()
+        self._file.write(self.table_header.tostring().encode('ascii'))
+
+    def write(self, rows):
+        '''
+        Appends raw FITS records to the table.
+        '''
+        if rows.dtype != self.dtype:
+            raise ValueError(f"Row dtype {rows.dtype} does not match the table dtype {self.dtype}.")
+        if self.expected_rows is not None and self.n_rows + len(rows) > self.expected_rows:
+            raise ValueError(f"More rows than the {self.expected_rows} declared.")
+        self._file.write(np.ascontiguousarray(rows).data)
+        self.n_rows += len(rows)
+
+    def close(self):
+        '''
+        Pads the table, patches NAXIS2, appends the extra extensions and moves the file
+        to output_file.
+        '''
+        if self._file is None:
+            return
+        if self.expected_rows is not None and self.n_rows != self.expected_rows:
+            self.abort()
+            raise ValueError(f"{self.n_rows} rows written, {self.expected_rows} declared.")
+        self._file.write(b'\0' * (-self._file.tell() % FITS_BLOCK_SIZE))
+        if self.expected_rows is None:
+            end = self._file.tell()
+            self.table_header['NAXIS2'] = self.n_rows
+            self._file.seek(self._header_offset)
+            self._file.write(self.table_header.tostring().encode('ascii'))
+            self._file.seek(end)
+        if self.extra_hdus:
+            self._file.write(self._extensions_bytes(self.extra_hdus))
+        self._file.close()
+        self._file = None
+        self._output.commit()
+
+    @staticmethod
+    def _extensions_bytes(hdus) -> bytes:
+        # Serialized by astropy behind an empty primary HDU, which is then skipped.
+        hdul = fits.HDUList([fits.PrimaryHDU()] + list(hdus))
+        buffer = io.BytesIO()
+        hdul.writeto(buffer)
+        return buffer.getvalue()[len(hdul[0].header.tostring()):]
+
+    def abort(self):
+        '''
+        Closes and removes a partially written file.
+        '''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._output.discard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
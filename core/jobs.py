@@ -0,0 +1,267 @@
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from .config import JOB_WORKERS, JOB_RETENTION
+from .metrics import profiled, trace
+
+FINISHED_STATUSES = ('done', 'failed', 'cancelled')
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    '''
+    A unit of background work, made of named stages with their own status, progress and timing.
+
+    The job function receives the Job as first argument and reports through it:
+
+        def work(job, ...):
+            with job.stage('merge'):
+                ...
+                job.progress('merge', 0.5)
+
+    Cancellation is cooperative: begin() and progress() raise JobCancelled once the
+    job has been cancelled, so the work stops at the next stage or progress report.
+    '''
+
+    def __init__(self, kind, stages=(), group=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.group = group
+        self.status = 'queued'
+        self.error = None
+        self.result = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.stages = [self._new_stage(name) for name in stages]
+        self.version = 0
+        self.future = None
+        self._cancel_event = threading.Event()
+        self._changed = threading.Condition()
+
+    @staticmethod
+    def _new_stage(name):
+        return {'name': name, 'status': 'pending', 'progress': 0.0, 'started': None, 'finished': None}
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled(f"Job {self.id} was cancelled")
+
+    def _stage(self, name):
+        for stage in self.stages:
+            if stage['name'] == name:
+                return stage
+        stage = self._new_stage(name)
+        self.stages.append(stage)
+        return stage
+
+    def _update(self, **fields):
+        with self._changed:
+            for key, value in fields.items():
+                setattr(self, key, value)
+            self.version += 1
+            self._changed.notify_all()
+
+    def begin(self, name):
+        '''
+        Marks a stage as running.
+        '''
+        self.check_cancelled()
+        with self._changed:
+            stage = self._stage(name)
+            if stage['status'] == 'pending':
+                stage.update(status='running', started=time.time())
+            self.version += 1
+            self._changed.notify_all()
+
+    def progress(self, name, fraction):
+        '''
+        Sets the progress (0 to 1) of a stage, marking it as running if needed.
+        '''
+        self.check_cancelled()
+        with self._changed:
+            stage = self._stage(name)
+            if stage['status'] == 'pending':
+                stage.update(status='running', started=time.time())
+            stage['progress'] = min(max(float(fraction), 0.0), 1.0)
+            self.version += 1
+            self._changed.notify_all()
+
+    def end(self, name, status='done'):
+        '''
+        Marks a stage as finished with the given status.
+        '''
+        with self._changed:
+            stage = self._stage(name)
+            if stage['started'] is None:
+                stage['started'] = time.time()
+            stage.update(status=status, finished=time.time())
+            if status == 'done':
+                stage['progress'] = 1.0
+            self.version += 1
+            self._changed.notify_all()
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Runs a block as a stage: it is marked as done if the block completes, failed otherwise.
+        The block is traced (see metrics.trace) as the stage '<job kind>.<stage name>'.
+        '''
+        self.begin(name)
+        try:
+            with trace(f"{self.kind}.{name}"):
+                yield
+        except BaseException:
+            self.end(name, 'cancelled' if self.cancelled else 'failed')
+            raise
+        self.end(name)
+
+    def wait(self, version, timeout=None) -> int:
+        '''
+        Blocks until the job changes after the given version (or the timeout expires)
+        and returns the current version.
+        '''
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version or self.is_finished, timeout)
+            return self.version
+
+    def to_dict(self) -> dict:
+        '''
+        Returns a JSON-serializable snapshot of the job.
+        '''
+        with self._changed:
+            now = time.time()
+            stages = []
+            for stage in self.stages:
+                stage = dict(stage)
+                stage['elapsed'] = (stage['finished'] or now) - stage['started'] if stage['started'] else None
+                stages.append(stage)
+            return {
+                'id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'error': self.error,
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished,
+                'elapsed': (self.finished or now) - self.started if self.started else None,
+                'stages': stages,
+                'result': self.result if self.status == 'done' else None,
+                'version': self.version,
+            }
+
+
+class JobManager:
+    '''
+    Runs jobs on a local pool of worker threads and keeps their state for the status endpoints.
+
+    Finished jobs are kept for `retention` seconds. A job submitted with supersede=True
+    cancels the unfinished jobs of the same kind and group (e.g. the previous
+    /apply_filters run of the same workspace).
+    '''
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, max_workers=JOB_WORKERS, retention=JOB_RETENTION):
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(max_workers)), thread_name_prefix='fermifilters-job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, fn, *args, stages=(), group=None, supersede=False, **kwargs) -> Job:
+        '''
+        Queues fn(job, *args, **kwargs) and returns the job immediately. The job runs in a
+        copy of the current context, so its stages are added to the trace of the request
+        that submitted it.
+
+        Parameters:
+        ----------
+            kind: Kind of job, e.g. 'process_vo'.
+            fn: Job function, its return value becomes the job result.
+            stages: Names of the stages known in advance, reported as pending.
+            group: Optional group (e.g. the workspace id) used by supersede.
+            supersede: If True, the unfinished jobs of the same kind and group are cancelled.
+
+        Returns:
+        -------
+            The queued Job.
+        '''
+        job = Job(kind, stages, group)
+        with self._lock:
+            self._purge()
+            superseded = [j for j in self._jobs.values()
+                          if supersede and j.kind == kind and j.group == group and not j.is_finished]
+            self._jobs[job.id] = job
+        for old_job in superseded:
+            self.logger.info(" jobs: %s %s superseded by %s", kind, old_job.id, job.id)
+            self.cancel(old_job.id)
+        job.future = self._executor.submit(contextvars.copy_context().run, self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def active(self, group) -> bool:
+        '''
+        Returns True if a job of the group is queued or running.
+        '''
+        with self._lock:
+            return any(job.group == group and not job.is_finished for job in self._jobs.values())
+
+    def cancel(self, job_id) -> bool:
+        '''
+        Requests the cancellation of a job. Queued jobs never start; running jobs
+        stop at their next stage or progress report.
+
+        Returns:
+        -------
+            False if the job does not exist or is already finished, True otherwise.
+        '''
+        job = self.get(job_id)
+        if job is None or job.is_finished:
+            return False
+        job._cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            job._update(status='cancelled', finished=time.time())
+        return True
+
+    def _run(self, job, fn, args, kwargs):
+        if job.cancelled:
+            job._update(status='cancelled', finished=time.time())
+            return
+        job._update(status='running', started=time.time())
+        try:
+            with trace(job.kind), profiled(job.kind):
+                result = fn(job, *args, **kwargs)
+        except JobCancelled:
+            job._update(status='cancelled', finished=time.time())
+        except Exception as e:
+            self.logger.exception(" jobs: %s %s failed", job.kind, job.id)
+            job._update(status='cancelled' if job.cancelled else 'failed', error=str(e), finished=time.time())
+        else:
+            job._update(status='cancelled' if job.cancelled else 'done', result=result, finished=time.time())
+
+    def _purge(self):
+        now = time.time()
+        for job_id in [i for i, j in self._jobs.items() if j.is_finished and now - j.finished > self.retention]:
+            del self._jobs[job_id]
+
+    def shutdown(self, wait=True):
+        for job_id in list(self._jobs):
+            self.cancel(job_id)
+        self._executor.shutdown(wait=wait)
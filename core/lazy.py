@@ -0,0 +1,85 @@
+import logging
+import importlib
+import importlib.util
+import threading
+
+
+class LazyModule:
+    '''
+    Stands in for a module until one of its attributes is used, then imports it.
+    '''
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'{' (loaded)' if self._module is not None else ''}>"
+
+
+def lazy_module(name):
+    '''
+    Returns a LazyModule for an optional module, or None if it is not installed: unlike
+    'try: import ... except ImportError', the check does not import the module, so
+    'module is None' tests stay cheap at import time.
+    '''
+    try:
+        found = importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        found = False
+    return LazyModule(name) if found else None
+
+
+def warm_up(background=False):
+    '''
+    Imports the modules loaded lazily by the engine, plotter and readers, and builds the
+    astropy frame transforms and the matplotlib font cache, so that the first request of
+    a worker does not pay for them. Meant for pre-forked servers, e.g. in a gunicorn
+    configuration file:
+
+        def post_fork(server, worker):
+            from FermiFilters.core.lazy import warm_up
+            warm_up()
+
+    Parameters:
+    ----------
+        background: If True, warms up in a daemon thread and returns immediately.
+
+    Returns:
+    -------
+        The thread if background is True, None otherwise.
+    '''
+    if background:
+        thread = threading.Thread(target=warm_up, name='fermifilters-warmup', daemon=True)
+        thread.start()
+        return thread
+    try:
+        import numpy as np
+        import astropy.units as u
+        from astropy.coordinates import SkyCoord
+        from .skymap import hp
+        from .utils import pyplot
+        SkyCoord(ra=[0.0] * u.deg, dec=[0.0] * u.deg, frame='icrs').galactic
+        if hp is not None:
+            hp.ang2pix(1, 0.0, 0.0, lonlat=True)
+        plt = pyplot()
+        fig, ax = plt.subplots(subplot_kw={'projection': 'mollweide'})
+        ax.pcolormesh(np.zeros((2, 2)))
+        ax.set_title('warm-up')
+        fig.canvas.draw()
+        plt.close(fig)
+    except Exception as e:
+        logging.warning(" warm-up: %s", e)
+    else:
+        logging.info(" warm-up: done")
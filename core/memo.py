@@ -0,0 +1,121 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import logging
+from .config import STAGE_CACHE_BUDGET
+from .stats import file_fingerprint
+from .workspace import atomic_output
+
+MEMO_VERSION = 1
+STAGE_CACHE_DIR = '.stage_cache'
+
+
+def link_or_copy(src, dst):
+    '''
+    Hard-links src to dst (replacing dst), copying it when a link is not possible.
+    '''
+    # rename() is a no-op when both names link the same file, which would leave tmp_path.
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    with atomic_output(dst) as tmp_path:
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            shutil.copyfile(src, tmp_path)
+
+
+class StageCache:
+    '''
+    Per-workspace store of filter stage outputs, keyed by the content of the stage inputs
+    and the normalized stage parameters.
+
+    The key of a stage chains the key of its input (the content fingerprint of the FT1
+    file for the first stage, the key of the previous stage otherwise) with the stage
+    name, its parameters, the fingerprint of the FT2 file when the stage reads it and
+    the engine backend. A stage whose key is in the cache is not run again: its output
+    is hard-linked to the requested path. Entries are touched on every hit and the least
+    recently used ones are evicted when the cache exceeds its disk budget.
+    '''
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, cache_dir, budget=STAGE_CACHE_BUDGET):
+        self.cache_dir = cache_dir
+        self.budget = budget
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def input_key(ft_file) -> str:
+        return file_fingerprint(ft_file)
+
+    @staticmethod
+    def stage_key(parent_key, stage_name, params, ft2_key=None, backend='native') -> str:
+        '''
+        Returns the key of the output of a stage run on the input identified by parent_key.
+        '''
+        payload = json.dumps([MEMO_VERSION, parent_key, stage_name, params, ft2_key, backend], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def path(self, key) -> str:
+        return os.path.join(self.cache_dir, f"{key}.fits")
+
+    def staging_path(self, key) -> str:
+        '''
+        Path where a stage output that is only kept in the cache can be written before put().
+        '''
+        return os.path.join(self.cache_dir, f"{key}.{uuid.uuid4().hex}.part.fits")
+
+    def __contains__(self, key) -> bool:
+        return os.path.exists(self.path(key))
+
+    def get(self, key, output_file) -> bool:
+        '''
+        Materializes a cached output at output_file.
+
+        Returns:
+        -------
+            True on a cache hit, False if the key is not cached.
+        '''
+        try:
+            link_or_copy(self.path(key), output_file)
+            # Touch the entry (and the linked output, so that plot caches keyed by mtime see it as new).
+            os.utime(output_file)
+        except FileNotFoundError:
+            return False
+        self.logger.info(" memo: hit %s -> %s", key[:12], output_file)
+        return True
+
+    def put(self, key, output_file):
+        '''
+        Stores a stage output in the cache. Staging files are moved, other files linked.
+        '''
+        if os.path.dirname(os.path.abspath(output_file)) == os.path.abspath(self.cache_dir):
+            os.replace(output_file, self.path(key))
+        else:
+            link_or_copy(output_file, self.path(key))
+        self.evict()
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache fits in its budget.
+        '''
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith('.part.fits') or not file_name.endswith('.fits'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, file_name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file_name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total <= self.budget:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, file_name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.logger.info(" memo: evicted %s", file_name)
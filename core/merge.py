@@ -0,0 +1,250 @@
+import logging
+from contextlib import ExitStack
+import numpy as np
+from .config import CHUNK_SIZE
+from .fitsio import StreamingTableWriter, clean_header, make_gti_hdu, read_dss_keywords, write_dss_keywords
+from .kernels import raw_columns
+from .lazy import LazyModule
+from .mktime import merge_gtis, read_gti
+
+fits = LazyModule('astropy.io.fits')
+
+
+def is_time_sorted(times, chunk_size=CHUNK_SIZE, strict=False) -> bool:
+    '''
+    Checks chunk by chunk that a (possibly memory-mapped) time column is non-decreasing
+    (strictly increasing if strict is True).
+    '''
+    n_rows = len(times)
+    for start in range(0, n_rows, chunk_size):
+        stop = min(start + chunk_size + 1, n_rows)
+        steps = np.diff(times[start:stop])
+        if np.any(steps <= 0) if strict else np.any(steps < 0):
+            return False
+    return True
+
+
+def merge_dss_keywords(headers) -> list:
+    '''
+    Combines the DSS keywords of the merged files.
+
+    Keywords with the same value in every file are kept; range keywords ('min:max')
+    of the same type are widened to cover all the files; any other keyword that
+    differs between the files no longer describes the merged data and is dropped.
+    '''
+    all_keywords = [read_dss_keywords(header) for header in headers]
+    merged = []
+    for keyword in all_keywords[0]:
+        same_type = [next((k for k in keywords if k['type'] == keyword['type']), None) for keywords in all_keywords]
+        if any(k is None for k in same_type):
+            logging.warning(" merge: dropping DSS keyword %s, missing in some inputs", keyword['type'])
+            continue
+        values = {str(k['value']) for k in same_type}
+        if len(values) == 1:
+            merged.append(keyword)
+            continue
+        try:
+            bounds = [tuple(float(x) for x in value.split(':')) for value in values]
+        except ValueError:
+            logging.warning(" merge: dropping DSS keyword %s, inputs disagree: %s", keyword['type'], sorted(values))
+            continue
+        low, high = min(b[0] for b in bounds), max(b[1] for b in bounds)
+        merged.append(dict(keyword, value=f"{low:g}:{high:g}"))
+    return merged
+
+
+def update_time_keywords(header, headers):
+    '''
+    Sets TSTART/TSTOP (and DATE-OBS/DATE-END, if present) to span all the input headers.
+    '''
+    first = min(headers, key=lambda h: h.get('TSTART', np.inf))
+    last = max(headers, key=lambda h: h.get('TSTOP', -np.inf))
+    for keyword, source in (('TSTART', first), ('DATE-OBS', first), ('TSTOP', last), ('DATE-END', last)):
+        if keyword in header and keyword in source:
+            header[keyword] = source[keyword]
+
+
+def merge_ft1(ft1_file_list, output_file, chunk_size=CHUNK_SIZE) -> int:
+    '''
+    Merges time-sorted FT1 files into a single time-sorted FT1 file, streaming the events.
+
+    When the files are internally sorted and their time ranges are disjoint, their
+    events are block-copied one file after the other. Otherwise they are combined with
+    a chunked k-way merge on TIME: at each step every input contributes the events of
+    its current window up to the smallest window end among the inputs with more events
+    left, so memory stays proportional to chunk_size. The output GTI is the union of the
+    input GTIs, and TSTART/TSTOP and the DSS keywords are updated to cover all the inputs.
+
+    Parameters:
+    ----------
+        ft1_file_list: List of FT1 files, each sorted by TIME.
+        output_file: Output FT1 file.
+        chunk_size: Total number of events buffered at once.
+
+    Returns:
+    -------
+        Number of events written.
+    '''
+    with ExitStack() as stack:
+        hduls = [stack.enter_context(fits.open(ft1_file, memmap=True)) for ft1_file in ft1_file_list]
+        events = [raw_columns(hdul['EVENTS'].data) for hdul in hduls]
+        dtype = events[0].dtype
+        for ft1_file, rows in zip(ft1_file_list, events):
+            if rows.dtype != dtype:
+                raise ValueError(f"{ft1_file} has a different EVENTS layout than {ft1_file_list[0]}.")
+            if not is_time_sorted(rows['TIME'], chunk_size):
+                raise ValueError(f"{ft1_file} is not sorted by TIME.")
+        order = sorted((i for i in range(len(hduls)) if len(events[i])), key=lambda i: events[i]['TIME'][0])
+
+        events_headers = [hdul['EVENTS'].header for hdul in hduls]
+        primary_header = clean_header(hduls[0]['PRIMARY'].header)
+        events_header = clean_header(events_headers[0])
+        gti_header = clean_header(hduls[0]['GTI'].header)
+        for header, headers in ((primary_header, [h['PRIMARY'].header for h in hduls]),
+                                (events_header, events_headers),
+                                (gti_header, [h['GTI'].header for h in hduls])):
+            update_time_keywords(header, headers)
+        write_dss_keywords(events_header, merge_dss_keywords(events_headers))
+        gti = merge_gtis(np.concatenate([read_gti(hdul['GTI'])[0] for hdul in hduls]),
+                         np.concatenate([read_gti(hdul['GTI'])[1] for hdul in hduls]))
+
+        with StreamingTableWriter(output_file, primary_header, events_header, dtype) as writer:
+            writer.extra_hdus.append(make_gti_hdu(gti[0], gti[1], gti_header))
+            disjoint = all(events[a]['TIME'][-1] <= events[b]['TIME'][0] for a, b in zip(order, order[1:]))
+            if disjoint:
+                logging.info(" merge: inputs are disjoint and sorted, block-copying %d files", len(order))
+                for i in order:
+                    for start in range(0, len(events[i]), chunk_size):
+                        writer.write(events[i][start:start + chunk_size])
+            else:
+                logging.info(" merge: k-way merge of %d overlapping files", len(order))
+                _kway_merge([events[i] for i in order], writer, chunk_size)
+            n_rows = writer.n_rows
+    return n_rows
+
+
+def _kway_merge(inputs, writer, chunk_size):
+    window = max(chunk_size // max(len(inputs), 1), 1)
+    positions = [0] * len(inputs)
+    while True:
+        active = [i for i, rows in enumerate(inputs) if positions[i] < len(rows)]
+        if not active:
+            return
+        windows = {i: inputs[i][positions[i]:positions[i] + window] for i in active}
+        # Inputs with events beyond their window bound what can be safely emitted.
+        bounded = [windows[i]['TIME'][-1] for i in active if positions[i] + window < len(inputs[i])]
+        frontier = min(bounded) if bounded else np.inf
+        taken = []
+        for i in active:
+            count = np.searchsorted(windows[i]['TIME'], frontier, side='right')
+            if count:
+                taken.append(windows[i][:count])
+                positions[i] += count
+        # Filled slice by slice: np.concatenate would convert the big-endian records to native order.
+        rows = np.empty(sum(len(t) for t in taken), dtype=writer.dtype)
+        offset = 0
+        for t in taken:
+            rows[offset:offset + len(t)] = t
+            offset += len(t)
+        writer.write(rows[np.argsort(rows['TIME'], kind='stable')])
+
+
+def merge_ft2(ft2_file_list, output_file, chunk_size=CHUNK_SIZE) -> int:
+    '''
+    Merges FT2 (spacecraft) files into a single FT2 file sorted by START, without duplicate rows.
+
+    When every file is strictly increasing in START and consecutive files overlap at most
+    by rows repeated at their edges, the rows are block-copied and the repeated rows skipped.
+    Otherwise the START values and row origins are collected into arrays preallocated from
+    the input row counts, merged with a stable sort of the sorted runs, de-duplicated on
+    START (keeping the first occurrence) and the rows are gathered chunk by chunk from the
+    memory-mapped inputs. In both cases the output is written in chunks of chunk_size rows,
+    so memory never holds more than one copy of the spacecraft data index.
+
+    Parameters:
+    ----------
+        ft2_file_list: List of FT2 files.
+        output_file: Output FT2 file.
+        chunk_size: Number of rows written at once.
+
+    Returns:
+    -------
+        Number of rows written.
+    '''
+    with ExitStack() as stack:
+        hduls = [stack.enter_context(fits.open(ft2_file, memmap=True)) for ft2_file in ft2_file_list]
+        tables = [raw_columns(hdul['SC_DATA'].data) for hdul in hduls]
+        dtype = tables[0].dtype
+        for ft2_file, rows in zip(ft2_file_list, tables):
+            if rows.dtype != dtype:
+                raise ValueError(f"{ft2_file} has a different SC_DATA layout than {ft2_file_list[0]}.")
+        order = sorted((i for i in range(len(hduls)) if len(tables[i])), key=lambda i: tables[i]['START'][0])
+        tables = [tables[i] for i in order]
+
+        primary_header = clean_header(hduls[0]['PRIMARY'].header)
+        sc_header = clean_header(hduls[0]['SC_DATA'].header)
+        update_time_keywords(primary_header, [h['PRIMARY'].header for h in hduls])
+        update_time_keywords(sc_header, [h['SC_DATA'].header for h in hduls])
+
+        with StreamingTableWriter(output_file, primary_header, sc_header, dtype) as writer:
+            skips = _edge_duplicates(tables, chunk_size)
+            if skips is not None:
+                logging.info(" ft2_merge: inputs are sorted, block-copying %d files", len(tables))
+                for rows, skip in zip(tables, skips):
+                    for start in range(skip, len(rows), chunk_size):
+                        writer.write(rows[start:start + chunk_size])
+            else:
+                logging.info(" ft2_merge: merging %d unsorted or overlapping files", len(tables))
+                _sorted_merge(tables, writer, chunk_size)
+            n_rows = writer.n_rows
+    return n_rows
+
+
+def _edge_duplicates(tables, chunk_size):
+    '''
+    Number of leading rows to skip in each table for a block copy, or None if the
+    tables are not strictly increasing with overlaps made only of repeated edge rows.
+    '''
+    skips = [0]
+    for previous, rows in zip(tables, tables[1:]):
+        if not is_time_sorted(rows['START'], chunk_size, strict=True):
+            return None
+        tail = previous['START'][-min(len(previous), len(rows)):]
+        skip = int(np.searchsorted(rows['START'], previous['START'][-1], side='right'))
+        if skip and not np.array_equal(rows['START'][:skip], tail[len(tail) - skip:]):
+            return None
+        skips.append(skip)
+    if tables and not is_time_sorted(tables[0]['START'], chunk_size, strict=True):
+        return None
+    return skips
+
+
+def _sorted_merge(tables, writer, chunk_size):
+    n_total = sum(len(rows) for rows in tables)
+    starts = np.empty(n_total, dtype=np.float64)
+    sources = np.empty(n_total, dtype=np.int32)
+    indices = np.empty(n_total, dtype=np.int64)
+    offset = 0
+    for i, rows in enumerate(tables):
+        n_rows = len(rows)
+        run = np.argsort(rows['START'], kind='stable')
+        starts[offset:offset + n_rows] = rows['START'][run]
+        sources[offset:offset + n_rows] = i
+        indices[offset:offset + n_rows] = run
+        offset += n_rows
+    # A stable sort of the concatenated sorted runs merges them, keeping the input order on ties.
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    unique = np.ones(n_total, dtype=bool)
+    unique[1:] = starts[1:] != starts[:-1]
+    order = order[unique]
+    sources, indices = sources[order], indices[order]
+    logging.info(" ft2_merge: dropped %d duplicate rows", n_total - len(order))
+    for start in range(0, len(order), chunk_size):
+        chunk_sources = sources[start:start + chunk_size]
+        chunk_indices = indices[start:start + chunk_size]
+        rows = np.empty(len(chunk_sources), dtype=writer.dtype)
+        for i in np.unique(chunk_sources):
+            selected = chunk_sources == i
+            rows[selected] = tables[i][chunk_indices[selected]]
+        writer.write(rows)
@@ -0,0 +1,366 @@
+import os
+import re
+import time
+import uuid
+import logging
+import cProfile
+import resource
+import threading
+import functools
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from .config import METRICS_TRACES, PROFILE_DIR
+
+DURATION_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# Metrics exposed on /metrics: name -> (type, help).
+METRICS = {
+    'fermifilters_requests_total': ('counter', 'HTTP requests by endpoint and status code.'),
+    'fermifilters_request_duration_seconds': ('histogram', 'Wall time of the HTTP requests, until the response is returned.'),
+    'fermifilters_stage_runs_total': ('counter', 'Runs of the traced stages by status.'),
+    'fermifilters_stage_duration_seconds': ('histogram', 'Wall time of the traced stages.'),
+    'fermifilters_stage_cpu_seconds_total': ('counter', 'CPU time of the threads running the traced stages.'),
+    'fermifilters_stage_read_bytes_total': ('counter', 'Bytes read by the traced stages.'),
+    'fermifilters_stage_written_bytes_total': ('counter', 'Bytes written by the traced stages.'),
+    'fermifilters_stage_events_in_total': ('counter', 'Events read by the traced stages.'),
+    'fermifilters_stage_events_out_total': ('counter', 'Events kept by the traced stages.'),
+    'fermifilters_stage_max_rss_bytes': ('gauge', 'Peak resident set size of the process at the end of the last run of each stage.'),
+    'fermifilters_workspaces': ('gauge', 'User workspaces on disk, as of the last scan.'),
+    'fermifilters_workspace_bytes': ('gauge', 'Disk usage of the user workspaces, as of the last scan.'),
+    'fermifilters_workspace_evictions_total': ('counter', 'Workspaces evicted by the workspace manager.'),
+    'fermifilters_workspace_evicted_bytes_total': ('counter', 'Bytes freed by the workspace evictions.'),
+}
+
+
+class MetricsRegistry:
+    '''
+    Counters, gauges and histograms rendered in the Prometheus text exposition format.
+    '''
+
+    def __init__(self, metrics=METRICS):
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._values = {name: {} for name in metrics}
+
+    def inc(self, name, value=1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[name][key] = self._values[name].get(key, 0.0) + value
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[name][key] = float(value)
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histogram = self._values[name].get(key)
+            if histogram is None:
+                histogram = self._values[name][key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(histogram['buckets']):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def render(self) -> str:
+        '''
+        Returns all the metrics in the Prometheus text format (version 0.0.4).
+        '''
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in self.metrics.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(self._values[name].items()):
+                    if kind != 'histogram':
+                        lines.append(f"{name}{_labels(key)} {_number(value)}")
+                        continue
+                    for bound, count in zip(value['buckets'], value['counts']):
+                        lines.append(f"{name}_bucket{_labels(key + (('le', _number(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{_labels(key + (('le', '+Inf'),))} {value['count']}")
+                    lines.append(f"{name}_sum{_labels(key)} {_number(value['sum'])}")
+                    lines.append(f"{name}_count{_labels(key)} {value['count']}")
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(key) -> str:
+    if not key:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in key)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + '}'
+
+
+def _number(value) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+registry = MetricsRegistry()
+
+
+def _thread_io():
+    '''
+    Bytes read and written through system calls by the calling thread (Linux only, else 0).
+    '''
+    try:
+        with open('/proc/thread-self/io') as f:
+            fields = dict(line.split(':', 1) for line in f)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _max_rss() -> int:
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Span:
+    '''
+    Measurements of one run of a traced stage (see trace).
+
+    Wall time, CPU time and bytes read/written are measured on the thread running the
+    stage: work done by other threads or processes (parallel downloads, worker pools) is
+    only included in the wall time, unless the stage reports it with count(). Bytes are
+    those of read/write system calls: pages of memory-mapped files are not counted.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.status = 'running'
+        self.wall = None
+        self.cpu = None
+        self.read_bytes = 0
+        self.written_bytes = 0
+        self.max_rss = None
+        self.events_in = 0
+        self.events_out = 0
+        self.children = []
+        self._start = (time.perf_counter(), time.thread_time()) + _thread_io()
+
+    def count(self, events_in=0, events_out=0, read_bytes=0, written_bytes=0):
+        '''
+        Adds event counts, and bytes transferred outside the thread of the stage.
+        '''
+        self.events_in += int(events_in)
+        self.events_out += int(events_out)
+        self.read_bytes += int(read_bytes)
+        self.written_bytes += int(written_bytes)
+
+    def finish(self, status):
+        wall0, cpu0, read0, written0 = self._start
+        read1, written1 = _thread_io()
+        self.wall = time.perf_counter() - wall0
+        self.cpu = time.thread_time() - cpu0
+        self.read_bytes += max(read1 - read0, 0)
+        self.written_bytes += max(written1 - written0, 0)
+        self.max_rss = _max_rss()
+        self.status = status
+
+    def to_dict(self) -> dict:
+        return {'name': self.name, 'status': self.status, 'started': self.started, 'wall_seconds': self.wall,
+                'cpu_seconds': self.cpu, 'read_bytes': self.read_bytes, 'written_bytes': self.written_bytes,
+                'max_rss_bytes': self.max_rss, 'events_in': self.events_in, 'events_out': self.events_out,
+                'children': [child.to_dict() for child in list(self.children)]}
+
+
+class _NoSpan:
+    def count(self, *args, **kwargs):
+        pass
+
+
+class RequestTrace:
+    '''
+    Spans of a request, including those of the background jobs it submitted.
+    '''
+
+    def __init__(self, request_id, endpoint, profile=False):
+        self.request_id = request_id
+        # Names the profile dumps: never derived from the client-supplied request id.
+        self.trace_id = uuid.uuid4().hex
+        self.endpoint = endpoint
+        self.profile = profile
+        self.started = time.time()
+        self.status_code = None
+        self.spans = []
+        self.profiles = []
+        self._profiler = None
+        self._lock = threading.Lock()
+
+    def add(self, span, parent=None):
+        with self._lock:
+            (parent.children if parent is not None else self.spans).append(span)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans, profiles = list(self.spans), list(self.profiles)
+        return {'request_id': self.request_id, 'endpoint': self.endpoint, 'started': self.started,
+                'status_code': self.status_code, 'spans': [span.to_dict() for span in spans], 'profiles': profiles}
+
+
+_current_trace = contextvars.ContextVar('fermifilters_trace', default=None)
+_current_span = contextvars.ContextVar('fermifilters_span', default=None)
+_traces = OrderedDict()
+_traces_lock = threading.Lock()
+# Request ids accepted from clients; other ids are replaced by a new one.
+REQUEST_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def begin_request(endpoint, request_id=None, profile=False):
+    '''
+    Starts the trace of a request in the current context; the spans of the stages run
+    in this context, or in the jobs it submits (see jobs.JobManager.submit), are added to it.
+
+    Parameters:
+    ----------
+        endpoint: Name of the endpoint.
+        request_id: Optional id of the request (e.g. its X-Request-ID header). A new one
+            is generated if it is missing, malformed or already names a trace.
+        profile: If True, the request thread and its jobs are profiled (see profiled),
+            the request thread until end_request.
+
+    Returns:
+    -------
+        Token to pass to end_request.
+    '''
+    with _traces_lock:
+        if not request_id or not REQUEST_ID.match(request_id) or request_id in _traces:
+            request_id = uuid.uuid4().hex
+        trace = RequestTrace(request_id, endpoint, profile)
+        _traces[trace.request_id] = trace
+        while len(_traces) > METRICS_TRACES:
+            _traces.popitem(last=False)
+    if profile:
+        trace._profiler = _start_profiler()
+    return trace, _current_trace.set(trace), time.perf_counter()
+
+
+def end_request(token, status_code):
+    '''
+    Records the request metrics and leaves the trace of the request.
+
+    Returns:
+    -------
+        The RequestTrace.
+    '''
+    trace, context_token, start = token
+    trace.status_code = status_code
+    if trace._profiler is not None:
+        _dump_profile(trace, trace._profiler, 'request')
+        trace._profiler = None
+    registry.inc('fermifilters_requests_total', endpoint=trace.endpoint, code=status_code)
+    registry.observe('fermifilters_request_duration_seconds', time.perf_counter() - start, endpoint=trace.endpoint)
+    _current_trace.reset(context_token)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def current_span():
+    '''
+    Span of the innermost running stage, or an object ignoring count() outside of any stage.
+    '''
+    span = _current_span.get()
+    return span if span is not None else _NoSpan()
+
+
+def get_trace(request_id):
+    with _traces_lock:
+        trace = _traces.get(request_id)
+    return trace.to_dict() if trace is not None else None
+
+
+@contextmanager
+def trace(name):
+    '''
+    Runs a block as a traced stage: its measurements are added to the metrics of the
+    stage and to the trace of the current request, if any.
+
+    Yields:
+    ------
+        The Span, e.g. to report event counts with span.count().
+    '''
+    span = Span(name)
+    parent = _current_span.get()
+    request = _current_trace.get()
+    if request is not None:
+        request.add(span, parent)
+    token = _current_span.set(span)
+    status = 'failed'
+    try:
+        yield span
+        status = 'done'
+    finally:
+        _current_span.reset(token)
+        span.finish(status)
+        registry.inc('fermifilters_stage_runs_total', stage=name, status=status)
+        registry.observe('fermifilters_stage_duration_seconds', span.wall, stage=name)
+        registry.inc('fermifilters_stage_cpu_seconds_total', span.cpu, stage=name)
+        registry.inc('fermifilters_stage_read_bytes_total', span.read_bytes, stage=name)
+        registry.inc('fermifilters_stage_written_bytes_total', span.written_bytes, stage=name)
+        registry.inc('fermifilters_stage_events_in_total', span.events_in, stage=name)
+        registry.inc('fermifilters_stage_events_out_total', span.events_out, stage=name)
+        registry.set('fermifilters_stage_max_rss_bytes', span.max_rss, stage=name)
+
+
+def traced(name):
+    '''
+    Decorator running every call of a function as a traced stage (see trace).
+    '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with trace(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _start_profiler():
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Python 3.12+ allows a single active cProfile profiler per process.
+        logging.warning(" metrics: could not start the profiler: %s", e)
+        return None
+    return profiler
+
+
+def _dump_profile(request, profiler, name):
+    profiler.disable()
+    path = os.path.join(PROFILE_DIR, f"{request.trace_id}.{name}.prof")
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(path)
+    except OSError as e:
+        logging.warning(" metrics: could not write the profile %s: %s", path, e)
+        return
+    with request._lock:
+        request.profiles.append(path)
+    logging.info(" metrics: profile of %s written to %s", name, path)
+
+
+@contextmanager
+def profiled(name):
+    '''
+    Profiles a block with cProfile when the current request asked for it (see
+    begin_request), writing the statistics to PROFILE_DIR/<trace id>.<name>.prof,
+    to be read with pstats or snakeviz. Only the calling thread is profiled.
+    '''
+    request = _current_trace.get()
+    profiler = _start_profiler() if request is not None and request.profile else None
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            _dump_profile(request, profiler, name)
+
+
+def render() -> str:
+    return registry.render()
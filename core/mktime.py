@@ -0,0 +1,322 @@
+import os
+import re
+import ast
+import operator
+import threading
+from collections import OrderedDict
+from functools import lru_cache, reduce
+import numpy as np
+from .columnar import table_columns
+from .config import MKTIME_CACHE_SIZE
+from .fitsio import read_dss_keywords
+from .kernels import radec_to_unit_vectors, angular_separation
+
+# Two FT2 rows are merged in the same GTI when the gap between them is below this tolerance, in seconds.
+GTI_GAP_TOLERANCE = 1e-6
+
+_BOOL_OPERATORS = {ast.And: np.logical_and, ast.Or: np.logical_or}
+_UNARY_OPERATORS = {ast.Not: np.logical_not, ast.USub: operator.neg, ast.UAdd: operator.pos}
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+_COMPARE_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+
+def angsep(ra1, dec1, ra2, dec2):
+    '''
+    Angular separation in degrees, as the angsep() function of gtmktime filter expressions.
+    '''
+    return angular_separation(radec_to_unit_vectors(ra1, dec1), radec_to_unit_vectors(ra2, dec2))
+
+
+FUNCTIONS = {
+    'ABS': np.abs,
+    'SQRT': np.sqrt,
+    'SIN': lambda x: np.sin(np.radians(x)),
+    'COS': lambda x: np.cos(np.radians(x)),
+    'TAN': lambda x: np.tan(np.radians(x)),
+    'MIN': np.minimum,
+    'MAX': np.maximum,
+    'ANGSEP': angsep,
+}
+
+# CFITSIO-style operators, translated to their Python equivalents before parsing.
+_TRANSLATIONS = [
+    (re.compile(r'&&'), ' and '),
+    (re.compile(r'\|\|'), ' or '),
+    (re.compile(r'!(?!=)'), ' not '),
+    (re.compile(r'\.and\.', re.IGNORECASE), ' and '),
+    (re.compile(r'\.or\.', re.IGNORECASE), ' or '),
+    (re.compile(r'\.not\.', re.IGNORECASE), ' not '),
+    (re.compile(r'\.eq\.', re.IGNORECASE), '=='),
+    (re.compile(r'\.ne\.', re.IGNORECASE), '!='),
+    (re.compile(r'\.lt\.', re.IGNORECASE), '<'),
+    (re.compile(r'\.le\.', re.IGNORECASE), '<='),
+    (re.compile(r'\.gt\.', re.IGNORECASE), '>'),
+    (re.compile(r'\.ge\.', re.IGNORECASE), '>='),
+]
+
+
+class FilterExpression:
+    '''
+    A gtmktime filter expression (e.g. 'DATA_QUAL>0 && LAT_CONFIG==1') compiled into a
+    vectorized evaluator over FT2 columns.
+
+    The expression is parsed with the Python ast module and only a whitelist of nodes
+    is accepted: boolean, comparison and arithmetic operators, numeric constants
+    (evaluated as float64), column names and the functions in FUNCTIONS. Nothing is ever passed to eval().
+    '''
+
+    def __init__(self, expr):
+        self.expr = (expr or '').strip()
+        self.columns = set()
+        if self.expr:
+            python_expr = self.expr
+            for pattern, replacement in _TRANSLATIONS:
+                python_expr = pattern.sub(replacement, python_expr)
+            try:
+                tree = ast.parse(python_expr.strip(), mode='eval')
+            except SyntaxError as e:
+                raise ValueError(f"Invalid filter expression '{self.expr}': {e.msg}") from e
+            self.normalized = ast.dump(tree.body)
+            self._evaluator = self._compile(tree.body)
+        else:
+            self.normalized = ''
+            self._evaluator = None
+
+    def evaluate(self, columns, n_rows) -> np.ndarray:
+        '''
+        Evaluates the expression on the input columns.
+
+        Parameters:
+        ----------
+            columns: Mapping (or record array) from upper-case column names to arrays.
+            n_rows: Number of rows, used to broadcast constant expressions.
+
+        Returns:
+        -------
+            Boolean mask of the rows passing the expression.
+        '''
+        if self._evaluator is None:
+            return np.ones(n_rows, dtype=bool)
+        with np.errstate(over='ignore'):
+            result = self._evaluator(columns)
+        return np.broadcast_to(np.asarray(result, dtype=bool), (n_rows,)).copy()
+
+    def _compile(self, node):
+        if isinstance(node, ast.BoolOp):
+            op = _BOOL_OPERATORS[type(node.op)]
+            values = [self._compile(value) for value in node.values]
+            return lambda columns: reduce(op, [value(columns) for value in values])
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+            op = _UNARY_OPERATORS[type(node.op)]
+            operand = self._compile(node.operand)
+            return lambda columns: op(operand(columns))
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+            op = _BINARY_OPERATORS[type(node.op)]
+            left, right = self._compile(node.left), self._compile(node.right)
+            return lambda columns: op(left(columns), right(columns))
+        if isinstance(node, ast.Compare) and all(type(op) in _COMPARE_OPERATORS for op in node.ops):
+            ops = [_COMPARE_OPERATORS[type(op)] for op in node.ops]
+            operands = [self._compile(operand) for operand in [node.left] + node.comparators]
+            return lambda columns: self._compare_chain(ops, operands, columns)
+        if isinstance(node, ast.Name):
+            name = node.id.upper()
+            self.columns.add(name)
+            return lambda columns: columns[name]
+        if isinstance(node, ast.Constant) and isinstance(node.value, (bool, int, float)):
+            # Constants are float64, so that constant sub-expressions (e.g. 9**9**9**9)
+            # overflow to inf instead of being computed as Python integers.
+            try:
+                value = np.float64(node.value)
+            except OverflowError:
+                raise ValueError(f"Constant out of range in filter expression '{self.expr}'") from None
+            return lambda columns: value
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id.upper() in FUNCTIONS and not node.keywords:
+            function = FUNCTIONS[node.func.id.upper()]
+            args = [self._compile(arg) for arg in node.args]
+            return lambda columns: function(*[arg(columns) for arg in args])
+        raise ValueError(f"Unsupported element '{ast.unparse(node)}' in filter expression '{self.expr}'")
+
+    @staticmethod
+    def _compare_chain(ops, operands, columns):
+        values = [operand(columns) for operand in operands]
+        result = ops[0](values[0], values[1])
+        for op, left, right in zip(ops[1:], values[1:], values[2:]):
+            result = np.logical_and(result, op(left, right))
+        return result
+
+
+@lru_cache(maxsize=256)
+def parse_filter_expression(expr) -> FilterExpression:
+    '''
+    Parses and compiles a filter expression, caching the result.
+    '''
+    return FilterExpression(expr)
+
+
+def rows_to_gti(start, stop, mask):
+    '''
+    Merges the FT2 rows passing a mask into Good Time Intervals.
+
+    Runs of consecutive passing rows are merged into one interval as long as each row
+    starts where the previous one stops.
+
+    Returns:
+    -------
+        (gti_start, gti_stop) float64 arrays.
+    '''
+    start = np.asarray(start, dtype=np.float64)[mask]
+    stop = np.asarray(stop, dtype=np.float64)[mask]
+    if len(start) == 0:
+        return np.empty(0), np.empty(0)
+    breaks = np.flatnonzero(start[1:] - stop[:-1] > GTI_GAP_TOLERANCE) + 1
+    run_begin = np.concatenate(([0], breaks))
+    run_end = np.concatenate((breaks - 1, [len(start) - 1]))
+    return start[run_begin], stop[run_end]
+
+
+def merge_gtis(start, stop):
+    '''
+    Sorts intervals and merges the overlapping or touching ones.
+    '''
+    start = np.asarray(start, dtype=np.float64)
+    stop = np.asarray(stop, dtype=np.float64)
+    if len(start) == 0:
+        return start, stop
+    order = np.argsort(start, kind='stable')
+    start, stop = start[order], stop[order]
+    reach = np.maximum.accumulate(stop)
+    breaks = np.flatnonzero(start[1:] > reach[:-1] + GTI_GAP_TOLERANCE) + 1
+    run_begin = np.concatenate(([0], breaks))
+    run_end = np.concatenate((breaks - 1, [len(start) - 1]))
+    return start[run_begin], reach[run_end]
+
+
+def intersect_gtis(gti_a, gti_b):
+    '''
+    Intersection of two lists of sorted, disjoint intervals.
+
+    Parameters:
+    ----------
+        gti_a, gti_b: (start, stop) pairs of arrays.
+
+    Returns:
+    -------
+        (start, stop) arrays of the intersection.
+    '''
+    a_start, a_stop = (np.asarray(x, dtype=np.float64) for x in gti_a)
+    b_start, b_stop = (np.asarray(x, dtype=np.float64) for x in gti_b)
+    # Range [lo, hi) of the b intervals overlapping each a interval.
+    lo = np.searchsorted(b_stop, a_start, side='right')
+    hi = np.searchsorted(b_start, a_stop, side='left')
+    counts = np.maximum(hi - lo, 0)
+    ia = np.repeat(np.arange(len(a_start)), counts)
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    ib = np.arange(counts.sum()) - offsets + np.repeat(lo, counts)
+    start = np.maximum(a_start[ia], b_start[ib])
+    stop = np.minimum(a_stop[ia], b_stop[ib])
+    keep = stop > start
+    return start[keep], stop[keep]
+
+
+def gti_mask(times, gti) -> np.ndarray:
+    '''
+    Selects the times falling in a list of sorted, disjoint intervals (bounds included).
+    '''
+    gti_start, gti_stop = gti
+    times = np.asarray(times, dtype=np.float64)
+    if len(gti_start) == 0:
+        return np.zeros(len(times), dtype=bool)
+    idx = np.searchsorted(gti_start, times, side='right') - 1
+    valid = idx >= 0
+    idx = np.maximum(idx, 0)
+    return valid & (times <= gti_stop[idx])
+
+
+def time_mask(columns, gti, start=0, stop=None) -> np.ndarray:
+    '''
+    Row kernel selecting the events of a row range inside a GTI list.
+    '''
+    return gti_mask(columns['TIME'][start:stop], gti)
+
+
+def read_gti(gti_hdu):
+    '''
+    Returns the (start, stop) float64 arrays of a GTI extension.
+    '''
+    return (np.asarray(gti_hdu.data['START'], dtype=np.float64),
+            np.asarray(gti_hdu.data['STOP'], dtype=np.float64))
+
+
+def roi_from_header(header):
+    '''
+    Returns the (ra, dec, radius, zmax) of the ROI cut of gtmktime from the DSS keywords
+    of an FT1 header, or None if the file has no cone or no zenith-angle limit below 180 deg.
+    '''
+    cone = zmax = None
+    for keyword in read_dss_keywords(header):
+        match = re.match(r'^CIRCLE\(([^,]+),([^,]+),([^)]+)\)$', str(keyword['value']).replace(' ', ''))
+        if keyword['type'].startswith('POS(') and match:
+            cone = tuple(float(x) for x in match.groups())
+        elif keyword['type'] == 'ZENITH_ANGLE':
+            zmax = float(str(keyword['value']).split(':')[1])
+    if cone is None or zmax is None or zmax >= 180 or cone[2] >= 180:
+        return None
+    return cone + (zmax,)
+
+
+_gti_cache = OrderedDict()
+_gti_cache_lock = threading.Lock()
+
+
+def ft2_gti(ft2_file, filter_expr, roi=None):
+    '''
+    Computes the GTIs of an FT2 file for a filter expression and an optional ROI cut.
+
+    Results are cached per FT2 file (keyed on its path, size and modification time),
+    parsed expression and ROI, because users iterate many times on the same spacecraft file.
+
+    Parameters:
+    ----------
+        ft2_file: Input FT2 file.
+        filter_expr: gtmktime filter expression, possibly empty.
+        roi: Optional (ra, dec, radius, zmax) as returned by roi_from_header: the intervals
+            where the ROI is not entirely within zmax of the zenith are excluded.
+
+    Returns:
+    -------
+        (gti_start, gti_stop) float64 arrays.
+    '''
+    expression = parse_filter_expression(filter_expr or '')
+    stat = os.stat(ft2_file)
+    key = (os.path.abspath(ft2_file), stat.st_size, stat.st_mtime_ns, expression.normalized, roi)
+    with _gti_cache_lock:
+        if key in _gti_cache:
+            _gti_cache.move_to_end(key)
+            return _gti_cache[key]
+    with table_columns(ft2_file, 'SC_DATA', decoded=True) as sc_data:
+        n_rows = len(sc_data)
+        columns = {name: sc_data[name] for name in expression.columns}
+        mask = expression.evaluate(columns, n_rows)
+        if roi is not None:
+            ra, dec, radius, zmax = roi
+            mask &= angsep(sc_data['RA_ZENITH'], sc_data['DEC_ZENITH'], ra, dec) + radius <= zmax
+        gti = rows_to_gti(sc_data['START'], sc_data['STOP'], mask)
+    with _gti_cache_lock:
+        _gti_cache[key] = gti
+        while len(_gti_cache) > MKTIME_CACHE_SIZE:
+            _gti_cache.popitem(last=False)
+    return gti
@@ -0,0 +1,163 @@
+import os
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from .columnar import open_table, table_columns
+from .config import CHUNK_SIZE, PARALLEL_WORKERS
+from .kernels import raw_columns
+from .lazy import LazyModule
+
+fits = LazyModule('astropy.io.fits')
+
+# Tables kept open by each worker process, most recently used last.
+WORKER_TABLES = 8
+
+
+def row_chunks(n_rows, chunk_size=CHUNK_SIZE) -> list:
+    '''
+    Returns the (start, stop) bounds of the fixed-size row chunks of a table.
+    '''
+    return [(start, min(start + chunk_size, n_rows)) for start in range(0, n_rows, chunk_size)]
+
+
+_tables = OrderedDict()
+
+
+def _worker_columns(ft_file, extension):
+    '''
+    Columns of a table as the main process reads them (see columnar.read_columns),
+    opened once per worker process and kept open for the next chunks.
+    '''
+    stat = os.stat(ft_file)
+    key = (os.path.abspath(ft_file), extension, stat.st_size, stat.st_mtime_ns)
+    if key in _tables:
+        _tables.move_to_end(key)
+        return _tables[key][1]
+    table = open_table(ft_file, extension)
+    if table is not None:
+        entry = (None, table)
+    else:
+        hdul = fits.open(ft_file, memmap=True)
+        entry = (hdul, raw_columns(hdul[extension].data))
+    _tables[key] = entry
+    while len(_tables) > WORKER_TABLES:
+        hdul, _ = _tables.popitem(last=False)[1]
+        if hdul is not None:
+            hdul.close()
+    return entry[1]
+
+
+def _run_chunk(kernel, ft_file, extension, args, start, stop):
+    return kernel(_worker_columns(ft_file, extension), *args, start=start, stop=stop)
+
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers):
+    '''
+    Returns the process pool of the given size shared by the engines and plotters of the
+    process. Pools of different sizes coexist: engines configured with other worker counts
+    never shut down a pool that other requests are using.
+    '''
+    with _pool_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            # The server is multi-threaded: never fork it.
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            pool = _pools[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+        return pool
+
+
+def _reset_pool(pool=None):
+    '''
+    Shuts down a broken pool, so that the next call starts a new one, or all the pools.
+    '''
+    with _pool_lock:
+        for workers, current in list(_pools.items()):
+            if pool is None or current is pool:
+                current.shutdown(wait=False, cancel_futures=True)
+                del _pools[workers]
+
+
+def map_chunks(kernel, ft_file, extension, n_rows, *args, columns=None, chunk_size=CHUNK_SIZE,
+               workers=PARALLEL_WORKERS, progress=None) -> list:
+    '''
+    Evaluates a row kernel on the chunks of a table, in a process pool.
+
+    Every worker maps the input file itself (the columnar cache when it is valid, else
+    the FITS table, see columnar.read_columns), so only the kernel arguments and the
+    results cross process boundaries. Chunks are the same as in the serial path and the
+    results are returned in chunk order, so a reduction done in that order gives results
+    bit-identical to the serial one.
+
+    Parameters:
+    ----------
+        kernel: Module-level callable(columns, *args, start, stop).
+        ft_file: Input FITS file.
+        extension: Name or index of the table extension.
+        n_rows: Number of rows of the table.
+        columns: Optional columns of the table already open in this process, used
+            when the kernel runs serially.
+        chunk_size: Number of rows per chunk.
+        workers: Number of worker processes; with 1 worker, or a single chunk, the
+            chunks are evaluated in this process.
+        progress: Optional callable(fraction), called as chunks complete. An exception
+            raised by it cancels the pending chunks and is re-raised.
+
+    Returns:
+    -------
+        List of the kernel results, one per chunk.
+    '''
+    chunks = row_chunks(n_rows, chunk_size)
+    if workers <= 1 or len(chunks) <= 1:
+        if columns is None:
+            with table_columns(ft_file, extension) as columns:
+                return _serial(kernel, columns, chunks, args, progress)
+        return _serial(kernel, columns, chunks, args, progress)
+
+    pool = _get_pool(workers)
+    futures = {pool.submit(_run_chunk, kernel, ft_file, extension, args, start, stop): i
+               for i, (start, stop) in enumerate(chunks)}
+    results = [None] * len(chunks)
+    done = 0
+    try:
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            done += 1
+            if progress is not None:
+                progress(done / len(chunks))
+    except BrokenProcessPool:
+        logging.error(" parallel: worker pool broken, restarting it")
+        _reset_pool(pool)
+        raise
+    finally:
+        for future in futures:
+            future.cancel()
+    return results
+
+
+def _serial(kernel, columns, chunks, args, progress):
+    results = []
+    for i, (start, stop) in enumerate(chunks):
+        results.append(kernel(columns, *args, start=start, stop=stop))
+        if progress is not None:
+            progress((i + 1) / len(chunks))
+    return results
+
+
+def parallel_mask(kernel, ft_file, extension, n_rows, *args, **kwargs) -> np.ndarray:
+    '''
+    Boolean mask of all the rows of a table, evaluated by chunks (see map_chunks).
+    '''
+    masks = map_chunks(kernel, ft_file, extension, n_rows, *args, **kwargs)
+    return np.concatenate(masks) if masks else np.empty(0, dtype=bool)
+
+
+def shutdown():
+    _reset_pool()
@@ -0,0 +1,553 @@
+import os
+import csv
+import json
+import shutil
+import logging
+import tempfile
+import numpy as np
+from .columnar import read_columns, table_columns
+from .config import CHUNK_SIZE
+from .engine import FiltersEngine
+from .fitsio import clean_header, update_select_dss_keywords, write_ft1, make_gti_hdu
+from .kernels import select_params, selection_mask, SEPARATION_OPERATORS, SunTrack, sun_cut_mask, sun_separation
+from .lazy import LazyModule
+from .metrics import current_span, traced
+from .mktime import parse_filter_expression, ft2_gti, intersect_gtis, read_gti, roi_from_header, time_mask
+from .parallel import map_chunks, parallel_mask
+from .spatial import indexed_selection_mask
+
+fits = LazyModule('astropy.io.fits')
+
+
+class SelectStage:
+    '''
+    gtselect cuts, evaluated as an event mask.
+    '''
+    name = 'select'
+    fusable = True
+    uses_ft2 = False
+
+    def __init__(self, select_dict):
+        self.select_dict = select_dict
+        self.params = select_params(select_dict)
+        self._indexed = None
+
+    def cache_params(self) -> dict:
+        return self.params
+
+    def prepare(self, events_header, gti, ft2_file):
+        self._indexed = None
+
+    def indexed_mask(self, columns):
+        '''
+        Mask of all the events computed from the cone rows when the columns have a spatial
+        index (see spatial.indexed_selection_mask), None otherwise. Computed once per columns.
+        '''
+        if self._indexed is None or self._indexed[0] is not columns:
+            self._indexed = (columns, indexed_selection_mask(columns, self.params, len(columns)))
+        return self._indexed[1]
+
+    def mask(self, columns, start, stop) -> np.ndarray:
+        indexed = self.indexed_mask(columns)
+        if indexed is not None:
+            return indexed[start:stop]
+        return selection_mask(columns, self.params, start, stop)
+
+    def kernel(self):
+        return selection_mask, (self.params,)
+
+    def update_header(self, events_header):
+        update_select_dss_keywords(events_header, self.params)
+
+    def update_gti(self, gti):
+        return gti
+
+    def run(self, engine, ft1_file, ft2_file, output_file) -> bool:
+        return engine.gtselect(self.select_dict, ft1_file, output_file)
+
+
+class MktimeStage:
+    '''
+    gtmktime, evaluated as an event mask on the GTIs computed from the FT2 file.
+    '''
+    name = 'mktime'
+    fusable = True
+    uses_ft2 = True
+
+    def __init__(self, maketime_dict):
+        self.maketime_dict = maketime_dict
+        self.filter_expr = maketime_dict.get('filter_expr', '')
+        self.roicut = str(maketime_dict.get('roicut', False)).lower() in ('true', 'yes', 'on', '1')
+        # Parse now, so that an invalid expression is reported before any work is done.
+        self.expression = parse_filter_expression(self.filter_expr)
+        self.gti = None
+
+    def cache_params(self) -> dict:
+        return {'filter': self.expression.normalized, 'roicut': self.roicut}
+
+    def prepare(self, events_header, gti, ft2_file):
+        roi = roi_from_header(events_header) if self.roicut else None
+        self.gti = intersect_gtis(ft2_gti(ft2_file, self.filter_expr, roi), gti)
+
+    def mask(self, columns, start, stop) -> np.ndarray:
+        return time_mask(columns, self.gti, start, stop)
+
+    def kernel(self):
+        return time_mask, (self.gti,)
+
+    def update_header(self, events_header):
+        pass
+
+    def update_gti(self, gti):
+        return self.gti
+
+    def run(self, engine, ft1_file, ft2_file, output_file) -> bool:
+        return engine.gtmktime(self.maketime_dict, ft1_file, ft2_file, output_file)
+
+
+class EclipticCutStage:
+    '''
+    Sun-avoidance cut, evaluated as an event mask.
+
+    Unlike FiltersEngine.ecliptic_cut, the follow-up cone selection around the mean
+    Sun position (which only writes an extra select_ file) is not run.
+    '''
+    name = 'ecliptic_cut'
+    fusable = True
+    uses_ft2 = True
+
+    def __init__(self, ecliptic_cut_dict):
+        self.ecliptic_cut_dict = ecliptic_cut_dict
+        self.radius = float(ecliptic_cut_dict.get('eclipticradius', 0))
+        self.operator = ecliptic_cut_dict.get('eclipticoperator', 'gt')
+        if self.operator not in SEPARATION_OPERATORS:
+            raise ValueError(f"Unknown ecliptic cut operator '{self.operator}'")
+        self.sun_track = None
+
+    def cache_params(self) -> dict:
+        return {'radius': self.radius, 'operator': self.operator}
+
+    def prepare(self, events_header, gti, ft2_file):
+        if self.sun_track is None:
+            with table_columns(ft2_file, 'SC_DATA', decoded=True) as sc_data:
+                self.sun_track = SunTrack.from_ft2(sc_data)
+
+    def mask(self, columns, start, stop) -> np.ndarray:
+        return sun_cut_mask(columns, self.sun_track, self.radius, self.operator, start, stop)
+
+    def kernel(self):
+        return sun_cut_mask, (self.sun_track, self.radius, self.operator)
+
+    def update_header(self, events_header):
+        pass
+
+    def update_gti(self, gti):
+        return gti
+
+    def run(self, engine, ft1_file, ft2_file, output_file) -> bool:
+        return engine.ecliptic_cut(self.ecliptic_cut_dict, ft1_file, ft2_file, output_file)
+
+
+def stage_masks(columns, kernels, start=0, stop=None) -> np.ndarray:
+    '''
+    Row kernel evaluating the (function, args) kernels of several stages on a row range.
+    Returns their individual masks, stacked; a None kernel keeps every row.
+    '''
+    stop = len(columns) if stop is None else stop
+    masks = np.ones((len(kernels), stop - start), dtype=bool)
+    for i, kernel in enumerate(kernels):
+        if kernel is not None:
+            function, args = kernel
+            masks[i] = function(columns, *args, start=start, stop=stop)
+    return masks
+
+
+class FilterPipeline:
+    '''
+    Runs the /apply_filters stages (gtselect, gtmktime, ecliptic cut) in a single pass.
+
+    Consecutive fusable stages are compiled into one cumulative boolean event mask,
+    evaluated chunk by chunk over the FT1 columns (see columnar.read_columns), and only the output
+    of the last stage is written (plus, on request, the output of every stage, computed
+    from the same pass). Stages that cannot be expressed as an event mask (fusable=False),
+    or all of them when the engine uses the gtapps backend, are run one by one through
+    the FiltersEngine on the file written by the stages before them.
+
+    With a StageCache, the stages whose output is cached for the same input and parameters
+    are not run: the pipeline restarts from the last cached stage. To make later reruns
+    cheap, every stage output is stored in the cache, including the intermediate ones
+    that were not requested.
+
+    With an engine running on several workers, the stage masks of the fused pass are
+    evaluated by chunks in its process pool (see parallel.map_chunks) and combined in the
+    same order as in the serial pass, so the outputs are identical.
+    '''
+
+    def __init__(self, engine=None, chunk_size=CHUNK_SIZE, cache=None):
+        self.engine = engine if engine is not None else FiltersEngine(chunk_size=chunk_size)
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self.failed_stage = None
+
+    @staticmethod
+    def build_stages(select_dict=None, maketime_dict=None, ecliptic_cut_dict=None) -> list:
+        '''
+        Returns the stages to run, in the /apply_filters order, skipping the empty ones.
+        '''
+        stages = []
+        if select_dict:
+            stages.append(SelectStage(select_dict))
+        if maketime_dict:
+            stages.append(MktimeStage(maketime_dict))
+        if ecliptic_cut_dict:
+            stages.append(EclipticCutStage(ecliptic_cut_dict))
+        return stages
+
+    @staticmethod
+    def output_path(output_dir, stage_name, ft1_filename):
+        return os.path.join(output_dir, f"{stage_name}_{ft1_filename}")
+
+    @staticmethod
+    def sweep_path(output_dir, index, ft1_filename):
+        return os.path.join(output_dir, f"sweep_{index:02d}_{ft1_filename}")
+
+    @staticmethod
+    def sweep_summary_path(output_dir, ft1_filename):
+        return os.path.join(output_dir, f"sweep_summary_{os.path.splitext(ft1_filename)[0]}.csv")
+
+    @traced('pipeline.run')
+    def run(self, stages, ft1_file, ft2_file, output_dir, keep_intermediate=False, ft1_filename=None, progress_callback=None):
+        '''
+        Runs the stages on the input FT1 file.
+
+        Parameters:
+        ----------
+            stages: List of stages, as returned by build_stages.
+            ft1_file: Input FT1 file.
+            ft2_file: Input FT2 file.
+            output_dir: Directory of the outputs, named '<stage>_<ft1_filename>'.
+            keep_intermediate: If True, the output of every stage is written.
+            ft1_filename: Base name of the outputs, defaults to the name of ft1_file.
+            progress_callback: Optional callable(stage_name, fraction), called as the stages
+                advance. An exception raised by the callback makes the running stage fail.
+
+        Returns:
+        -------
+            Dictionary mapping the name of each stage with a written output to its path
+            (in stage order), or None if a stage failed; failed_stage then holds its name.
+        '''
+        self.failed_stage = None
+        ft1_filename = ft1_filename or os.path.basename(ft1_file)
+        paths = [self.output_path(output_dir, stage.name, ft1_filename) for stage in stages]
+        requested = [keep_intermediate or i == len(stages) - 1 for i in range(len(stages))]
+        keys = self._stage_keys(stages, ft1_file, ft2_file) if self.cache is not None else None
+        outputs = {}
+        input_file = ft1_file
+        first = 0
+        for i in range(self._cached_stages(keys, requested) if keys else 0):
+            if requested[i]:
+                if not self.cache.get(keys[i], paths[i]):
+                    break
+                outputs[stages[i].name] = paths[i]
+            input_file = paths[i] if requested[i] else self.cache.path(keys[i])
+            first = i + 1
+            if progress_callback is not None:
+                progress_callback(stages[i].name, 1.0)
+        if first:
+            logging.info(" pipeline: reusing the cached output of [%s]", ', '.join(stage.name for stage in stages[:first]))
+
+        index = first
+        for segment in self._segments(stages[first:]):
+            indices = range(index, index + len(segment))
+            index += len(segment)
+            if self._fusable(segment[0]):
+                written = [paths[i] if requested[i] else self.cache.staging_path(keys[i]) if keys else None for i in indices]
+                for path in written:
+                    self._discard(path)
+                if not self._run_fused(segment, input_file, ft2_file, written, progress_callback):
+                    return None
+            else:
+                stage = segment[0]
+                written = [paths[indices[0]]]
+                self._discard(written[0])
+                try:
+                    if progress_callback is not None:
+                        progress_callback(stage.name, 0.0)
+                    succeeded = stage.run(self.engine, input_file, ft2_file, written[0])
+                except Exception as e:
+                    logging.error("Error during %s: %s", stage.name, e)
+                    succeeded = False
+                if not succeeded:
+                    self.failed_stage = stage.name
+                    return None
+                if progress_callback is not None:
+                    progress_callback(stage.name, 1.0)
+            input_file = written[-1]
+            for i, path in zip(indices, written):
+                if path is None:
+                    continue
+                if keys:
+                    self.cache.put(keys[i], path)
+                    if path == input_file and not requested[i]:
+                        input_file = self.cache.path(keys[i])
+                if path == paths[i]:
+                    outputs[stages[i].name] = path
+        return outputs
+
+    def _stage_keys(self, stages, ft1_file, ft2_file) -> list:
+        key = self.cache.input_key(ft1_file)
+        ft2_key = self.cache.input_key(ft2_file) if any(stage.uses_ft2 for stage in stages) else None
+        keys = []
+        for stage in stages:
+            key = self.cache.stage_key(key, stage.name, stage.cache_params(), ft2_key if stage.uses_ft2 else None, self.engine.backend)
+            keys.append(key)
+        return keys
+
+    def _cached_stages(self, keys, requested) -> int:
+        '''
+        Number of leading stages that can be served from the cache: up to the last cached
+        stage, provided that the output of every requested stage before it is cached too.
+        '''
+        first = 0
+        for i, key in enumerate(keys):
+            if key in self.cache:
+                first = i + 1
+            elif requested[i]:
+                break
+        return first
+
+    @staticmethod
+    def _discard(path):
+        # Outputs may be hard links to cache entries: never overwrite them in place.
+        if path is not None and os.path.lexists(path):
+            os.remove(path)
+
+    def _fusable(self, stage) -> bool:
+        return stage.fusable and self.engine.backend == 'native'
+
+    def _segments(self, stages) -> list:
+        segments = []
+        for stage in stages:
+            if self._fusable(stage) and segments and self._fusable(segments[-1][-1]):
+                segments[-1].append(stage)
+            else:
+                segments.append([stage])
+        return segments
+
+    @traced('pipeline.fused')
+    def _run_fused(self, stages, ft1_file, ft2_file, output_files, progress_callback=None) -> bool:
+        names = ', '.join(stage.name for stage in stages)
+        logging.info(" pipeline: fused pass of [%s] on %s", names, ft1_file)
+        stage = stages[0]
+        try:
+            with fits.open(ft1_file, memmap=True) as hdul:
+                columns = read_columns(ft1_file, hdul['EVENTS'])
+                n_events = len(columns)
+                events_header = clean_header(hdul['EVENTS'].header)
+                gti = read_gti(hdul['GTI'])
+                headers, gtis = [], []
+                for stage in stages:
+                    stage.prepare(events_header, gti, ft2_file)
+                    stage.update_header(events_header)
+                    gti = stage.update_gti(gti)
+                    headers.append(events_header.copy())
+                    gtis.append(gti)
+                masks = np.empty((len(stages), n_events), dtype=bool)
+                if self.engine.workers > 1:
+                    self._parallel_masks(stages, ft1_file, columns, masks, progress_callback)
+                else:
+                    for start in range(0, n_events, self.chunk_size):
+                        stop = min(start + self.chunk_size, n_events)
+                        mask = np.ones(stop - start, dtype=bool)
+                        for i, stage in enumerate(stages):
+                            mask &= stage.mask(columns, start, stop)
+                            masks[i, start:stop] = mask
+                        if progress_callback is not None:
+                            for stage in stages:
+                                progress_callback(stage.name, stop / n_events)
+                for i, stage in enumerate(stages):
+                    if output_files[i] is not None:
+                        write_ft1(output_files[i], hdul, masks[i], headers[i], make_gti_hdu(gtis[i][0], gtis[i][1], hdul['GTI'].header))
+                        logging.info(" pipeline: %s kept %d of %d events -> %s", stage.name, np.count_nonzero(masks[i]), n_events, output_files[i])
+                current_span().count(events_in=n_events, events_out=np.count_nonzero(masks[-1]))
+        except Exception as e:
+            logging.error("Error during %s: %s", stage.name, e)
+            self.failed_stage = stage.name
+            return False
+        return True
+
+    def _parallel_masks(self, stages, ft1_file, columns, masks, progress_callback=None):
+        '''
+        Fills the cumulative stage masks of a fused pass from the engine process pool.
+        Masks computed from a spatial index are computed here and not sent to the workers.
+        '''
+        indexed = [stage.indexed_mask(columns) if hasattr(stage, 'indexed_mask') else None for stage in stages]
+        kernels = [stage.kernel() if mask is None else None for stage, mask in zip(stages, indexed)]
+        progress = None
+        if progress_callback is not None:
+            def progress(fraction):
+                for stage in stages:
+                    progress_callback(stage.name, fraction)
+        start = 0
+        for chunk in map_chunks(stage_masks, ft1_file, 'EVENTS', masks.shape[1], kernels, columns=columns,
+                                chunk_size=self.chunk_size, workers=self.engine.workers, progress=progress):
+            masks[:, start:start + chunk.shape[1]] = chunk
+            start += chunk.shape[1]
+        for i, mask in enumerate(indexed):
+            if mask is not None:
+                masks[i] = mask
+            if i:
+                masks[i] &= masks[i - 1]
+
+    @traced('pipeline.sweep')
+    def run_sweep(self, variants, ft1_file, ft2_file, output_dir, ft1_filename=None, progress_callback=None):
+        '''
+        Runs several combinations of the filter stages on the same input and writes the
+        final output of each one, named 'sweep_<index>_<ft1_filename>'.
+
+        The FT1 columns are opened once and the sub-results shared by the variants are
+        computed once: the mask of every distinct chain of stages (so variants differing
+        only in their last stage share the masks of the stages before it), the GTIs (see
+        mktime.ft2_gti) and the Sun separation of every event, from which each ecliptic
+        cut is a single comparison. With the gtapps backend the variants are run one by
+        one through run().
+
+        Parameters:
+        ----------
+            variants: List of dictionaries with optional 'select_dict', 'maketime_dict',
+                'ecliptic_cut_dict' and 'name' keys.
+            ft1_file: Input FT1 file.
+            ft2_file: Input FT2 file.
+            output_dir: Directory of the outputs and of the CSV summary (see sweep_summary_path).
+            ft1_filename: Base name of the outputs, defaults to the name of ft1_file.
+            progress_callback: Optional callable('sweep', fraction), called after each variant.
+
+        Returns:
+        -------
+            Summary table: one dictionary per variant with 'variant', 'name', 'output',
+            'n_events', 'n_selected', 'fraction' and the number of events left after each
+            of its stages ('counts'), or None if a variant failed (failed_stage then holds
+            the name of the failed stage).
+
+        Raises:
+        ------
+            ValueError if a variant has invalid parameters (nothing is run then).
+        '''
+        self.failed_stage = None
+        ft1_filename = ft1_filename or os.path.basename(ft1_file)
+        plans = [self.build_stages(variant.get('select_dict'), variant.get('maketime_dict'), variant.get('ecliptic_cut_dict'))
+                 for variant in variants]
+        if self.engine.backend == 'native':
+            summary = self._sweep_fused(variants, plans, ft1_file, ft2_file, output_dir, ft1_filename, progress_callback)
+        else:
+            summary = self._sweep_stages(variants, plans, ft1_file, ft2_file, output_dir, ft1_filename, progress_callback)
+        if summary is not None:
+            self._write_summary(summary, self.sweep_summary_path(output_dir, ft1_filename))
+        return summary
+
+    def _sweep_fused(self, variants, plans, ft1_file, ft2_file, output_dir, ft1_filename, progress_callback=None):
+        logging.info(" pipeline: sweep of %d variants on %s", len(variants), ft1_file)
+        summary = []
+        stage = None
+        try:
+            with fits.open(ft1_file, memmap=True) as hdul:
+                columns = read_columns(ft1_file, hdul['EVENTS'])
+                n_events = len(columns)
+                masks, shared = {}, {}
+                for index, (variant, stages) in enumerate(zip(variants, plans)):
+                    events_header = clean_header(hdul['EVENTS'].header)
+                    gti = read_gti(hdul['GTI'])
+                    mask = np.ones(n_events, dtype=bool)
+                    chain = ()
+                    counts = {}
+                    for stage in stages:
+                        if isinstance(stage, EclipticCutStage):
+                            stage.sun_track = shared.get('sun_track')
+                        stage.prepare(events_header, gti, ft2_file)
+                        stage.update_header(events_header)
+                        gti = stage.update_gti(gti)
+                        chain += ((stage.name, json.dumps(stage.cache_params(), sort_keys=True, default=str)),)
+                        if chain not in masks:
+                            masks[chain] = mask & self._sweep_mask(stage, ft1_file, columns, shared)
+                        mask = masks[chain]
+                        counts[stage.name] = int(np.count_nonzero(mask))
+                    stage = None
+                    output_file = self.sweep_path(output_dir, index, ft1_filename)
+                    write_ft1(output_file, hdul, mask, events_header, make_gti_hdu(gti[0], gti[1], hdul['GTI'].header))
+                    summary.append(self._summary_row(index, variant, output_file, n_events, int(np.count_nonzero(mask)), counts))
+                    logging.info(" pipeline: sweep variant %d kept %d of %d events -> %s", index, summary[-1]['n_selected'], n_events, output_file)
+                    if progress_callback is not None:
+                        progress_callback('sweep', (index + 1) / len(variants))
+        except Exception as e:
+            logging.error("Error during %s: %s", stage.name if stage is not None else 'sweep', e)
+            self.failed_stage = stage.name if stage is not None else 'sweep'
+            return None
+        return summary
+
+    def _sweep_mask(self, stage, ft1_file, columns, shared) -> np.ndarray:
+        '''
+        Mask of all the events for one stage of a sweep, reusing the shared sub-results.
+        '''
+        if isinstance(stage, EclipticCutStage):
+            shared['sun_track'] = stage.sun_track
+            if 'sun_separation' not in shared:
+                shared['sun_separation'] = np.concatenate(map_chunks(
+                    sun_separation, ft1_file, 'EVENTS', len(columns), stage.sun_track, columns=columns,
+                    chunk_size=self.chunk_size, workers=self.engine.workers) or [np.empty(0)])
+            return SEPARATION_OPERATORS[stage.operator](shared['sun_separation'], stage.radius)
+        indexed = stage.indexed_mask(columns) if hasattr(stage, 'indexed_mask') else None
+        if indexed is not None:
+            return indexed
+        function, args = stage.kernel()
+        return parallel_mask(function, ft1_file, 'EVENTS', len(columns), *args, columns=columns,
+                             chunk_size=self.chunk_size, workers=self.engine.workers)
+
+    def _sweep_stages(self, variants, plans, ft1_file, ft2_file, output_dir, ft1_filename, progress_callback=None):
+        summary = []
+        with fits.open(ft1_file, memmap=True) as hdul:
+            n_events = int(hdul['EVENTS'].header['NAXIS2'])
+        for index, (variant, stages) in enumerate(zip(variants, plans)):
+            output_file = self.sweep_path(output_dir, index, ft1_filename)
+            work_dir = tempfile.mkdtemp(prefix='sweep_', dir=output_dir)
+            try:
+                outputs = self.run(stages, ft1_file, ft2_file, work_dir, keep_intermediate=True, ft1_filename=ft1_filename)
+                if outputs is None:
+                    return None
+                counts = {}
+                for name, path in outputs.items():
+                    with fits.open(path) as hdul:
+                        counts[name] = int(hdul['EVENTS'].header['NAXIS2'])
+                if outputs:
+                    os.replace(list(outputs.values())[-1], output_file)
+                else:
+                    shutil.copyfile(ft1_file, output_file)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            n_selected = counts[stages[-1].name] if stages else n_events
+            summary.append(self._summary_row(index, variant, output_file, n_events, n_selected, counts))
+            if progress_callback is not None:
+                progress_callback('sweep', (index + 1) / len(variants))
+        return summary
+
+    @staticmethod
+    def _summary_row(index, variant, output_file, n_events, n_selected, counts) -> dict:
+        return {
+            'variant': index,
+            'name': variant.get('name') or f"variant {index}",
+            'output': output_file,
+            'n_events': n_events,
+            'n_selected': n_selected,
+            'fraction': n_selected / n_events if n_events else 0.0,
+            'counts': counts,
+        }
+
+    @staticmethod
+    def _write_summary(summary, summary_file):
+        stage_names = ('select', 'mktime', 'ecliptic_cut')
+        with open(summary_file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['variant', 'name', 'n_events'] + [f"n_{name}" for name in stage_names] + ['n_selected', 'fraction', 'output'])
+            for row in summary:
+                writer.writerow([row['variant'], row['name'], row['n_events']]
+                                + [row['counts'].get(name, '') for name in stage_names]
+                                + [row['n_selected'], f"{row['fraction']:.6g}", os.path.basename(row['output'])])
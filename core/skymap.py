@@ -0,0 +1,151 @@
+import os
+import base64
+import logging
+import numpy as np
+from .columnar import table_columns
+from .config import CHUNK_SIZE, HEALPIX_NSIDE, PARALLEL_WORKERS, SKYMAP_PREVIEW_NSIDE
+from .lazy import lazy_module
+from .parallel import map_chunks
+from .workspace import atomic_output
+
+hp = lazy_module('healpy')
+
+AXIS_LABELS = {
+    'G': ('Galactic Longitude [deg]', 'Galactic Latitude [deg]'),
+    'C': ('RA [deg]', 'DEC [deg]'),
+}
+
+
+def count_map_path(ft_file, x='RA', y='DEC', nside=HEALPIX_NSIDE) -> str:
+    '''
+    Path of the cached count map of a FITS file, stored next to it.
+    '''
+    return f"{ft_file}.{x}_{y}.hpx{nside}.npy"
+
+
+def count_map_chunk(columns, x, y, nside, start=0, stop=None) -> np.ndarray:
+    '''
+    Row kernel binning the events of a row range into a HEALPix (RING) count map.
+    '''
+    lon = np.asarray(columns[x][start:stop], dtype=np.float64)
+    lat = np.asarray(columns[y][start:stop], dtype=np.float64)
+    finite = np.isfinite(lon) & np.isfinite(lat)
+    pixels = hp.ang2pix(nside, lon[finite], lat[finite], lonlat=True)
+    return np.bincount(pixels, minlength=hp.nside2npix(nside))
+
+
+def build_count_map(ft_file, x='RA', y='DEC', nside=HEALPIX_NSIDE, chunk_size=CHUNK_SIZE, workers=PARALLEL_WORKERS) -> np.ndarray:
+    '''
+    Bins the events of a FITS file into a HEALPix (RING) count map in the frame of
+    the x/y columns, reading the columns chunk by chunk (see columnar.table_columns).
+    With several workers the chunks are binned in a process pool (see parallel.map_chunks)
+    and the partial maps summed.
+
+    Parameters:
+    ----------
+        ft_file: Input FITS file, events in the first extension.
+        x, y: Longitude and latitude columns in degrees (e.g. 'RA' and 'DEC').
+        nside: HEALPix resolution.
+        chunk_size: Number of events binned at once.
+        workers: Number of worker processes.
+
+    Returns:
+    -------
+        int64 array of 12 * nside**2 counts.
+    '''
+    counts = np.zeros(hp.nside2npix(nside), dtype=np.int64)
+    with table_columns(ft_file, 1) as columns:
+        for partial in map_chunks(count_map_chunk, ft_file, 1, len(columns), x, y, nside,
+                                  columns=columns, chunk_size=chunk_size, workers=workers):
+            counts += partial
+    return counts
+
+
+def load_count_map(ft_file, x='RA', y='DEC', nside=HEALPIX_NSIDE, workers=PARALLEL_WORKERS) -> np.ndarray:
+    '''
+    Returns the count map of a FITS file, building and caching it next to the file
+    when there is no cached map or the file is newer than the cached map.
+    '''
+    cache_path = count_map_path(ft_file, x, y, nside)
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(ft_file):
+        return np.load(cache_path)
+    counts = build_count_map(ft_file, x, y, nside, workers=workers)
+    try:
+        with atomic_output(cache_path) as tmp_path:
+            # A file object, as np.save appends '.npy' to the names without it.
+            with open(tmp_path, 'wb') as f:
+                np.save(f, counts)
+    except OSError as e:
+        logging.warning(" skymap: could not cache the count map of %s: %s", ft_file, e)
+    return counts
+
+
+def render_grid(count_map, coord='C', n_lon=360, n_lat=180):
+    '''
+    Samples a celestial count map on a regular longitude/latitude grid of the display frame.
+
+    The frame change is applied by rotating the grid sample positions back to the
+    celestial frame, which is equivalent to rotating the map, so its cost does not
+    depend on the number of events.
+
+    Parameters:
+    ----------
+        count_map: HEALPix (RING) count map in celestial coordinates.
+        coord: Display frame, 'G' for galactic or 'C' for celestial.
+        n_lon, n_lat: Size of the grid.
+
+    Returns:
+    -------
+        (lon_edges, lat_edges, values): cell edges in radians, longitude in [-pi, pi],
+        and the (n_lon, n_lat) counts of the HEALPix pixel at each cell center.
+    '''
+    if coord not in AXIS_LABELS:
+        raise ValueError(f"Coordinate system '{coord}' non riconosciuto. Usa 'G' o 'C'.")
+    nside = hp.npix2nside(len(count_map))
+    lon_edges = np.linspace(-180, 180, n_lon + 1)
+    lat_edges = np.linspace(-90, 90, n_lat + 1)
+    lon, lat = np.meshgrid((lon_edges[:-1] + lon_edges[1:]) / 2, (lat_edges[:-1] + lat_edges[1:]) / 2, indexing='ij')
+    if coord == 'G':
+        lon, lat = hp.Rotator(coord=['G', 'C'])(lon.ravel(), lat.ravel(), lonlat=True)
+    values = count_map[hp.ang2pix(nside, lon.ravel(), lat.ravel(), lonlat=True)].reshape(n_lon, n_lat)
+    return np.radians(lon_edges), np.radians(lat_edges), values
+
+
+def map_levels(nside=HEALPIX_NSIDE, preview_nside=SKYMAP_PREVIEW_NSIDE) -> list:
+    '''
+    Resolutions served to the browser, from the preview to the full count map resolution.
+    '''
+    levels = [nside]
+    while levels[0] > max(preview_nside, 1):
+        levels.insert(0, levels[0] // 2)
+    return levels
+
+
+def nested_counts(count_map, nside) -> np.ndarray:
+    '''
+    Degrades a RING count map to a lower resolution, in NESTED order.
+
+    In NESTED order the 4 sub-pixels of every pixel are consecutive, so each halving of
+    nside sums groups of 4 counts exactly; every tile (base pixel) of the result is also
+    the contiguous range [tile * nside**2, (tile + 1) * nside**2).
+    '''
+    counts = hp.reorder(count_map, r2n=True).astype(np.int64)
+    while hp.npix2nside(len(counts)) > nside:
+        counts = counts.reshape(-1, 4).sum(axis=1)
+    return counts
+
+
+def encode_counts(counts):
+    '''
+    Encodes counts as base64 little-endian unsigned integers of the smallest size holding
+    them, the format decoded by static/skymap.js.
+
+    Returns:
+    -------
+        Tuple (dtype, data), dtype being 'uint8', 'uint16' or 'uint32'.
+    '''
+    counts = np.asarray(counts)
+    peak = int(counts.max()) if len(counts) else 0
+    dtype = next(t for t in (np.uint8, np.uint16, np.uint32) if peak <= np.iinfo(t).max)
+    data = counts.astype(np.dtype(dtype).newbyteorder('<')).tobytes()
+    return np.dtype(dtype).name, base64.b64encode(data).decode('ascii')
@@ -0,0 +1,142 @@
+import numpy as np
+from .config import CHUNK_SIZE
+from .kernels import cone_mask, selection_mask
+from .lazy import lazy_module
+
+hp = lazy_module('healpy')
+
+# Columns read by the non-spatial gtselect cuts.
+SELECT_COLUMNS = ('ENERGY', 'ZENITH_ANGLE', 'EVENT_CLASS', 'EVENT_TYPE')
+# Margin in radians keeping the interior pixels clear of rounding at the cone edge.
+EDGE_MARGIN = 1e-9
+
+
+def build_index(ra, dec, n_rows, rows_file, nside, chunk_size=CHUNK_SIZE) -> np.ndarray:
+    '''
+    Buckets the rows of a table by NESTED HEALPix pixel with a chunked counting sort.
+
+    Parameters:
+    ----------
+        ra, dec: Position columns in degrees (e.g. memory-mapped arrays).
+        n_rows: Number of rows.
+        rows_file: Path of the .npy file where the bucketed row numbers are written.
+        nside: HEALPix resolution of the index.
+        chunk_size: Number of rows binned at once.
+
+    Returns:
+    -------
+        int64 array of 12 * nside**2 + 1 offsets: the rows of pixel p are
+        rows[offsets[p]:offsets[p + 1]], in increasing (i.e. time) order.
+        Rows with non-finite positions are not indexed.
+    '''
+    npix = hp.nside2npix(nside)
+    counts = np.zeros(npix, dtype=np.int64)
+    for start in range(0, n_rows, chunk_size):
+        counts += np.bincount(_pixels(ra, dec, start, start + chunk_size, nside)[1], minlength=npix)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    rows_dtype = np.int32 if n_rows < 2 ** 31 else np.int64
+    rows = np.lib.format.open_memmap(rows_file, mode='w+', dtype=rows_dtype, shape=(int(offsets[-1]),))
+    cursor = offsets[:-1].copy()
+    for start in range(0, n_rows, chunk_size):
+        chunk_rows, pixels = _pixels(ra, dec, start, start + chunk_size, nside)
+        order = np.argsort(pixels, kind='stable')
+        pixels = pixels[order]
+        unique, first, n = np.unique(pixels, return_index=True, return_counts=True)
+        rank = np.arange(len(pixels)) - np.repeat(first, n)
+        rows[cursor[pixels] + rank] = chunk_rows[order]
+        cursor[unique] += n
+    rows.flush()
+    del rows
+    return offsets
+
+
+def _pixels(ra, dec, start, stop, nside):
+    lon = np.asarray(ra[start:stop], dtype=np.float64)
+    lat = np.asarray(dec[start:stop], dtype=np.float64)
+    finite = np.flatnonzero(np.isfinite(lon) & np.isfinite(lat))
+    return start + finite, hp.ang2pix(nside, lon[finite], lat[finite], nest=True, lonlat=True)
+
+
+def _gather(rows, offsets, pixels) -> np.ndarray:
+    '''
+    Concatenates the rows of a list of pixels.
+    '''
+    starts, stops = offsets[pixels], offsets[pixels + 1]
+    lengths = stops - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    ends = np.cumsum(lengths)
+    positions = np.arange(total) - np.repeat(ends - lengths, lengths) + np.repeat(starts, lengths)
+    return np.asarray(rows[positions], dtype=np.int64)
+
+
+class SpatialIndex:
+    '''
+    NESTED HEALPix index of the rows of an events table (see build_index).
+
+    Events are not reordered: the index maps every pixel to the sorted row numbers of its
+    events, so cone searches return rows in file (time) order and the outputs written
+    from them stay time-sorted.
+    '''
+
+    def __init__(self, nside, rows, offsets):
+        self.nside = nside
+        self.rows = rows
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    def cone_rows(self, columns, ra0, dec0, radius) -> np.ndarray:
+        '''
+        Rows within radius degrees (inclusive) from (ra0, dec0), as kernels.cone_mask selects them.
+
+        Only the pixels overlapping the cone are visited. The rows of the pixels lying
+        entirely inside the cone are taken as they are; only those of the pixels crossing
+        its edge are tested with cone_mask.
+
+        Returns:
+        -------
+            Sorted int64 array of row numbers.
+        '''
+        center = hp.ang2vec(ra0, dec0, lonlat=True)
+        radius_rad = np.radians(radius)
+        candidates = hp.query_disc(self.nside, center, radius_rad, inclusive=True, nest=True)
+        inner_radius = radius_rad - hp.max_pixrad(self.nside) - EDGE_MARGIN
+        if inner_radius > 0:
+            inner = hp.query_disc(self.nside, center, inner_radius, inclusive=False, nest=True)
+        else:
+            inner = np.empty(0, dtype=np.int64)
+        edge = np.setdiff1d(candidates, inner, assume_unique=True)
+        edge_rows = np.sort(_gather(self.rows, self.offsets, edge))
+        if len(edge_rows):
+            edge_rows = edge_rows[cone_mask(columns['RA'][edge_rows], columns['DEC'][edge_rows], ra0, dec0, radius)]
+        return np.sort(np.concatenate((_gather(self.rows, self.offsets, inner), edge_rows)))
+
+
+def indexed_selection_mask(columns, params, n_rows, chunk_size=CHUNK_SIZE):
+    '''
+    Evaluates the gtselect cuts (see kernels.selection_mask) through the spatial index of
+    the columns: the cone is searched first and the other cuts are evaluated only on the
+    rows inside it, so the work is proportional to the events in the ROI.
+
+    Parameters:
+    ----------
+        columns: Columns of the EVENTS table, with a spatial_index (see columnar.ColumnarTable).
+        params: Dictionary as returned by kernels.select_params.
+        n_rows: Number of events.
+        chunk_size: Number of cone rows evaluated at once.
+
+    Returns:
+    -------
+        Boolean mask of all the rows, or None when there is no index or no cone cut.
+    '''
+    index = getattr(columns, 'spatial_index', None)
+    if index is None or hp is None or params['rad'] is None or params['rad'] >= 180:
+        return None
+    rows = index.cone_rows(columns, params['ra'], params['dec'], params['rad'])
+    other_cuts = dict(params, rad=None)
+    mask = np.zeros(n_rows, dtype=bool)
+    for start in range(0, len(rows), chunk_size):
+        chunk_rows = rows[start:start + chunk_size]
+        gathered = {name: columns[name][chunk_rows] for name in SELECT_COLUMNS if name in columns}
+        mask[chunk_rows[selection_mask(gathered, other_cuts)]] = True
+    return mask
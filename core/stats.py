@@ -0,0 +1,284 @@
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+from .config import CHUNK_SIZE
+from .kernels import raw_columns, bitmask_values, select_params
+from .lazy import LazyModule, lazy_module
+from .workspace import atomic_output
+
+fits = LazyModule('astropy.io.fits')
+hp = lazy_module('healpy')
+
+STATS_VERSION = 1
+FINGERPRINT_BLOCK = 1024 * 1024
+# Binning of the coarse histograms: (scale, number of bins, fixed range or None for min/max).
+HISTOGRAMS = {
+    'ENERGY': ('log', 128, None),
+    'ZENITH_ANGLE': ('linear', 180, (0, 180)),
+    'TIME': ('linear', 256, None),
+    'START': ('linear', 256, None),
+    'ROCK_ANGLE': ('linear', 180, None),
+}
+# Columns with few distinct values, stored as exact value counts.
+DISCRETE_COLUMNS = ('EVENT_CLASS', 'EVENT_TYPE', 'DATA_QUAL', 'LAT_CONFIG', 'IN_SAA')
+MAX_DISCRETE_VALUES = 4096
+SKY_NSIDE = 16
+
+
+def stats_path(ft_file) -> str:
+    return f"{ft_file}.stats.json"
+
+
+def file_fingerprint(ft_file) -> str:
+    '''
+    Hash identifying the content of a FITS file: SHA-256 of its size and of its first and
+    last FINGERPRINT_BLOCK bytes, which hold the headers (NAXIS2, TSTART/TSTOP, DSS keywords),
+    the first and last rows and the GTI extension. Unlike a full hash, it costs two reads.
+    '''
+    size = os.path.getsize(ft_file)
+    digest = hashlib.sha256(str(size).encode())
+    with open(ft_file, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_BLOCK))
+        if size > FINGERPRINT_BLOCK:
+            f.seek(max(size - FINGERPRINT_BLOCK, FINGERPRINT_BLOCK))
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def build_stats(ft_file, chunk_size=CHUNK_SIZE) -> dict:
+    '''
+    Computes the statistics index of the first table extension of a FITS file.
+
+    Two chunked passes are made over the memory-mapped columns: the first collects the
+    min/max and the null count of every scalar numeric column and the value counts of the
+    discrete columns, the second the coarse histograms (see HISTOGRAMS), binned between the
+    min and max found by the first. For FT1 files a coarse HEALPix count map of the events
+    is stored too, when healpy is available.
+
+    Parameters:
+    ----------
+        ft_file: Input FT1 or FT2 file.
+        chunk_size: Number of rows read at once.
+
+    Returns:
+    -------
+        Dictionary with the keys 'version', 'key', 'extension', 'n_rows', 'columns'
+        (per column 'min', 'max', 'nulls', 'dtype', 'unit'), 'discrete' (per column the
+        lists of 'values' and 'counts'), 'histograms' (per column 'scale', 'edges', 'counts')
+        and 'sky' ('nside' and RING 'counts') or None.
+    '''
+    key = file_fingerprint(ft_file)
+    with fits.open(ft_file, memmap=True) as hdul:
+        table = hdul[1]
+        data = raw_columns(table.data)
+        n_rows = len(data)
+        scalars = [col for col in table.columns if col.dtype.shape == () and col.dtype.kind in 'biuf']
+        discrete = [col for col in table.columns if col.name in DISCRETE_COLUMNS]
+
+        extrema = {col.name: [np.inf, -np.inf, 0] for col in scalars}
+        value_counts = {col.name: {} for col in discrete}
+        for start in range(0, n_rows, chunk_size):
+            rows = slice(start, start + chunk_size)
+            for col in scalars:
+                values = data[col.name][rows]
+                valid = _valid(values, col.null)
+                found = extrema[col.name]
+                found[2] += len(values) - int(np.count_nonzero(valid))
+                if np.any(valid):
+                    values = values[valid]
+                    found[0] = min(found[0], values.min().item())
+                    found[1] = max(found[1], values.max().item())
+            for col in discrete:
+                counts = value_counts[col.name]
+                if counts is None:
+                    continue
+                values, n = np.unique(bitmask_values(data[col.name][rows]), return_counts=True)
+                for value, count in zip(values.tolist(), n.tolist()):
+                    counts[value] = counts.get(value, 0) + count
+                if len(counts) > MAX_DISCRETE_VALUES:
+                    logging.warning(" stats: %s has more than %d distinct values, not indexed", col.name, MAX_DISCRETE_VALUES)
+                    value_counts[col.name] = None
+
+        histograms = {}
+        for name, (scale, n_bins, fixed_range) in HISTOGRAMS.items():
+            if name not in extrema or extrema[name][0] > extrema[name][1]:
+                continue
+            low, high = fixed_range or extrema[name][:2]
+            if scale == 'log':
+                low = max(low, np.finfo(np.float32).tiny)
+                edges = np.logspace(np.log10(low), np.log10(max(high, low)), n_bins + 1)
+            else:
+                edges = np.linspace(low, high, n_bins + 1)
+            edges[-1] = np.nextafter(edges[-1], np.inf)
+            counts = np.zeros(n_bins, dtype=np.int64)
+            for start in range(0, n_rows, chunk_size):
+                values = data[name][start:start + chunk_size]
+                counts += np.histogram(values[_valid(values, None)], bins=edges)[0]
+            histograms[name] = {'scale': scale, 'edges': edges.tolist(), 'counts': counts.tolist()}
+
+        sky = None
+        if hp is not None and 'RA' in extrema and 'DEC' in extrema:
+            sky_counts = np.zeros(hp.nside2npix(SKY_NSIDE), dtype=np.int64)
+            for start in range(0, n_rows, chunk_size):
+                ra = np.asarray(data['RA'][start:start + chunk_size], dtype=np.float64)
+                dec = np.asarray(data['DEC'][start:start + chunk_size], dtype=np.float64)
+                valid = np.isfinite(ra) & np.isfinite(dec)
+                sky_counts += np.bincount(hp.ang2pix(SKY_NSIDE, ra[valid], dec[valid], lonlat=True), minlength=len(sky_counts))
+            sky = {'nside': SKY_NSIDE, 'counts': sky_counts.tolist()}
+
+        columns = {}
+        for col in scalars:
+            low, high, nulls = extrema[col.name]
+            columns[col.name] = {
+                'min': low if low <= high else None,
+                'max': high if low <= high else None,
+                'nulls': nulls,
+                'dtype': str(col.dtype),
+                'unit': col.unit,
+            }
+        return {
+            'version': STATS_VERSION,
+            'key': key,
+            'extension': table.name,
+            'n_rows': n_rows,
+            'columns': columns,
+            'discrete': {name: {'values': list(counts), 'counts': list(counts.values())}
+                         for name, counts in value_counts.items() if counts is not None},
+            'histograms': histograms,
+            'sky': sky,
+        }
+
+
+def _valid(values, null) -> np.ndarray:
+    if values.dtype.kind == 'f':
+        return np.isfinite(values)
+    if null is not None:
+        return values != null
+    return np.ones(len(values), dtype=bool)
+
+
+def update_stats(ft_file) -> dict:
+    '''
+    Builds the statistics index of a file and stores it in its sidecar file.
+    Called when a file is downloaded or written by a merge.
+    '''
+    stats = build_stats(ft_file)
+    try:
+        with atomic_output(stats_path(ft_file)) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump(stats, f)
+    except OSError as e:
+        logging.warning(" stats: could not save the index of %s: %s", ft_file, e)
+    return stats
+
+
+def load_stats(ft_file) -> dict:
+    '''
+    Returns the statistics index of a file from its sidecar, rebuilding it when
+    it is missing or its key does not match the current content of the file.
+    '''
+    try:
+        with open(stats_path(ft_file)) as f:
+            stats = json.load(f)
+        if stats.get('version') == STATS_VERSION and stats.get('key') == file_fingerprint(ft_file):
+            return stats
+    except (OSError, ValueError):
+        pass
+    logging.info(" stats: indexing %s", ft_file)
+    return update_stats(ft_file)
+
+
+def histogram_fraction(histogram, low, high) -> float:
+    '''
+    Estimated fraction of the histogrammed rows with low <= value <= high, interpolating
+    the cumulative counts within the bins (in log space for log-scaled histograms).
+    '''
+    edges = np.asarray(histogram['edges'], dtype=np.float64)
+    cumulative = np.concatenate(([0], np.cumsum(histogram['counts'])))
+    if cumulative[-1] == 0:
+        return 0.0
+    bounds = np.clip(np.array([low, high], dtype=np.float64), edges[0], edges[-1])
+    if histogram['scale'] == 'log':
+        edges, bounds = np.log10(edges), np.log10(bounds)
+    inside = np.diff(np.interp(bounds, edges, cumulative))[0]
+    return float(max(inside, 0) / cumulative[-1])
+
+
+def intervals_fraction(histogram, start, stop) -> float:
+    '''
+    Estimated fraction of the histogrammed rows inside the union of disjoint intervals.
+    '''
+    return float(sum(histogram_fraction(histogram, a, b) for a, b in zip(start, stop)))
+
+
+def bitmask_fraction(discrete, mask) -> float:
+    '''
+    Exact fraction of the rows of a bit-field column with any bit of mask set.
+    '''
+    values = np.asarray(discrete['values'], dtype=np.uint64)
+    counts = np.asarray(discrete['counts'], dtype=np.int64)
+    if counts.sum() == 0:
+        return 0.0
+    return float(counts[(values & np.uint64(mask)) != 0].sum() / counts.sum())
+
+
+def cone_fraction(sky, ra, dec, radius) -> float:
+    '''
+    Estimated fraction of the events within radius degrees from (ra, dec): the mean
+    density of the coarse HEALPix pixels overlapping the cone times the cone area.
+    '''
+    counts = np.asarray(sky['counts'], dtype=np.float64)
+    if radius >= 180 or counts.sum() == 0:
+        return 1.0
+    nside = sky['nside']
+    center = hp.ang2vec(ra, dec, lonlat=True)
+    pixels = hp.query_disc(nside, center, np.radians(radius), inclusive=True)
+    cone_area = 2 * np.pi * (1 - np.cos(np.radians(radius)))
+    density = counts[pixels].sum() / (len(pixels) * hp.nside2pixarea(nside))
+    return float(min(density * cone_area / counts.sum(), 1.0))
+
+
+def estimate_selection(ft1_stats, select_dict=None, gti=None) -> dict:
+    '''
+    Estimates the number of events of an FT1 file kept by a gtselect run and a GTI
+    selection, from its statistics index and without reading the events.
+
+    The cuts are assumed independent, so the estimate is the number of events times the
+    product of the fraction kept by each cut. The event class and type fractions are
+    exact; energy, zenith angle and time fractions come from the coarse histograms, the
+    cone fraction from the coarse sky map (the cone is not estimated without healpy).
+
+    Parameters:
+    ----------
+        ft1_stats: Statistics index of the FT1 file, see load_stats.
+        select_dict: Optional gtselect parameters, as accepted by kernels.select_params.
+        gti: Optional (start, stop) arrays of the good time intervals.
+
+    Returns:
+    -------
+        Dictionary with 'n_events', 'estimate' and the 'fractions' of each cut
+        (None for the cuts that could not be estimated).
+    '''
+    fractions = {}
+    if select_dict is not None:
+        params = select_params(select_dict)
+        histograms, discrete = ft1_stats['histograms'], ft1_stats['discrete']
+        fractions['energy'] = histogram_fraction(histograms['ENERGY'], params['emin'], params['emax']) if 'ENERGY' in histograms else None
+        fractions['zenith_angle'] = histogram_fraction(histograms['ZENITH_ANGLE'], params['zmin'], params['zmax']) if 'ZENITH_ANGLE' in histograms else None
+        if params['evclass']:
+            fractions['evclass'] = bitmask_fraction(discrete['EVENT_CLASS'], params['evclass']) if 'EVENT_CLASS' in discrete else None
+        if params['evtype'] and 'EVENT_TYPE' in discrete:
+            fractions['evtype'] = bitmask_fraction(discrete['EVENT_TYPE'], params['evtype'])
+        if params['rad'] is not None:
+            sky = ft1_stats.get('sky')
+            fractions['cone'] = cone_fraction(sky, params['ra'], params['dec'], params['rad']) if sky and hp is not None else None
+    if gti is not None:
+        fractions['gti'] = intervals_fraction(ft1_stats['histograms']['TIME'], gti[0], gti[1]) if 'TIME' in ft1_stats['histograms'] else None
+    n_events = ft1_stats['n_rows']
+    estimate = float(n_events)
+    for fraction in fractions.values():
+        if fraction is not None:
+            estimate *= fraction
+    return {'n_events': n_events, 'estimate': int(round(estimate)), 'fractions': fractions}
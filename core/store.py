@@ -0,0 +1,255 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from .columnar import update_columns
+from .config import STORE_DIR, STORE_BUDGET, COLUMNAR_CACHE
+from .stats import update_stats
+from .workspace import atomic_output
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request cloning a file (copy-on-write) on Btrfs, XFS and other reflink-capable filesystems.
+FICLONE = 0x40049409
+LAST_USED_FILE = '.last_used'
+# Lock files of the entries, outside the entries so that evicting an entry never unlinks
+# a lock file another request is waiting on. They are never removed.
+LOCK_DIR = '.locks'
+
+
+def clone_file(src, dst):
+    '''
+    Places a copy of src at dst, as cheaply as the filesystem allows: a reflink
+    (copy-on-write clone), else a hard link, else a plain copy.
+
+    Returns:
+    -------
+        'reflink', 'hardlink' or 'copy'.
+    '''
+    method = None
+    with atomic_output(dst) as tmp_path:
+        if fcntl is not None:
+            try:
+                with open(src, 'rb') as fsrc, open(tmp_path, 'wb') as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                method = 'reflink'
+            except OSError:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        if method is None:
+            try:
+                os.link(src, tmp_path)
+                method = 'hardlink'
+            except OSError:
+                shutil.copyfile(src, tmp_path)
+                method = 'copy'
+    return method
+
+
+class WeeklyFileStore:
+    '''
+    Content-addressed store of the raw weekly FT1/FT2 files, shared by all the workspaces.
+
+    Every file is stored once, in a directory named after the hash of its file name and
+    checksum (weekly files are immutable: a new version has a new name), together with
+    its statistics index (see stats.update_stats) and its columnar cache (see
+    columnar.update_columns). Workspaces receive a reflink, hard link or copy of the
+    stored file and of these sidecars. Concurrent requests for the same file are serialized
+    by a per-key lock (a thread lock plus an flock on a lock file of LOCK_DIR, across
+    processes), so that a file is downloaded only once and the other requests wait for it.
+    The locks and pins are per instance: the process should share one store
+    (see default_store).
+
+    When the store exceeds its budget, the least recently used entries are evicted, skipping
+    the pinned ones: those in use by this process (see pinned) and those still hard-linked
+    from a workspace, whose removal would not free any disk space.
+    '''
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, store_dir=STORE_DIR, budget=STORE_BUDGET):
+        self.store_dir = store_dir
+        self.budget = budget
+        os.makedirs(os.path.join(store_dir, LOCK_DIR), exist_ok=True)
+        self._locks = {}
+        self._pins = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(file_name, checksum=None) -> str:
+        return hashlib.sha256(f"{file_name}:{checksum or ''}".encode()).hexdigest()[:32]
+
+    def entry_dir(self, key) -> str:
+        return os.path.join(self.store_dir, key)
+
+    def object_path(self, key, file_name) -> str:
+        return os.path.join(self.entry_dir(key), file_name)
+
+    @contextmanager
+    def locked(self, key):
+        '''
+        Holds the lock of an entry, in this process and across processes.
+        '''
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            with open(os.path.join(self.store_dir, LOCK_DIR, f"{key}.lock"), 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    @contextmanager
+    def pinned(self, key):
+        '''
+        Protects an entry from eviction while in use.
+        '''
+        with self._lock:
+            self._pins[key] = self._pins.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins[key] -= 1
+                if not self._pins[key]:
+                    del self._pins[key]
+
+    def fetch(self, file_name, output_file, download, checksum=None) -> str:
+        '''
+        Places a weekly file at output_file, downloading it into the store first if needed.
+
+        Parameters:
+        ----------
+            file_name: Name of the weekly file.
+            output_file: Destination path in the workspace.
+            download: Callable(path) that downloads and verifies the file at path.
+            checksum: Optional checksum of the file, part of the store key.
+
+        Returns:
+        -------
+            output_file.
+        '''
+        key = self.key(file_name, checksum)
+        with self.pinned(key):
+            with self.locked(key):
+                # The entry may have been evicted while this request waited for its lock.
+                os.makedirs(self.entry_dir(key), exist_ok=True)
+                path = self.object_path(key, file_name)
+                if os.path.exists(path):
+                    self.logger.info(" store: %s found in the store", file_name)
+                else:
+                    download(path)
+                    try:
+                        update_stats(path)
+                    except Exception as e:
+                        self.logger.warning(" stats: could not index %s: %s", path, e)
+                    if COLUMNAR_CACHE:
+                        try:
+                            update_columns(path)
+                        except Exception as e:
+                            self.logger.warning(" columns: could not convert %s: %s", path, e)
+                self._touch(key)
+                self.checkout(path, output_file)
+            self.evict()
+        return output_file
+
+    def checkout(self, path, output_file):
+        '''
+        Places a stored file and its sidecar files (e.g. the statistics index) in a workspace.
+        '''
+        if not self._same_file(path, output_file):
+            method = clone_file(path, output_file)
+            self.logger.info(" store: %s -> %s (%s)", os.path.basename(path), output_file, method)
+        for file_name in os.listdir(os.path.dirname(path)):
+            sidecar = os.path.join(os.path.dirname(path), file_name)
+            if file_name.startswith(os.path.basename(path) + '.') and not file_name.endswith('.part'):
+                target = os.path.join(os.path.dirname(output_file), file_name)
+                if not self._same_file(sidecar, target):
+                    clone_file(sidecar, target)
+
+    @staticmethod
+    def _same_file(a, b) -> bool:
+        try:
+            return os.path.samefile(a, b)
+        except OSError:
+            return False
+
+    def _touch(self, key):
+        with open(os.path.join(self.entry_dir(key), LAST_USED_FILE), 'a'):
+            pass
+        os.utime(os.path.join(self.entry_dir(key), LAST_USED_FILE))
+
+    def _entry_usage(self, key):
+        '''
+        Returns (last_used, size, linked) of an entry; linked is True if any of its
+        files is hard-linked from elsewhere.
+        '''
+        entry_dir = self.entry_dir(key)
+        size, linked = 0, False
+        for file_name in os.listdir(entry_dir):
+            stat = os.stat(os.path.join(entry_dir, file_name))
+            size += stat.st_size
+            linked |= stat.st_nlink > 1 and file_name != LAST_USED_FILE
+        last_used_file = os.path.join(entry_dir, LAST_USED_FILE)
+        last_used = os.path.getmtime(last_used_file) if os.path.exists(last_used_file) else 0
+        return last_used, size, linked
+
+    def evict(self):
+        '''
+        Removes the least recently used unpinned entries until the store fits in its budget.
+        '''
+        entries = []
+        for key in os.listdir(self.store_dir):
+            if key.startswith('.'):
+                continue
+            try:
+                last_used, size, linked = self._entry_usage(key)
+            except OSError:
+                continue
+            entries.append((last_used, size, linked, key))
+        total = sum(size for _, size, _, _ in entries)
+        for last_used, size, linked, key in sorted(entries):
+            if total <= self.budget:
+                break
+            with self._lock:
+                in_use = key in self._pins
+            if linked or in_use:
+                continue
+            with self.locked(key):
+                # The entry may have been fetched again while waiting for its lock.
+                try:
+                    _, size, linked = self._entry_usage(key)
+                except OSError:
+                    continue
+                with self._lock:
+                    in_use = key in self._pins
+                if linked or in_use:
+                    continue
+                shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total -= size
+            self.logger.info(" store: evicted %s (%d bytes, unused for %.0f s)", key, size, time.time() - last_used)
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def default_store():
+    '''
+    Returns the WeeklyFileStore shared by the downloads of the process, or None if
+    STORE_DIR is empty.
+    '''
+    global _default_store
+    if not STORE_DIR:
+        return None
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = WeeklyFileStore()
+        return _default_store
@@ -0,0 +1,362 @@
+import os
+import numpy as np
+from astropy.io import fits
+
+# Mission elapsed time of the start of weekly file 9, the first week of science data.
+WEEK_9_START = 239557417.0
+WEEK_SECONDS = 604800.0
+FT2_STEP = 30.0
+ORBIT_PERIOD = 5760.0
+ORBIT_INCLINATION = 25.6
+ORBIT_RADIUS = 6.93e6
+ROCK_ANGLE = 50.0
+# Half-opening angle of the field of view around the spacecraft z axis.
+FOV_RADIUS = 70.0
+# Fraction of the orbits crossing the South Atlantic Anomaly, and range of the crossing times.
+SAA_FRACTION = 0.4
+SAA_DURATION = (600.0, 1800.0)
+# Spectral index and range in MeV of the event energies.
+SPECTRAL_INDEX = 2.4
+ENERGY_RANGE = (100.0, 1e6)
+# Fractions of the events from the Galactic plane and from the point sources below.
+PLANE_FRACTION = 0.3
+SOURCES_FRACTION = 0.1
+# (RA, DEC) in degrees of bright point sources: Vela, Geminga, Crab, 3C 454.3.
+POINT_SOURCES = ((128.84, -45.18), (98.48, 17.77), (83.63, 22.01), (343.49, 16.15))
+# Rotation from galactic to equatorial (J2000) unit vectors.
+GALACTIC_TO_EQUATORIAL = np.array([
+    [-0.0548755604162154, 0.4941094278755837, -0.8676661490190047],
+    [-0.8734370902348850, -0.4448296299600112, -0.1980763734312015],
+    [-0.4838350155487132, 0.7469822444972189, 0.4559837761750669],
+])
+
+
+def week_start(week) -> float:
+    return WEEK_9_START + (week - 9) * WEEK_SECONDS
+
+
+def weekly_file_names(week):
+    '''
+    Names of the photon and spacecraft weekly files of a week, as published by the FSSC.
+    '''
+    return f"lat_photon_weekly_w{week:03d}_p305_v001.fits", f"lat_spacecraft_weekly_w{week:03d}_p310_v001.fits"
+
+
+def _unit_vectors(lon, lat) -> np.ndarray:
+    lon, lat = np.radians(lon), np.radians(lat)
+    return np.stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)), axis=-1)
+
+
+def _lonlat(vectors):
+    lon = np.degrees(np.arctan2(vectors[..., 1], vectors[..., 0])) % 360
+    lat = np.degrees(np.arcsin(np.clip(vectors[..., 2], -1, 1)))
+    return lon, lat
+
+
+def orbit(times, seed=0) -> dict:
+    '''
+    Attitude and position of a spacecraft in a circular low Earth orbit, rocking
+    ROCK_ANGLE degrees north and south of the zenith on alternate orbits.
+
+    Returns:
+    -------
+        Dictionary of float64 arrays: 'position' (n, 3) in meters, 'zenith' and 'scz'
+        (n, 3) unit vectors, and 'rock' the rocking angle in degrees.
+    '''
+    rng = np.random.default_rng(seed)
+    node = rng.uniform(0, 2 * np.pi)
+    phase = 2 * np.pi * (times - WEEK_9_START) / ORBIT_PERIOD + rng.uniform(0, 2 * np.pi)
+    # Precession of the orbit node, about 6 degrees per day.
+    node = node - np.radians(6.0) * (times - WEEK_9_START) / 86400.0
+    inclination = np.radians(ORBIT_INCLINATION)
+    in_plane = np.stack((np.cos(phase), np.sin(phase) * np.cos(inclination), np.sin(phase) * np.sin(inclination)), axis=-1)
+    zenith = np.stack((in_plane[:, 0] * np.cos(node) - in_plane[:, 1] * np.sin(node),
+                       in_plane[:, 0] * np.sin(node) + in_plane[:, 1] * np.cos(node),
+                       in_plane[:, 2]), axis=-1)
+    rock = np.where(np.floor(phase / (2 * np.pi)) % 2 == 0, ROCK_ANGLE, -ROCK_ANGLE)
+    # Rock towards the north (or south) celestial pole, in the plane of the zenith and the pole.
+    north = np.array([0.0, 0.0, 1.0]) - zenith[:, 2:3] * zenith
+    north /= np.linalg.norm(north, axis=1, keepdims=True)
+    angle = np.radians(rock)[:, None]
+    scz = np.cos(angle) * zenith + np.sin(angle) * north
+    return {'position': ORBIT_RADIUS * zenith, 'zenith': zenith, 'scz': scz, 'rock': rock}
+
+
+def sun_position(times):
+    '''
+    Approximate RA and DEC of the Sun in degrees at mission elapsed times.
+    '''
+    days = (times - WEEK_9_START) / 86400.0
+    # Ecliptic longitude of the Sun at the start of week 9 (2008 August 4).
+    longitude = np.radians(132.2 + 0.98565 * days)
+    obliquity = np.radians(23.439)
+    ra = np.degrees(np.arctan2(np.cos(obliquity) * np.sin(longitude), np.cos(longitude))) % 360
+    dec = np.degrees(np.arcsin(np.sin(obliquity) * np.sin(longitude)))
+    return ra, dec
+
+
+def saa_gtis(tstart, tstop, seed=0):
+    '''
+    Good time intervals of a time range: orbits minus random South Atlantic Anomaly crossings.
+
+    Returns:
+    -------
+        (start, stop) float64 arrays.
+    '''
+    rng = np.random.default_rng(seed)
+    orbit_starts = np.arange(tstart, tstop, ORBIT_PERIOD)
+    starts, stops = [], []
+    for orbit_start in orbit_starts:
+        orbit_stop = min(orbit_start + ORBIT_PERIOD, tstop)
+        if rng.random() < SAA_FRACTION:
+            duration = rng.uniform(*SAA_DURATION)
+            saa_start = rng.uniform(orbit_start, max(orbit_start, orbit_stop - duration))
+            intervals = ((orbit_start, saa_start), (saa_start + duration, orbit_stop))
+        else:
+            intervals = ((orbit_start, orbit_stop),)
+        for start, stop in intervals:
+            if stop - start > FT2_STEP:
+                starts.append(start)
+                stops.append(stop)
+    return np.array(starts), np.array(stops)
+
+
+def _sky_directions(n, rng) -> np.ndarray:
+    '''
+    Unit vectors of n photon directions: isotropic background, Galactic plane and point sources.
+    '''
+    kind = rng.choice(3, size=n, p=(1 - PLANE_FRACTION - SOURCES_FRACTION, PLANE_FRACTION, SOURCES_FRACTION))
+    vectors = np.empty((n, 3))
+    isotropic = kind == 0
+    vectors[isotropic] = _unit_vectors(rng.uniform(0, 360, isotropic.sum()),
+                                       np.degrees(np.arcsin(rng.uniform(-1, 1, isotropic.sum()))))
+    plane = kind == 1
+    l = rng.laplace(0, 30, plane.sum()) % 360
+    b = np.clip(rng.normal(0, 3, plane.sum()), -90, 90)
+    vectors[plane] = _unit_vectors(l, b) @ GALACTIC_TO_EQUATORIAL.T
+    sources = kind == 2
+    centers = np.array(POINT_SOURCES)[rng.integers(len(POINT_SOURCES), size=sources.sum())]
+    # Small-angle scatter of about 1 degree around the source.
+    offsets = rng.normal(0, 1.0, (sources.sum(), 2))
+    dec = np.clip(centers[:, 1] + offsets[:, 1], -90, 90)
+    ra = centers[:, 0] + offsets[:, 0] / np.maximum(np.cos(np.radians(dec)), 0.05)
+    vectors[sources] = _unit_vectors(ra, dec)
+    return vectors
+
+
+def make_ft1(output_file, ft2_file, n_events, seed=0):
+    '''
+    Writes a synthetic FT1 file (EVENTS and GTI extensions) observed along the orbit of an FT2 file.
+
+    Events are drawn from a sky model (see _sky_directions) within FOV_RADIUS of the
+    spacecraft z axis, at times uniformly distributed in the good time intervals of the
+    FT2 file (DATA_QUAL > 0 and outside the SAA). Energies follow a power law of index
+    SPECTRAL_INDEX and zenith angles are computed from the orbit.
+
+    Parameters:
+    ----------
+        output_file: Output FT1 file.
+        ft2_file: FT2 file written by make_ft2 for the same week.
+        n_events: Number of events.
+        seed: Seed of the random generator.
+    '''
+    rng = np.random.default_rng(seed)
+    with fits.open(ft2_file) as hdul:
+        sc_data = hdul['SC_DATA'].data
+        start, stop = sc_data['START'], sc_data['STOP']
+        good = (sc_data['DATA_QUAL'] > 0) & ~sc_data['IN_SAA']
+        zenith = _unit_vectors(sc_data['RA_ZENITH'], sc_data['DEC_ZENITH'])
+        scz = _unit_vectors(sc_data['RA_SCZ'], sc_data['DEC_SCZ'])
+        tstart, tstop = hdul['SC_DATA'].header['TSTART'], hdul['SC_DATA'].header['TSTOP']
+        good &= (start >= tstart) & (stop <= tstop)
+        gti_start, gti_stop = _merge_intervals(start[good], stop[good])
+
+    # Times: rows drawn proportionally to their duration, then uniformly within the row.
+    rows = np.flatnonzero(good)
+    weights = (stop[rows] - start[rows]) / (stop[rows] - start[rows]).sum()
+    event_rows = np.sort(rng.choice(rows, size=n_events, p=weights))
+    times = start[event_rows] + rng.uniform(0, 1, n_events) * (stop[event_rows] - start[event_rows])
+    order = np.argsort(times, kind='stable')
+    times, event_rows = times[order], event_rows[order]
+
+    # Directions: sky model events in the field of view of each event row.
+    directions = np.empty((n_events, 3))
+    missing = np.arange(n_events)
+    cos_fov = np.cos(np.radians(FOV_RADIUS))
+    while len(missing):
+        candidates = _sky_directions(len(missing), rng)
+        inside = np.einsum('ij,ij->i', candidates, scz[event_rows[missing]]) >= cos_fov
+        directions[missing[inside]] = candidates[inside]
+        missing = missing[~inside]
+    ra, dec = _lonlat(directions)
+    l, b = _lonlat(directions @ GALACTIC_TO_EQUATORIAL)
+    zenith_angle = np.degrees(np.arccos(np.clip(np.einsum('ij,ij->i', directions, zenith[event_rows]), -1, 1)))
+    emin, emax = ENERGY_RANGE
+    a = 1 - SPECTRAL_INDEX
+    energy = (emin ** a + rng.uniform(0, 1, n_events) * (emax ** a - emin ** a)) ** (1 / a)
+
+    # EVENT_CLASS bits: SOURCE (7) and the looser classes (2-6); 80% pass the cleaner classes (8+).
+    event_class = np.zeros((n_events, 32), dtype=bool)
+    event_class[:, 31 - np.arange(2, 8)] = True
+    event_class[:, 31 - 8] = rng.random(n_events) < 0.8
+    event_class[:, 31 - 9] = event_class[:, 31 - 8] & (rng.random(n_events) < 0.8)
+    # EVENT_TYPE bits: FRONT (0) or BACK (1), one PSF quartile (2-5), one EDISP quartile (6-9).
+    event_type = np.zeros((n_events, 32), dtype=bool)
+    front = rng.random(n_events) < 0.5
+    event_type[:, 31] = front
+    event_type[:, 30] = ~front
+    event_type[np.arange(n_events), 31 - 2 - rng.integers(4, size=n_events)] = True
+    event_type[np.arange(n_events), 31 - 6 - rng.integers(4, size=n_events)] = True
+
+    columns = [
+        fits.Column('ENERGY', 'E', unit='MeV', array=energy),
+        fits.Column('RA', 'E', unit='deg', array=ra),
+        fits.Column('DEC', 'E', unit='deg', array=dec),
+        fits.Column('L', 'E', unit='deg', array=l),
+        fits.Column('B', 'E', unit='deg', array=b),
+        fits.Column('THETA', 'E', unit='deg', array=np.degrees(np.arccos(np.clip(np.einsum('ij,ij->i', directions, scz[event_rows]), -1, 1)))),
+        fits.Column('ZENITH_ANGLE', 'E', unit='deg', array=zenith_angle),
+        fits.Column('EARTH_AZIMUTH_ANGLE', 'E', unit='deg', array=rng.uniform(0, 360, n_events)),
+        fits.Column('TIME', 'D', unit='s', array=times),
+        fits.Column('EVENT_ID', 'J', array=np.arange(n_events)),
+        fits.Column('RUN_ID', 'J', array=np.floor(times / ORBIT_PERIOD).astype(np.int64) % 2 ** 31),
+        fits.Column('EVENT_CLASS', '32X', array=event_class),
+        fits.Column('EVENT_TYPE', '32X', array=event_type),
+        fits.Column('CONVERSION_TYPE', 'I', array=(~front).astype(np.int16)),
+        fits.Column('LIVETIME', 'D', unit='s', array=rng.uniform(0, 1e-3, n_events)),
+    ]
+    events = fits.BinTableHDU.from_columns(columns, name='EVENTS')
+    gti = fits.BinTableHDU.from_columns([fits.Column('START', 'D', unit='s', array=gti_start),
+                                         fits.Column('STOP', 'D', unit='s', array=gti_stop)], name='GTI')
+    primary = fits.PrimaryHDU()
+    for hdu in (primary, events, gti):
+        _mission_keywords(hdu.header, tstart, tstop)
+    dss = (('TIME', 's', 'TABLE', ':GTI'), ('POS(RA,DEC)', 'deg', 'CIRCLE(0,0,180)', None),
+           ('ENERGY', 'MeV', f"{emin:g}:{emax:g}", None), ('BIT_MASK(EVENT_CLASS,128,P8R3)', 'DIMENSIONLESS', '1:1', None))
+    events.header['NDSKEYS'] = len(dss)
+    for i, (dstyp, dsuni, dsval, dsref) in enumerate(dss, 1):
+        events.header[f'DSTYP{i}'] = dstyp
+        events.header[f'DSUNI{i}'] = dsuni
+        events.header[f'DSVAL{i}'] = dsval
+        if dsref:
+            events.header[f'DSREF{i}'] = dsref
+    fits.HDUList([primary, events, gti]).writeto(output_file, overwrite=True, checksum=True)
+
+
+def _merge_intervals(start, stop):
+    '''
+    Merges contiguous rows into intervals.
+    '''
+    if not len(start):
+        return np.empty(0), np.empty(0)
+    breaks = np.flatnonzero(start[1:] > stop[:-1]) + 1
+    return start[np.r_[0, breaks]], stop[np.r_[breaks - 1, len(stop) - 1]]
+
+
+def _mission_keywords(header, tstart, tstop):
+    header['TELESCOP'] = 'GLAST'
+    header['INSTRUME'] = 'LAT'
+    header['OBSERVER'] = 'Synthetic'
+    header['TIMESYS'] = 'TT'
+    header['TIMEREF'] = 'LOCAL'
+    header['MJDREFI'] = 51910
+    header['MJDREFF'] = 7.428703703703703e-4
+    header['TSTART'] = tstart
+    header['TSTOP'] = tstop
+
+
+def make_ft2(output_file, tstart, tstop, seed=0):
+    '''
+    Writes a synthetic FT2 file (SC_DATA extension) with one row every FT2_STEP seconds.
+
+    The rows cover [tstart, tstop] plus one row on both sides, like the weekly files.
+    The spacecraft follows orbit(), the Sun sun_position(); rows inside the SAA
+    crossings of saa_gtis() have IN_SAA set and LIVETIME 0, and a few percent of the
+    rows have DATA_QUAL 0 or LAT_CONFIG 0.
+
+    Parameters:
+    ----------
+        output_file: Output FT2 file.
+        tstart, tstop: Time range in mission elapsed time.
+        seed: Seed of the random generator.
+    '''
+    rng = np.random.default_rng(seed)
+    start = np.arange(tstart - FT2_STEP, tstop + FT2_STEP, FT2_STEP)
+    stop = start + FT2_STEP
+    n_rows = len(start)
+    mid = start + FT2_STEP / 2
+    state = orbit(mid, seed)
+    gti_start, gti_stop = saa_gtis(tstart, tstop, seed)
+    index = np.searchsorted(gti_start, start, side='right') - 1
+    in_gti = (index >= 0) & (stop <= gti_stop[np.maximum(index, 0)])
+    in_saa = ~in_gti & (start >= tstart) & (stop <= tstop)
+    data_qual = np.where(rng.random(n_rows) < 0.03, 0, 1).astype(np.int16)
+    lat_config = np.where(rng.random(n_rows) < 0.01, 0, 1).astype(np.int16)
+    ra_zenith, dec_zenith = _lonlat(state['zenith'])
+    ra_scz, dec_scz = _lonlat(state['scz'])
+    # The x axis points towards the Sun side, orthogonal to z.
+    ra_sun, dec_sun = sun_position(mid)
+    sun = _unit_vectors(ra_sun, dec_sun)
+    scx = sun - np.einsum('ij,ij->i', sun, state['scz'])[:, None] * state['scz']
+    scx /= np.linalg.norm(scx, axis=1, keepdims=True)
+    ra_scx, dec_scx = _lonlat(scx)
+    gmst = (280.46 + 360.9856474 * (mid - WEEK_9_START) / 86400.0 + 133.0) % 360
+    columns = [
+        fits.Column('START', 'D', unit='s', array=start),
+        fits.Column('STOP', 'D', unit='s', array=stop),
+        fits.Column('SC_POSITION', '3E', unit='m', array=state['position']),
+        fits.Column('LAT_GEO', 'E', unit='deg', array=dec_zenith),
+        fits.Column('LON_GEO', 'E', unit='deg', array=(ra_zenith - gmst) % 360),
+        fits.Column('RAD_GEO', 'E', unit='m', array=np.full(n_rows, ORBIT_RADIUS)),
+        fits.Column('RA_ZENITH', 'E', unit='deg', array=ra_zenith),
+        fits.Column('DEC_ZENITH', 'E', unit='deg', array=dec_zenith),
+        fits.Column('IN_SAA', 'L', array=in_saa),
+        fits.Column('RA_SCZ', 'E', unit='deg', array=ra_scz),
+        fits.Column('DEC_SCZ', 'E', unit='deg', array=dec_scz),
+        fits.Column('RA_SCX', 'E', unit='deg', array=ra_scx),
+        fits.Column('DEC_SCX', 'E', unit='deg', array=dec_scx),
+        fits.Column('LAT_MODE', 'J', array=np.where(in_saa, 4, 5)),
+        fits.Column('LAT_CONFIG', 'I', array=lat_config),
+        fits.Column('DATA_QUAL', 'I', array=data_qual),
+        fits.Column('LIVETIME', 'D', unit='s', array=np.where(in_saa, 0.0, FT2_STEP * rng.uniform(0.85, 0.92, n_rows))),
+        fits.Column('ROCK_ANGLE', 'E', unit='deg', array=state['rock']),
+        fits.Column('RA_SUN', 'E', unit='deg', array=ra_sun),
+        fits.Column('DEC_SUN', 'E', unit='deg', array=dec_sun),
+    ]
+    sc_data = fits.BinTableHDU.from_columns(columns, name='SC_DATA')
+    primary = fits.PrimaryHDU()
+    for hdu in (primary, sc_data):
+        _mission_keywords(hdu.header, tstart, tstop)
+    fits.HDUList([primary, sc_data]).writeto(output_file, overwrite=True, checksum=True)
+
+
+def make_weeks(output_dir, weeks, events_per_week, first_week=9, seed=0):
+    '''
+    Writes the synthetic photon and spacecraft weekly files of consecutive weeks.
+    Existing files are kept, so generated datasets can be reused across runs.
+
+    Parameters:
+    ----------
+        output_dir: Output directory.
+        weeks: Number of weeks.
+        events_per_week: Number of events of each photon file.
+        first_week: Mission week of the first file.
+        seed: Seed of the random generator; week w uses seed + w.
+
+    Returns:
+    -------
+        (ft1_list, ft2_list) of the file paths.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    ft1_list, ft2_list = [], []
+    for week in range(first_week, first_week + weeks):
+        ft1_name, ft2_name = weekly_file_names(week)
+        ft1_file, ft2_file = os.path.join(output_dir, ft1_name), os.path.join(output_dir, ft2_name)
+        tstart = week_start(week)
+        if not os.path.exists(ft2_file):
+            make_ft2(ft2_file, tstart, tstart + WEEK_SECONDS, seed + week)
+        if not os.path.exists(ft1_file):
+            make_ft1(ft1_file, ft2_file, events_per_week, seed + week)
+        ft1_list.append(ft1_file)
+        ft2_list.append(ft2_file)
+    return ft1_list, ft2_list
@@ -0,0 +1,170 @@
+import os
+import time
+import shutil
+import signal
+import logging
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from .config import TOOL_WORKERS, TOOL_TIMEOUT, TOOLS_DIR, TOOL_ENV
+
+
+class ToolError(Exception):
+    pass
+
+
+class ToolResult:
+    '''
+    Outcome of a tool invocation.
+    '''
+
+    def __init__(self, tool, command, returncode, stdout, stderr, elapsed, timed_out=False):
+        self.tool = tool
+        self.command = command
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0 and not self.timed_out
+
+    def __repr__(self):
+        return f"ToolResult({self.tool!r}, returncode={self.returncode}, elapsed={self.elapsed:.2f}, timed_out={self.timed_out})"
+
+
+def format_param(value) -> str:
+    '''
+    Formats a parameter value for the command line of a Fermitools (PIL) executable.
+    '''
+    if isinstance(value, bool):
+        return 'yes' if value else 'no'
+    return str(value)
+
+
+class ToolRunner:
+    '''
+    Runs command-line tools (e.g. the Fermitools gtselect/gtmktime) as isolated subprocesses.
+
+    Parameters are passed as 'name=value' arguments instead of through shared .par files,
+    and every invocation gets its own temporary PFILES directory (followed by the system
+    parameter directories), so concurrent invocations never see each other's parameters.
+    At most max_workers tools run at once; each one is killed, with its process group,
+    when it exceeds its timeout. Its exit code, stdout and stderr are returned in a ToolResult.
+
+    Executables are looked up in tools_dir first, then in PATH, so that a directory of
+    stub executables can stand in for the Fermitools. The variables of env (by default
+    the calibration paths CALDB, CALDBCONFIG and REFDATA of the configuration) are added
+    to the environment of the tools, not to the environment of the server.
+    '''
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, max_workers=TOOL_WORKERS, timeout=TOOL_TIMEOUT, tools_dir=TOOLS_DIR, env=None):
+        self.max_workers = max(1, int(max_workers))
+        self.timeout = timeout
+        self.tools_dir = tools_dir
+        self.env = dict(TOOL_ENV if env is None else env)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='fermifilters-tool')
+
+    def which(self, tool):
+        '''
+        Returns the path of a tool executable, or None if it cannot be found.
+        '''
+        if self.tools_dir:
+            path = shutil.which(tool, path=self.tools_dir)
+            if path:
+                return path
+        return shutil.which(tool)
+
+    def submit(self, tool, params=None, cwd=None, timeout=None):
+        '''
+        Queues a tool invocation and returns a concurrent.futures.Future of its ToolResult.
+        '''
+        return self._executor.submit(self._run, tool, dict(params or {}), cwd, timeout)
+
+    def run(self, tool, params=None, cwd=None, timeout=None) -> ToolResult:
+        '''
+        Runs a tool and waits for its result.
+
+        Parameters:
+        ----------
+            tool: Name of the executable, e.g. 'gtselect'.
+            params: Dictionary of parameters, passed as 'name=value' arguments.
+                'mode' defaults to 'h', so that the tool never prompts.
+            cwd: Optional working directory.
+            timeout: Timeout in seconds, defaults to the runner timeout.
+
+        Returns:
+        -------
+            The ToolResult of the invocation.
+
+        Raises:
+        ------
+            ToolError if the executable cannot be found or started.
+        '''
+        return self.submit(tool, params, cwd, timeout).result()
+
+    def _run(self, tool, params, cwd, timeout):
+        executable = self.which(tool)
+        if executable is None:
+            raise ToolError(f"{tool} not found in {self.tools_dir or 'PATH'}")
+        params.setdefault('mode', 'h')
+        command = [executable] + [f"{name}={format_param(value)}" for name, value in params.items()]
+        timeout = self.timeout if timeout is None else timeout
+        pfiles_dir = tempfile.mkdtemp(prefix=f"pfiles_{tool}_")
+        env = os.environ.copy()
+        env.update(self.env)
+        if self.tools_dir:
+            # The Fermitools run their helper executables from PATH.
+            env['PATH'] = os.pathsep.join([self.tools_dir, env.get('PATH', '')])
+        env['PFILES'] = f"{pfiles_dir};{self._system_pfiles()}"
+        self.logger.info(" %s: %s", tool, ' '.join(command[1:]))
+        start = time.monotonic()
+        try:
+            try:
+                process = subprocess.Popen(command, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                           start_new_session=True)
+            except OSError as e:
+                raise ToolError(f"{tool} could not be started: {e}") from e
+            try:
+                stdout, stderr = process.communicate(timeout=timeout)
+                timed_out = False
+            except subprocess.TimeoutExpired:
+                self.logger.error(" %s: timed out after %s s, killing it", tool, timeout)
+                os.killpg(process.pid, signal.SIGKILL)
+                stdout, stderr = process.communicate()
+                timed_out = True
+        finally:
+            shutil.rmtree(pfiles_dir, ignore_errors=True)
+        result = ToolResult(tool, command, process.returncode, stdout, stderr, time.monotonic() - start, timed_out)
+        if not result.ok:
+            self.logger.error(" %s: exit code %s\n%s", tool, result.returncode, stderr.strip())
+        return result
+
+    @staticmethod
+    def _system_pfiles() -> str:
+        # PFILES is 'user1:user2;system1:system2', or a single list used for both.
+        pfiles = os.environ.get('PFILES', '')
+        return pfiles.split(';', 1)[1] if ';' in pfiles else pfiles
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+_default_runner = None
+_default_runner_lock = threading.Lock()
+
+
+def default_runner() -> ToolRunner:
+    '''
+    Returns the ToolRunner shared by the engines of the process.
+    '''
+    global _default_runner
+    with _default_runner_lock:
+        if _default_runner is None:
+            _default_runner = ToolRunner()
+        return _default_runner
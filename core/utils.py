@@ -1,22 +1,55 @@
+import io
 import os
-import matplotlib
-import matplotlib.pyplot as plt
-from matplotlib.colors import LogNorm
-from astropy.io import fits
 import numpy as np
-import requests
 import logging
-import xml.etree.ElementTree as ET
-import astropy.units as u
-from astropy.coordinates import SkyCoord
+from .columnar import table_columns, open_table, read_table_gti, load_columns
+from .config import PLOT_BACKEND, HEALPIX_NSIDE, COLUMNAR_CACHE, PARALLEL_WORKERS
+from .downloads import DownloadManager
+from .lazy import LazyModule
+from .metrics import current_span, traced
+from .mktime import ft2_gti, intersect_gtis, read_gti, roi_from_header
+from .parallel import map_chunks
+from .stats import load_stats, estimate_selection
+from .store import default_store
+from .votable import iter_manifest
+from .workspace import atomic_output
+from .skymap import AXIS_LABELS, hp, load_count_map, render_grid
 
-class Plotter:
+fits = LazyModule('astropy.io.fits')
+
+
+def pyplot():
+    '''
+    Returns matplotlib.pyplot, imported on first use with the non-interactive Agg backend.
+    '''
+    import matplotlib
     matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+class Plotter:
+    BACKENDS = ('healpix', 'histogram')
+
+    def __init__(self, backend=PLOT_BACKEND, nside=HEALPIX_NSIDE, workers=PARALLEL_WORKERS):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown plot backend '{backend}', expected one of {self.BACKENDS}")
+        if backend == 'healpix' and hp is None:
+            logging.warning(" Plotter: healpy is not installed, falling back to the histogram backend")
+            backend = 'histogram'
+        self.backend = backend
+        self.nside = nside
+        self.workers = workers
 
+    @traced('plot')
     def plot_ft_data(self, ft_file_list, x, y, plot_filename, coord='C', projection=None):
         """
-        Crea una serie di plot in proiezione usando matplotlib,
-        plottando i punti (x, y) direttamente.
+        Crea una serie di plot in proiezione usando matplotlib.
+
+        Con il backend 'healpix' gli eventi di ogni file vengono binnati una sola volta
+        in una mappa HEALPix, salvata accanto al file (vedi core.skymap), e i plot
+        successivi (anche con coord o projection diversi) usano la mappa in cache.
+        Con il backend 'histogram' i punti (x, y) vengono binnati a ogni chiamata.
 
         Args:
             ft_file_list (list): Lista dei percorsi dei file FITS.
@@ -28,67 +61,103 @@ class Plotter:
         Returns:
             fig: Matplotlib figure object.
         """
+        if coord not in AXIS_LABELS:
+            raise ValueError(f"Coordinate system '{coord}' non riconosciuto. Usa 'G' o 'C'.")
         if projection == 'none':
             projection = None
+        from matplotlib.colors import LogNorm
+        plt = pyplot()
         fig, axs = plt.subplots(len(ft_file_list), 1, figsize=(12, 9), subplot_kw={'projection': projection})
         if len(ft_file_list) == 1:
             axs = [axs]
 
+        xlabel, ylabel = AXIS_LABELS[coord]
         for i, (ax, ft_file) in enumerate(zip(axs, ft_file_list)):
-            with fits.open(ft_file) as hdul:
-                ft_data = hdul[1].data
-                
-                xdata = ft_data[x]
-                ydata = ft_data[y]
-                
-                if coord == 'G':
-                    c = SkyCoord(ra=xdata*u.degree, dec=ydata*u.degree, frame='fk5').galactic
-                    lon = c.l.deg
-                    lat = c.b.deg
-                    xlabel = 'Galactic Longitude [deg]'
-                    ylabel = 'Galactic Latitude [deg]'
-                elif coord == 'C':
-                    lon = xdata
-                    lat = ydata
-                    xlabel = 'RA [deg]'
-                    ylabel = 'DEC [deg]'
-                else:
-                    raise ValueError(f"Coordinate system '{coord}' non riconosciuto. Usa 'G' o 'C'.")
-                
-                lon = (lon + 180) % 360 - 180
-                
-                lon_rad = np.radians(lon)
-                lat_rad = np.radians(lat)
-                
-                mask = np.isfinite(lon_rad) & np.isfinite(lat_rad)
-                lon_rad = lon_rad[mask]
-                lat_rad = lat_rad[mask]
-                
-                xbins = 200
-                ybins = 200
-
-                H, xedges, yedges = np.histogram2d(lon_rad, lat_rad, bins=[xbins, ybins])
-                H_plot = H + 1.0
-                pcm = ax.pcolormesh(xedges, yedges, H_plot.T, cmap='magma', norm=LogNorm(vmin=1, vmax=H_plot.max()))
-                fig.colorbar(pcm, ax=ax)
-                ax.set_title(os.path.basename(ft_file))
-                ax.grid(True)
-                ax.set_xlabel(xlabel)
-                ax.set_ylabel(ylabel)
+            if self.backend == 'healpix':
+                count_map = load_count_map(ft_file, x, y, self.nside, self.workers)
+                xedges, yedges, H = render_grid(count_map, coord)
+            else:
+                xedges, yedges, H = self._histogram(ft_file, x, y, coord)
+            H_plot = H + 1.0
+            pcm = ax.pcolormesh(xedges, yedges, H_plot.T, cmap='magma', norm=LogNorm(vmin=1, vmax=H_plot.max()))
+            fig.colorbar(pcm, ax=ax)
+            ax.set_title(os.path.basename(ft_file))
+            ax.grid(True)
+            ax.set_xlabel(xlabel)
+            ax.set_ylabel(ylabel)
 
         plt.tight_layout()
         if projection is not None:
             fig.subplots_adjust(top=0.95, right=0.99, left=0., bottom=0.02, hspace=0.2)
-        plt.savefig(plot_filename, dpi=400)
+        with atomic_output(plot_filename) as tmp_path:
+            plt.savefig(tmp_path, dpi=400, format=os.path.splitext(plot_filename)[1][1:] or 'png')
         plt.close(fig)
         return fig
-    
+
+    def _histogram(self, ft_file, x, y, coord):
+        xbins = 200
+        ybins = 200
+        with table_columns(ft_file, 1, decoded=True) as ft_data:
+            if self.workers <= 1:
+                lon_rad, lat_rad = sky_coordinates(ft_data, x, y, coord)
+                H, xedges, yedges = np.histogram2d(lon_rad, lat_rad, bins=[xbins, ybins])
+                return xedges, yedges, H
+            # Same edges as the serial histogram: the range spans the coordinates of all the events.
+            extrema = [e for e in map_chunks(sky_extrema, ft_file, 1, len(ft_data), x, y, coord, workers=self.workers) if e is not None]
+            hist_range = [[min(e[0] for e in extrema), max(e[1] for e in extrema)],
+                          [min(e[2] for e in extrema), max(e[3] for e in extrema)]]
+            H = None
+            for partial in map_chunks(sky_histogram, ft_file, 1, len(ft_data), x, y, coord, [xbins, ybins], hist_range, workers=self.workers):
+                H = partial[0] if H is None else H + partial[0]
+                xedges, yedges = partial[1], partial[2]
+        return xedges, yedges, H
+
+
+def sky_coordinates(columns, x, y, coord, start=0, stop=None):
+    '''
+    Longitudes in [-pi, pi) and latitudes in radians of the events of a row range,
+    in the frame of coord ('G' or 'C'), skipping the non-finite positions.
+    '''
+    xdata = columns[x][start:stop]
+    ydata = columns[y][start:stop]
+
+    if coord == 'G':
+        import astropy.units as u
+        from astropy.coordinates import SkyCoord
+        c = SkyCoord(ra=xdata*u.degree, dec=ydata*u.degree, frame='fk5').galactic
+        lon = c.l.deg
+        lat = c.b.deg
+    else:
+        lon = xdata
+        lat = ydata
+
+    lon = (lon + 180) % 360 - 180
+
+    lon_rad = np.radians(lon)
+    lat_rad = np.radians(lat)
+
+    mask = np.isfinite(lon_rad) & np.isfinite(lat_rad)
+    return lon_rad[mask], lat_rad[mask]
+
+
+def sky_extrema(columns, x, y, coord, start=0, stop=None):
+    lon_rad, lat_rad = sky_coordinates(columns, x, y, coord, start, stop)
+    if not len(lon_rad):
+        return None
+    return lon_rad.min(), lon_rad.max(), lat_rad.min(), lat_rad.max()
+
+
+def sky_histogram(columns, x, y, coord, bins, hist_range, start=0, stop=None):
+    lon_rad, lat_rad = sky_coordinates(columns, x, y, coord, start, stop)
+    return np.histogram2d(lon_rad, lat_rad, bins=bins, range=hist_range)
+
 
 class FitsReader:
 
+    @traced('metadata.ft2')
     def read_info_from_ft2(self, ft_file) -> dict:
         '''
-        Reads the information from the input FT2 file.
+        Reads the information from the input FT2 file, served from its statistics index.
 
         Parameters:
         ----------
@@ -101,30 +170,27 @@ class FitsReader:
         EXCLUDED_COLUMNS = ['SC_VELOCITY', 'SC_POSITION']
         DEFAULT_COLUMNS = ['START', 'DATA_QUAL', 'ROCK_ANGLE', 'LAT_CONFIG']
         ACCEPTED_DTYPES = (np.float64, np.float32, np.uint8, np.int16, np.int32)
-        with fits.open(ft_file) as file:
-            data = file[1].data
-            info_dict = {}
-            for col in data.columns:
-                col_name = col.name
-                if col_name in EXCLUDED_COLUMNS:
-                    continue
-                col_data = data[col_name]
-                col_type = col.dtype
-                if col_type in ACCEPTED_DTYPES:
-                    info_dict[col_name] = {
-                        'max': col_data.max().item(),
-                        'min': col_data.min().item(),
-                        'dtype': str(col_type),
-                        'unit': col.unit if col.unit else "N.A.",
-                        'disabled': int(col_data.max() != col_data.min()),
-                        'default': int(col_name in DEFAULT_COLUMNS)
-                    }
-            return info_dict
+        stats = load_stats(ft_file)
+        info_dict = {}
+        for col_name, col_stats in stats['columns'].items():
+            if col_name in EXCLUDED_COLUMNS or col_stats['min'] is None:
+                continue
+            if np.dtype(col_stats['dtype']) in ACCEPTED_DTYPES:
+                info_dict[col_name] = {
+                    'max': col_stats['max'],
+                    'min': col_stats['min'],
+                    'dtype': col_stats['dtype'],
+                    'unit': col_stats['unit'] if col_stats['unit'] else "N.A.",
+                    'disabled': int(col_stats['max'] != col_stats['min']),
+                    'default': int(col_name in DEFAULT_COLUMNS)
+                }
+        return info_dict
 
+    @traced('metadata.ft1')
     def read_info_from_ft1(self, ft_file) -> dict:
         '''
-        Mock function!
-        Reads the information from the input FT1 file.
+        Reads the energy and zenith angle ranges of the input FT1 file, served from its
+        statistics index. The ranges are widened to whole numbers for the sliders.
 
         Parameters:
         ----------
@@ -134,65 +200,140 @@ class FitsReader:
         -------
             Dictionary containing the information.
         '''
+        COLUMNS = {'zenith_angle': ('ZENITH_ANGLE', 'Zenith Angle', 'deg'),
+                   'energy': ('ENERGY', 'Energy', 'MeV')}
+        stats = load_stats(ft_file)
         info_dict = {}
-        info_dict['zenith_angle'] = {
-            'name': 'Zenith Angle',
-            'max': 180,
-            'min': 0,
-            'dtype': 'int16',
-            'unit': 'deg',
-            'disabled': 1,
-            'default': 1
-        }
-        info_dict['energy'] = {
-            'name': 'Energy',
-            'max': 300000,
-            'min': 30,
-            'dtype': 'int16',
-            'unit': 'MeV',
-            'disabled': 1,
-            'default': 1
-        }
+        for key, (col_name, name, unit) in COLUMNS.items():
+            col_stats = stats['columns'].get(col_name)
+            if col_stats is None or col_stats['min'] is None:
+                continue
+            col_min, col_max = int(np.floor(col_stats['min'])), int(np.ceil(col_stats['max']))
+            info_dict[key] = {
+                'name': name,
+                'max': col_max,
+                'min': col_min,
+                'dtype': col_stats['dtype'],
+                'unit': col_stats['unit'] or unit,
+                'disabled': int(col_max != col_min),
+                'default': 1
+            }
         return info_dict
 
+    def estimate_selected_events(self, ft1_file, ft2_file, select_dict=None, maketime_dict=None) -> dict:
+        '''
+        Estimates the number of events left by gtselect and gtmktime before running them
+        (see stats.estimate_selection). The GTIs of gtmktime are computed from the FT2 file.
+
+        Parameters:
+        ----------
+            ft1_file: Input FT1 file.
+            ft2_file: Input FT2 file.
+            select_dict: Optional gtselect parameters.
+            maketime_dict: Optional gtmktime parameters.
+
+        Returns:
+        -------
+            Dictionary with 'n_events', 'estimate' and the 'fractions' of each cut.
+        '''
+        gti = None
+        if maketime_dict:
+            roicut = str(maketime_dict.get('roicut', False)).lower() in ('true', 'yes', 'on', '1')
+            events = open_table(ft1_file, 'EVENTS')
+            if events is not None:
+                events_header, ft1_gti = events.header, read_table_gti(ft1_file)
+            else:
+                with fits.open(ft1_file, memmap=True) as hdul:
+                    events_header, ft1_gti = hdul['EVENTS'].header.copy(), read_gti(hdul['GTI'])
+            roi = roi_from_header(events_header) if roicut else None
+            gti = intersect_gtis(ft2_gti(ft2_file, maketime_dict.get('filter_expr', ''), roi), ft1_gti)
+        return estimate_selection(load_stats(ft1_file), select_dict or None, gti)
+
 
 class FilesHandler:
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger(__name__)
 
-    def download_from_url(self, files_dict, tmp_dir):
+    def __init__(self):
+        self._logged_progress = {}
+
+    @traced('download')
+    def download_from_url(self, files_dict, tmp_dir, checksums=None, progress_callback=None):
         '''
-        Downloads a file from the given URL.
+        Downloads the files of the input dictionary concurrently.
 
         Parameters:
         ----------
-            files_dict: dict containing URLs of the files to download.
+            files_dict: dict containing URLs of the files to download, grouped by week.
+            tmp_dir: Directory where the files are saved.
+            checksums: Optional dict mapping file names to 'algorithm:hexdigest' strings.
+            progress_callback: Optional callable(file_name, bytes_done, bytes_total).
 
         Returns:
         -------
-            True if the download was successful, False otherwise.
+            Dictionary with the paths of the downloaded 'photon' and 'spacecraft' files.
+            Files are taken from the shared weekly-file store when STORE_DIR is set.
+            Downloaded files are indexed (see stats.load_stats) and converted to the
+            columnar cache (see columnar.load_columns).
         '''
-        files_list = {'photon': [], 'spacecraft': []}
+        checksums = checksums or {}
+        tasks = []
         for week, week_dict in files_dict.items():
             for file_name, url in week_dict.items():
+                tasks.append({'url': url,
+                              'path': os.path.join(tmp_dir, file_name),
+                              'checksum': checksums.get(file_name)})
+        store = default_store()
+        manager = DownloadManager(progress_callback=progress_callback or self._log_progress, store=store)
+        results = manager.download(tasks)
+        files_list = {'photon': [], 'spacecraft': []}
+        for task in tasks:
+            if results[task['path']]:
+                # Written by the download threads, out of reach of the thread measurements.
+                current_span().count(written_bytes=os.path.getsize(task['path']))
                 try:
-                    output_file_path = os.path.join(tmp_dir, file_name)
-                    self.logger.info(f" Starting download from {url} to {output_file_path}")
-                    if os.path.exists(output_file_path):
-                        self.logger.info(f" File already exists: {output_file_path}, skipping download.")
-                        ft_type = 'photon' if 'photon' in file_name else 'spacecraft'
-                        files_list[ft_type].append(output_file_path)
-                        continue
-                    response = requests.get(url)
-                    response.raise_for_status()
-                    with open(output_file_path, 'wb') as f:
-                        f.write(response.content)
-                    self.logger.info(f" Download completed: {output_file_path}")
-                    ft_type = 'photon' if 'photon' in file_name else 'spacecraft'
-                    files_list[ft_type].append(output_file_path)
+                    load_stats(task['path'])
                 except Exception as e:
-                    self.logger.error(f" Error downloading file from {url}: {e}")
+                    self.logger.warning(" stats: could not index %s: %s", task['path'], e)
+                if COLUMNAR_CACHE:
+                    try:
+                        load_columns(task['path'])
+                    except Exception as e:
+                        self.logger.warning(" columns: could not convert %s: %s", task['path'], e)
+                ft_type = 'photon' if 'photon' in os.path.basename(task['path']) else 'spacecraft'
+                files_list[ft_type].append(task['path'])
         return files_list
+
+    @traced('prefetch')
+    def prefetch(self, entries, tmp_dir, progress_callback=None) -> dict:
+        '''
+        Downloads the files of a manifest while its entries are produced, e.g. while the
+        VOTable is still being parsed (see VOHandler.iter_files).
+
+        Parameters:
+        ----------
+            entries: Iterable of votable.ManifestEntry, consumed lazily.
+            tmp_dir: Directory where the files are saved.
+            progress_callback: Optional callable(file_name, bytes_done, bytes_total).
+
+        Returns:
+        -------
+            Dictionary mapping each output path to True if it was downloaded.
+        '''
+        tasks = ({'url': entry.access_url, 'path': os.path.join(tmp_dir, entry.file_name)} for entry in entries)
+        store = default_store()
+        manager = DownloadManager(progress_callback=progress_callback or self._log_progress, store=store)
+        results = manager.download(tasks)
+        current_span().count(written_bytes=sum(os.path.getsize(path) for path, ok in results.items() if ok))
+        return results
+
+    def _log_progress(self, file_name, done, total):
+        if not total:
+            return
+        decile = 10 * done // total
+        if self._logged_progress.get(file_name) != decile:
+            self._logged_progress[file_name] = decile
+            self.logger.info(f" {file_name}: {10 * decile}% ({done}/{total} bytes)")
         
 if __name__ == "__main__":
     files_dict = {'fermi_photon__lat_photon_weekly_w009_p305_v001.fits':
@@ -205,40 +346,39 @@ if __name__ == "__main__":
     print(f"Downloaded files: {files_list}")    
 
 class VOHandler:
-    def get_files_dict(self, vo_text):
+    def iter_files(self, vo_source):
         '''
-        Converts the input vo_file to a format suitable for downloading.
+        Lazily lists the files of a VOTable manifest while it is parsed (see votable.iter_manifest).
 
         Parameters:
         ----------
-            vo_file: vo xml containing the files to download.
+            vo_source: VOTable as str or bytes, or binary file-like object (e.g. a request stream).
 
         Returns:
         -------
-            Dictionary containing the files to download.
+            Iterator of votable.ManifestEntry.
+        '''
+        if isinstance(vo_source, str):
+            vo_source = vo_source.encode('utf-8')
+        if isinstance(vo_source, bytes):
+            vo_source = io.BytesIO(vo_source)
+        return iter_manifest(vo_source)
+
+    def get_files_dict(self, vo_source):
         '''
+        Converts the input vo_file to a format suitable for downloading.
 
-        vo_xml = ET.fromstring(vo_text)
-        ns = {'vot': 'http://www.ivoa.net/xml/VOTable/v1.3'}
+        Parameters:
+        ----------
+            vo_source: vo xml containing the files to download, as accepted by iter_files.
 
+        Returns:
+        -------
+            User of the last row and dictionary containing the files to download, grouped by week.
+        '''
+        user = None
         files_dict = {}
-        for table in vo_xml.findall('.//vot:TABLE', ns):
-            fields = [field.attrib['name'] for field in table.findall('vot:FIELD', ns)]
-            did_idx = fields.index('did_name')
-            url_idx = fields.index('access_url')
-            week_idx = fields.index('week')
-            user_idx = fields.index('user')
-
-            for tr in table.findall('.//vot:TR', ns):
-                tds = tr.findall('vot:TD', ns)
-                did_name = tds[did_idx].text
-                access_url = tds[url_idx].text
-                week = tds[week_idx].text
-                user = tds[user_idx].text
-                if not did_name.endswith('.fits'):
-                    file_name = did_name + '.fits'
-
-                if week not in files_dict:
-                    files_dict[week] = {}
-                files_dict[week][file_name] = access_url
-        return user, files_dict
\ No newline at end of file
+        for entry in self.iter_files(vo_source):
+            user = entry.user
+            files_dict.setdefault(entry.week, {})[entry.file_name] = entry.access_url
+        return user, files_dict
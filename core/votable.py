@@ -0,0 +1,181 @@
+import base64
+import struct
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+# Columns of the VOTable manifests posted to /tool.
+MANIFEST_FIELDS = ('did_name', 'access_url', 'week', 'user')
+
+# Size in bytes and struct code of the VOTable datatypes in BINARY serializations.
+BINARY_TYPES = {
+    'boolean': (1, 'c'),
+    'unsignedByte': (1, 'B'),
+    'short': (2, 'h'),
+    'int': (4, 'i'),
+    'long': (8, 'q'),
+    'char': (1, 's'),
+    'unicodeChar': (2, 's'),
+    'float': (4, 'f'),
+    'double': (8, 'd'),
+    'floatComplex': (8, 'ff'),
+    'doubleComplex': (16, 'dd'),
+}
+
+ManifestEntry = namedtuple('ManifestEntry', ('user', 'week', 'file_name', 'access_url'))
+
+
+class VOTableError(ValueError):
+    pass
+
+
+def _local(tag) -> str:
+    '''
+    Tag name without its namespace: VOTable 1.1 to 1.5 only differ by namespace URI
+    (or have none at all).
+    '''
+    return tag.rsplit('}', 1)[-1]
+
+
+class _Field:
+    def __init__(self, attrib):
+        self.name = attrib.get('name') or attrib.get('ID')
+        self.datatype = attrib.get('datatype', 'char')
+        if self.datatype not in BINARY_TYPES and self.datatype != 'bit':
+            raise VOTableError(f"Unknown datatype '{self.datatype}' of field {self.name}")
+        arraysize = attrib.get('arraysize')
+        self.variable = arraysize is not None and arraysize.endswith('*')
+        self.count = 1
+        if arraysize is not None and not self.variable:
+            for size in arraysize.split('x'):
+                self.count *= int(size.rstrip('*') or 1)
+
+    def read(self, data, offset):
+        '''
+        Decodes the value of the field at data[offset:], returns (value, new offset).
+        '''
+        count = self.count
+        if self.variable:
+            count = struct.unpack_from('>I', data, offset)[0]
+            offset += 4
+        if self.datatype == 'bit':
+            size = (count + 7) // 8
+            return data[offset:offset + size], offset + size
+        item_size, code = BINARY_TYPES[self.datatype]
+        size = item_size * count
+        raw = data[offset:offset + size]
+        if len(raw) < size:
+            raise VOTableError("Truncated BINARY stream")
+        offset += size
+        if self.datatype == 'char':
+            return raw.split(b'\0', 1)[0].decode('ascii', errors='replace'), offset
+        if self.datatype == 'unicodeChar':
+            return raw.decode('utf-16-be').split('\0', 1)[0], offset
+        if self.datatype == 'boolean':
+            values = [None if c in b'?\0 ' else c in b'Tt1' for c in raw]
+        else:
+            values = list(struct.unpack(f">{count * len(code)}{code[0]}", raw))
+            if len(code) == 2:
+                values = [complex(re, im) for re, im in zip(values[::2], values[1::2])]
+        return (values[0] if count == 1 and not self.variable else values), offset
+
+
+def _binary_rows(fields, data, nullable):
+    '''
+    Rows of a decoded BINARY (or BINARY2, with nullable=True) stream, as dictionaries.
+    '''
+    offset = 0
+    mask_size = (len(fields) + 7) // 8
+    while offset < len(data):
+        nulls = data[offset:offset + mask_size] if nullable else b''
+        offset += len(nulls)
+        row = {}
+        for i, field in enumerate(fields):
+            value, offset = field.read(data, offset)
+            if nullable and nulls[i // 8] & (0x80 >> (i % 8)):
+                value = None
+            row[field.name] = value
+        yield row
+
+
+def iter_rows(source):
+    '''
+    Parses a VOTable incrementally and yields its rows.
+
+    Elements are discarded as soon as they are read, so memory does not grow with the
+    number of rows of TABLEDATA tables. TABLEDATA, BINARY and BINARY2 serializations
+    are supported, the latter two when the STREAM is inline and base64 encoded.
+
+    Parameters:
+    ----------
+        source: File name or binary file-like object, e.g. the stream of a request body.
+
+    Returns:
+    -------
+        Iterator of dictionaries mapping the field names to the values of each row:
+        strings for TABLEDATA cells (None when empty), decoded values for BINARY rows.
+
+    Raises:
+    ------
+        VOTableError: The document is not well-formed or its tables cannot be read.
+    '''
+    fields = []
+    parents = []
+    try:
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            tag = _local(elem.tag)
+            if event == 'start':
+                if tag == 'TABLE':
+                    fields = []
+                parents.append(elem)
+                continue
+            parents.pop()
+            if tag == 'FIELD':
+                fields.append(_Field(elem.attrib))
+            elif tag == 'TR':
+                cells = [td.text for td in elem if _local(td.tag) == 'TD']
+                yield {field.name: (cells[i] if i < len(cells) else None) for i, field in enumerate(fields)}
+            elif tag == 'STREAM':
+                if elem.get('href'):
+                    raise VOTableError("External STREAM references are not supported")
+                encoding = elem.get('encoding', 'base64')
+                if encoding != 'base64':
+                    raise VOTableError(f"Unsupported STREAM encoding '{encoding}'")
+                yield from _binary_rows(fields, base64.b64decode(elem.text or ''),
+                                       bool(parents) and _local(parents[-1].tag) == 'BINARY2')
+            else:
+                continue
+            # Rows and streams are consumed: drop them from the tree.
+            elem.clear()
+            if parents:
+                parents[-1].remove(elem)
+    except ET.ParseError as e:
+        raise VOTableError(f"Invalid VOTable: {e}") from e
+
+
+def iter_manifest(source):
+    '''
+    Yields the weekly files listed by a VOTable manifest (see iter_rows), as soon as they
+    are parsed.
+
+    Parameters:
+    ----------
+        source: File name or binary file-like object.
+
+    Returns:
+    -------
+        Iterator of ManifestEntry(user, week, file_name, access_url); file_name is the
+        'did_name' of the row, with a '.fits' suffix added when it has none.
+
+    Raises:
+    ------
+        VOTableError: The document cannot be read or a row lacks a manifest column.
+    '''
+    for row in iter_rows(source):
+        missing = [name for name in MANIFEST_FIELDS if name not in row]
+        if missing:
+            raise VOTableError(f"Missing VOTable fields: {missing}")
+        did_name = str(row['did_name'] or '')
+        if not did_name or not row['access_url']:
+            continue
+        file_name = did_name if did_name.endswith('.fits') else did_name + '.fits'
+        yield ManifestEntry(row['user'], str(row['week']), file_name, row['access_url'])
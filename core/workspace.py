@@ -0,0 +1,367 @@
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+from .config import TMP_ROOT, WORKSPACE_BUDGET, WORKSPACE_USER_QUOTA, WORKSPACE_MIN_IDLE, WORKSPACE_EVICTION_INTERVAL
+from .metrics import registry
+
+WORKSPACE_FILE = '.workspace.json'
+# Workspace ids are url-safe tokens (e.g. Fernet tokens): no separators, no leading dot.
+WORKSPACE_ID = re.compile(r'^[A-Za-z0-9_\-=][A-Za-z0-9_\-=.]*$')
+# File of the workspaces created before the manager, which are adopted on their first scan.
+LEGACY_MARKER = 'files_dict.json'
+
+
+class AtomicOutput:
+    '''
+    Temporary path next to an output file, renamed to the output file by commit() and
+    removed by discard(): readers never see a partially written file. For writers whose
+    output outlives a with block (e.g. fitsio.StreamingTableWriter); see atomic_output.
+    '''
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.tmp_path = f"{output_file}.{uuid.uuid4().hex}.tmp"
+
+    def commit(self):
+        os.replace(self.tmp_path, self.output_file)
+
+    def discard(self):
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self.tmp_path
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.commit()
+        finally:
+            self.discard()
+        return False
+
+
+def atomic_output(output_file) -> AtomicOutput:
+    '''
+    Yields a temporary path next to output_file, renamed to output_file when the block
+    completes and removed if it fails: readers never see a partially written file.
+
+    Usage:
+    -----
+        with atomic_output(path) as tmp_path:
+            write(tmp_path)
+    '''
+    return AtomicOutput(output_file)
+
+
+def owner_key(user):
+    '''
+    Key of the owner of a workspace: a hash of the user, so that the (web-served)
+    workspace marker does not reveal it. None if the user is unknown.
+    '''
+    return hashlib.sha256(str(user).encode()).hexdigest()[:16] if user else None
+
+
+class WorkspaceUsage:
+    '''
+    Disk usage of a workspace, as of the last scan.
+    '''
+
+    def __init__(self, workspace_id, owner, created, last_used, size, n_files):
+        self.id = workspace_id
+        self.owner = owner
+        self.created = created
+        self.last_used = last_used
+        self.size = size
+        self.n_files = n_files
+
+    def to_dict(self) -> dict:
+        return {'size': self.size, 'files': self.n_files, 'created': self.created, 'last_used': self.last_used}
+
+
+class WorkspaceManager:
+    '''
+    Lifecycle of the user workspaces, the directories of TMP_ROOT holding the downloaded
+    weeks, merged files, filter outputs and plots of a VO submission.
+
+    A workspace is created with its owner (see create) and touched whenever a request
+    uses it (see open). A background thread, started on first use, evicts the least
+    recently used workspaces while the workspaces exceed the global budget or the
+    workspaces of an owner exceed the user quota. Workspaces used in the last min_idle
+    seconds, or with unfinished jobs (see in_use), are never evicted. An evicted
+    workspace is first renamed out of the way, so requests never see it half deleted.
+
+    Files hard-linked from elsewhere (e.g. the weekly-file store or the stage cache)
+    are charged in proportion to their links: evicting a workspace only frees its share.
+    '''
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, root=TMP_ROOT, budget=WORKSPACE_BUDGET, user_quota=WORKSPACE_USER_QUOTA,
+                 min_idle=WORKSPACE_MIN_IDLE, interval=WORKSPACE_EVICTION_INTERVAL, in_use=None):
+        '''
+        Parameters:
+        ----------
+            root: Directory of the workspaces.
+            budget: Disk budget of all the workspaces, in bytes (0 disables it).
+            user_quota: Disk quota of the workspaces of each owner, in bytes (0 disables it).
+            min_idle: Seconds since the last use before a workspace can be evicted.
+            interval: Seconds between two eviction passes of the background thread.
+            in_use: Optional callable(workspace_id) returning True while the workspace
+                has unfinished jobs.
+        '''
+        self.root = root
+        self.budget = budget
+        self.user_quota = user_quota
+        self.min_idle = min_idle
+        self.interval = interval
+        self.in_use = in_use or (lambda workspace_id: False)
+        self.evicted = 0
+        self.evicted_bytes = 0
+        self._usage = {}
+        self._scanned = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def valid_id(workspace_id) -> bool:
+        return bool(workspace_id) and WORKSPACE_ID.match(workspace_id) is not None
+
+    def path(self, workspace_id) -> str:
+        '''
+        Directory of a workspace.
+
+        Raises:
+        ------
+            ValueError if the id is not a valid workspace id (e.g. it contains a path).
+        '''
+        if not self.valid_id(workspace_id):
+            raise ValueError(f"Invalid workspace id '{workspace_id}'")
+        return os.path.join(self.root, workspace_id)
+
+    def create(self, workspace_id, user=None) -> str:
+        '''
+        Creates a workspace owned by user, returns its directory. Workspaces without a
+        known user are only subject to the global budget.
+        '''
+        path = self.path(workspace_id)
+        os.makedirs(path, exist_ok=True)
+        now = time.time()
+        with atomic_output(os.path.join(path, WORKSPACE_FILE)) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump({'owner': owner_key(user), 'created': now}, f)
+        self.start()
+        return path
+
+    def open(self, workspace_id):
+        '''
+        Returns the directory of an existing workspace and marks it as used, or None if
+        the id is invalid or the workspace does not exist (e.g. it was evicted).
+        '''
+        try:
+            path = self.path(workspace_id)
+        except ValueError:
+            return None
+        if not os.path.isdir(path):
+            return None
+        self.touch(workspace_id)
+        self.start()
+        return path
+
+    def touch(self, workspace_id):
+        '''
+        Marks a workspace as used now; workspaces created before the manager are adopted.
+        '''
+        marker = os.path.join(self.path(workspace_id), WORKSPACE_FILE)
+        try:
+            os.utime(marker)
+        except FileNotFoundError:
+            if os.path.isdir(os.path.dirname(marker)):
+                self.create(workspace_id)
+
+    def _read_marker(self, path):
+        marker = os.path.join(path, WORKSPACE_FILE)
+        try:
+            with open(marker) as f:
+                meta = json.load(f)
+            return meta.get('owner'), meta.get('created'), os.path.getmtime(marker)
+        except (OSError, ValueError):
+            return None
+
+    def _measure(self, workspace_id):
+        path = os.path.join(self.root, workspace_id)
+        marker = self._read_marker(path)
+        if marker is None:
+            # Workspaces created before the manager: adopted, owner unknown.
+            if not os.path.exists(os.path.join(path, LEGACY_MARKER)):
+                return None
+            self.create(workspace_id)
+            marker = self._read_marker(path)
+            if marker is None:
+                return None
+        owner, created, last_used = marker
+        size, n_files = 0, 0
+        for dir_path, _, file_names in os.walk(path):
+            for file_name in file_names:
+                try:
+                    stat = os.stat(os.path.join(dir_path, file_name))
+                except FileNotFoundError:
+                    continue
+                size += stat.st_size // max(stat.st_nlink, 1)
+                n_files += 1
+        return WorkspaceUsage(workspace_id, owner, created, last_used, size, n_files)
+
+    def scan(self) -> list:
+        '''
+        Measures all the workspaces.
+
+        Returns:
+        -------
+            List of WorkspaceUsage, least recently used first.
+        '''
+        workspaces = []
+        for workspace_id in os.listdir(self.root) if os.path.isdir(self.root) else []:
+            if not self.valid_id(workspace_id) or not os.path.isdir(os.path.join(self.root, workspace_id)):
+                continue
+            try:
+                usage = self._measure(workspace_id)
+            except OSError:
+                continue
+            if usage is not None:
+                workspaces.append(usage)
+        workspaces.sort(key=lambda usage: usage.last_used)
+        with self._lock:
+            self._usage = {usage.id: usage for usage in workspaces}
+            self._scanned = time.time()
+        self._publish()
+        return workspaces
+
+    def _publish(self):
+        with self._lock:
+            workspaces = list(self._usage.values())
+        registry.set('fermifilters_workspaces', len(workspaces))
+        registry.set('fermifilters_workspace_bytes', sum(usage.size for usage in workspaces))
+
+    def _evictable(self, usage, now) -> bool:
+        return now - usage.last_used >= self.min_idle and not self.in_use(usage.id)
+
+    def evict(self) -> list:
+        '''
+        Removes the least recently used idle workspaces until every owner fits in the
+        user quota and all the workspaces fit in the budget.
+
+        Returns:
+        -------
+            Ids of the evicted workspaces.
+        '''
+        workspaces = self.scan()
+        now = time.time()
+        evicted = []
+        if self.user_quota:
+            owners = {}
+            for usage in workspaces:
+                owners[usage.owner] = owners.get(usage.owner, 0) + usage.size
+            for usage in workspaces:
+                if usage.owner is not None and owners[usage.owner] > self.user_quota and self._evictable(usage, now) and self._remove(usage):
+                    owners[usage.owner] -= usage.size
+                    evicted.append(usage.id)
+        if self.budget:
+            total = sum(usage.size for usage in workspaces if usage.id not in evicted)
+            for usage in workspaces:
+                if total <= self.budget:
+                    break
+                if usage.id not in evicted and self._evictable(usage, now) and self._remove(usage):
+                    total -= usage.size
+                    evicted.append(usage.id)
+        if evicted:
+            self._publish()
+        return evicted
+
+    def _remove(self, usage) -> bool:
+        path = os.path.join(self.root, usage.id)
+        # Re-read the last use: the workspace may have been opened since the scan.
+        marker = self._read_marker(path)
+        if marker is None or time.time() - marker[2] < self.min_idle:
+            return False
+        trash = os.path.join(self.root, f".evicted.{usage.id}.{uuid.uuid4().hex}")
+        try:
+            os.rename(path, trash)
+        except OSError:
+            # Already evicted by another process.
+            return False
+        shutil.rmtree(trash, ignore_errors=True)
+        with self._lock:
+            self._usage.pop(usage.id, None)
+            self.evicted += 1
+            self.evicted_bytes += usage.size
+        registry.inc('fermifilters_workspace_evictions_total')
+        registry.inc('fermifilters_workspace_evicted_bytes_total', usage.size)
+        self.logger.info(" workspaces: evicted %s (%d bytes, unused for %.0f s)", usage.id, usage.size, time.time() - usage.last_used)
+        return True
+
+    def usage(self, workspace_id=None) -> dict:
+        '''
+        Usage statistics of the workspaces, as of the last scan (done now if there was
+        none yet): totals, budget, quota and evictions, plus the usage of one workspace
+        and of its owner if an id is given.
+        '''
+        if self._scanned is None:
+            self.scan()
+        with self._lock:
+            workspaces = list(self._usage.values())
+            evicted, evicted_bytes, scanned = self.evicted, self.evicted_bytes, self._scanned
+        stats = {'scanned': scanned,
+                 'workspaces': len(workspaces),
+                 'owners': len({usage.owner for usage in workspaces if usage.owner is not None}),
+                 'size': sum(usage.size for usage in workspaces),
+                 'budget': self.budget,
+                 'user_quota': self.user_quota,
+                 'evicted': evicted,
+                 'evicted_bytes': evicted_bytes}
+        if workspace_id is not None:
+            usage = next((usage for usage in workspaces if usage.id == workspace_id), None)
+            if usage is not None:
+                stats['workspace'] = usage.to_dict()
+                if usage.owner is not None:
+                    stats['owner_size'] = sum(other.size for other in workspaces if other.owner == usage.owner)
+        return stats
+
+    def request_eviction(self):
+        '''
+        Wakes the background thread up, e.g. after a job wrote new files.
+        '''
+        self.start()
+        self._wakeup.set()
+
+    def start(self):
+        '''
+        Starts the eviction thread, if not running yet.
+        '''
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._loop, name='fermifilters-workspaces', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            try:
+                self.evict()
+            except Exception:
+                self.logger.exception(" workspaces: eviction failed")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
@@ -4,41 +4,103 @@ sys.path.insert(0, str(Path(__file__).parent))
 import json
 import os
 import logging
-import zipfile
-import io
 import uuid
-from flask import Blueprint, render_template, request, jsonify, session, send_file
+import itertools
+from queue import Queue
+from flask import Blueprint, Response, g, render_template, request, jsonify, session, send_file
 from cryptography.fernet import Fernet
-from FermiFilters.core.config import TMP_DIR
+from FermiFilters.core.archive import ARCHIVE_STAGES, archive_files, archive_path, stream_zip
+from FermiFilters.core.config import STORE_DIR, TMP_ROOT, WARMUP
 from FermiFilters.core.engine import FiltersEngine
+from FermiFilters.core.jobs import JobManager
+from FermiFilters.core.lazy import warm_up
+from FermiFilters.core.memo import STAGE_CACHE_DIR, StageCache
+from FermiFilters.core import metrics
+from FermiFilters.core.pipeline import FilterPipeline
+from FermiFilters.core.skymap import encode_counts, hp, load_count_map, map_levels, nested_counts
 from FermiFilters.core.utils import Plotter, FitsReader, FilesHandler, VOHandler
+from FermiFilters.core.votable import VOTableError
+from FermiFilters.core.workspace import WorkspaceManager, atomic_output
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
 
 
 fermifilters = Blueprint('FermiFilters', __name__)
 fermifilters.secret_key = '1234'
+jobs = JobManager()
+# Workspaces with unfinished jobs are never evicted.
+workspaces = WorkspaceManager(in_use=jobs.active)
+if WARMUP:
+    fermifilters.record_once(lambda state: warm_up(background=True))
+# Filter stages whose outputs can be plotted, in pipeline order.
+SKYMAP_STAGES = ('select', 'mktime', 'ecliptic_cut')
+
+@fermifilters.before_request
+def begin_trace():
+    '''
+    Traces every request (see core.metrics): the X-Request-ID header, if it is a valid
+    unused id, names the trace (the id used is returned in the response header), and
+    '?profile=1' writes cProfile statistics of the request and of its jobs.
+    '''
+    g.trace = metrics.begin_request(request.endpoint or request.path, request.headers.get('X-Request-ID'),
+                                    request.args.get('profile', '0') in ('1', 'true', 'on'))
+
+@fermifilters.after_request
+def end_trace(response):
+    token = g.pop('trace', None)
+    if token is not None:
+        trace = metrics.end_request(token, response.status_code)
+        response.headers['X-Request-ID'] = trace.request_id
+    return response
+
+@fermifilters.teardown_request
+def end_failed_trace(error=None):
+    # after_request is skipped when the view raises.
+    token = g.pop('trace', None)
+    if token is not None:
+        metrics.end_request(token, 500)
 
 @fermifilters.route('/tool', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
         ct = request.headers.get('Content-Type', '')
         if 'xml' in ct:
-            vo_text = request.data.decode('utf-8', errors='ignore')
-            user_path, files_dict = VOHandler().get_files_dict(vo_text)
-            if not user_path:
-                user_path = os.path.dirname(TMP_DIR)
+            # The body is parsed as it is received; with a weekly-file store, the files
+            # are prefetched while the rest of the manifest is still being parsed.
+            entries = VOHandler().iter_files(request.stream)
+            try:
+                first = next(entries, None)
+            except VOTableError as e:
+                return jsonify({"error": str(e)}), 400
+            user = first.user if first is not None else None
+            user_path = user or TMP_ROOT
             secret_key = Fernet.generate_key()
             f = Fernet(secret_key)
             encrypted_key = f.encrypt(user_path.encode()).decode()
-            user_path = os.path.join(os.path.dirname(TMP_DIR), encrypted_key)
+            user_path = workspaces.create(encrypted_key, user)
             files_dict_path = os.path.join(user_path, 'files_dict.json')
-            os.makedirs(user_path, exist_ok=True)
-            with open(files_dict_path, 'w') as f:
-                json.dump(files_dict, f)
+            queue = Queue()
+            prefetch = None
+            if STORE_DIR and first is not None:
+                prefetch = jobs.submit('prefetch', prefetch_job, iter(queue.get, None), user_path,
+                                       stages=('download',), group=encrypted_key)
+            files_dict = {}
+            try:
+                for entry in itertools.chain([first] if first is not None else [], entries):
+                    files_dict.setdefault(entry.week, {})[entry.file_name] = entry.access_url
+                    queue.put(entry)
+            except VOTableError as e:
+                if prefetch is not None:
+                    jobs.cancel(prefetch.id)
+                return jsonify({"error": str(e)}), 400
+            finally:
+                queue.put(None)
+            with atomic_output(files_dict_path) as tmp_path:
+                with open(tmp_path, 'w') as f:
+                    json.dump(files_dict, f)
             return jsonify({'status': 'ok', 'id': encrypted_key})
         else:
-            return render_template('error.html', error_message="Invalid content type: expected a VO table in XML format.")
+            return jsonify({"error": "Invalid content type: expected a VO table in XML format."}), 415
         
     elif request.method == 'GET':
         id = request.args.get('id', None)
@@ -46,52 +108,149 @@ def index():
                 id=id
                 )
 
+def unknown_workspace():
+    return jsonify({"error": "Unknown or expired workspace."}), 404
+
+def plot_url_for(plot_filename):
+    if plot_filename and os.path.exists(plot_filename):
+        # Calculate relative URL from static directory
+        static_dir = os.path.join(os.path.dirname(__file__), 'static')
+        rel_path = os.path.relpath(plot_filename, static_dir)
+        return f"/static/{rel_path.replace(os.sep, '/')}"
+    return None
+
+
+def prefetch_job(job, entries, user_path):
+    '''
+    Downloads the files of a VO table while /tool is still parsing it.
+    '''
+    with job.stage('download'):
+        results = FilesHandler().prefetch(entries, user_path)
+    return {'downloaded': sum(results.values()), 'failed': len(results) - sum(results.values())}
+
+
+def process_vo_job(job, user_path, files_dict):
+    '''
+    Downloads, merges, plots and reads the metadata of the files of a VO table.
+    '''
+    sizes = {}
+
+    def download_progress(file_name, done, total):
+        sizes[file_name] = (done, total or done)
+        job.progress('download', sum(d for d, _ in sizes.values()) / max(sum(t for _, t in sizes.values()), 1))
+
+    with job.stage('download'):
+        fts_list = FilesHandler().download_from_url(files_dict, user_path, progress_callback=download_progress)
+    weeks_list = list(files_dict.keys())
+    ft1_list = fts_list['photon']
+    ft2_list = fts_list['spacecraft']
+    if not ft1_list or not ft2_list:
+        raise RuntimeError("Download of the FT1/FT2 files failed.")
+    with job.stage('merge'):
+        if len(ft1_list) > 1:
+            ft1_output_filepath = os.path.join(user_path, f"merged_photon_{'_'.join(weeks_list)}.fits")
+            FiltersEngine().gtmerge(ft1_list, ft1_output_filepath, user_path)
+            ft1_file = ft1_output_filepath
+            job.progress('merge', 0.5)
+            ft2_output_filepath = os.path.join(user_path, f"merged_spacecraft_{'_'.join(weeks_list)}.fits")
+            FiltersEngine().ft2_merge(ft2_list, ft2_output_filepath)
+            ft2_file = ft2_output_filepath
+        else:
+            ft1_file = ft1_list[0]
+            ft2_file = ft2_list[0]
+    plot_filename = os.path.join(user_path, "plot.png")
+    with job.stage('plot'):
+        if hp is not None:
+            # The browser draws the count map (see /skymap); the PNG is rendered on export.
+            load_count_map(ft1_file)
+        else:
+            Plotter().plot_ft_data([ft1_file], x='RA', y='DEC', plot_filename=plot_filename, coord='G', projection='mollweide')
+    with job.stage('metadata'):
+        info_dict_ft1 = FitsReader().read_info_from_ft1(ft1_file)
+        info_dict_ft2 = FitsReader().read_info_from_ft2(ft2_file)
+    return {'info_dict_ft1': info_dict_ft1,
+            'info_dict_ft2': info_dict_ft2,
+            'ft1_file_name': ft1_file,
+            'ft2_file_name': ft2_file,
+            'plot_filename': plot_filename,
+            'plot_url': plot_url_for(plot_filename)}
+
+
 @fermifilters.route('/process_vo', methods=['GET'])
 def process_vo():
     id = request.args.get('id')
-    user_path = os.path.join(os.path.dirname(TMP_DIR), id)
+    user_path = workspaces.open(id)
+    if user_path is None:
+        return unknown_workspace()
     files_dict_path = os.path.join(user_path, 'files_dict.json')
     with open(files_dict_path, 'r') as f:
         files_dict = json.load(f)
-    fts_list = FilesHandler().download_from_url(files_dict, user_path)
-    weeks_list = list(files_dict.keys())
-    ft1_list = fts_list['photon']
-    ft2_list = fts_list['spacecraft']
-    if len(ft1_list) > 1:
-        ft1_output_filepath = os.path.join(user_path, f"merged_photon_{'_'.join(weeks_list)}.fits")
-        FiltersEngine().gtmerge(ft1_list, ft1_output_filepath, user_path)
-        ft1_file = ft1_output_filepath
-        ft2_output_filepath = os.path.join(user_path, f"merged_spacecraft_{'_'.join(weeks_list)}.fits")
-        FiltersEngine().ft2_merge(ft2_list, ft2_output_filepath)
-        ft2_file = ft2_output_filepath
-    else:
-        ft1_file = ft1_list[0]
-        ft2_file = ft2_list[0]
-    plot_filename = os.path.join(user_path, "plot.png")
-    Plotter().plot_ft_data([ft1_file], x='RA', y='DEC', plot_filename=plot_filename, coord='G', projection='mollweide')
-    info_dict_ft1 = FitsReader().read_info_from_ft1(ft1_file)
-    info_dict_ft2 = FitsReader().read_info_from_ft2(ft2_file)
-    plot_url = None
-    if os.path.exists(plot_filename):
-        # Calculate relative URL from static directory
-        static_dir = os.path.join(os.path.dirname(__file__), 'static')
-        rel_path = os.path.relpath(plot_filename, static_dir)
-        plot_url = f"/static/{rel_path.replace(os.sep, '/')}"
-    session['ft1_file_name'] = ft1_file
-    session['ft2_file_name'] = ft2_file
-    session['plot_url'] = plot_filename  # Keep filesystem path in session for internal use
+    job = jobs.submit('process_vo', process_vo_job, user_path, files_dict,
+                      stages=('download', 'merge', 'plot', 'metadata'), group=id, supersede=True)
+    job.future.add_done_callback(lambda future: workspaces.request_eviction())
+    return jsonify({'job_id': job.id})
+
+@fermifilters.route('/process_vo/result', methods=['GET'])
+def process_vo_result():
+    job = jobs.get(request.args.get('job_id'))
+    if job is None or job.kind != 'process_vo':
+        return jsonify({"error": "Unknown or expired job."}), 404
+    if job.status != 'done':
+        return jsonify({"error": job.error or f"Job is {job.status}.", "status": job.status}), 409
+    result = job.result
+    session['ft1_file_name'] = result['ft1_file_name']
+    session['ft2_file_name'] = result['ft2_file_name']
+    session['plot_url'] = result['plot_filename']  # Keep filesystem path in session for internal use
     return render_template('template.html',
-                            info_dict_ft1=info_dict_ft1,
-                            info_dict_ft2=info_dict_ft2,
-                            ft1_file_name=ft1_file,
-                            ft2_file_name=ft2_file,
-                            plot_url=plot_url,
-                            id=id)
+                            info_dict_ft1=result['info_dict_ft1'],
+                            info_dict_ft2=result['info_dict_ft2'],
+                            ft1_file_name=result['ft1_file_name'],
+                            ft2_file_name=result['ft2_file_name'],
+                            plot_url=result['plot_url'],
+                            skymap=hp is not None,
+                            id=job.group)
+
+
+def apply_filters_job(job, stages, ft1_filepath, ft2_filepath, user_path, ft1_filename, plot_filename,
+                      plot_coord, plot_projection, update_plot, keep_intermediate):
+    '''
+    Runs the filter stages and re-plots the input and filtered files: with healpy, the
+    count maps drawn by the browser are built (see /skymap) and the PNG is only rendered
+    by /export_plot.
+    '''
+    stage_errors = {
+        'select': "Error during gtselect on FT1.",
+        'mktime': "Error during gtmktime.",
+        'ecliptic_cut': "Error during ecliptic cut.",
+    }
+    pipeline = FilterPipeline(cache=StageCache(os.path.join(user_path, STAGE_CACHE_DIR)))
+    outputs = pipeline.run(stages, ft1_filepath, ft2_filepath, user_path, keep_intermediate=keep_intermediate,
+                           ft1_filename=ft1_filename, progress_callback=job.progress)
+    job.check_cancelled()
+    if outputs is None:
+        job.end(pipeline.failed_stage, 'failed')
+        raise RuntimeError(stage_errors[pipeline.failed_stage])
+    for stage in stages:
+        job.end(stage.name)
+    plots_list = [ft1_filepath] + list(outputs.values())
+    if update_plot:
+        with job.stage('plot'):
+            if hp is not None:
+                for i, ft_file in enumerate(plots_list):
+                    load_count_map(ft_file)
+                    job.progress('plot', (i + 1) / len(plots_list))
+                return {"plot_url": None, "skymaps": ['input'] + list(outputs)}
+            Plotter().plot_ft_data(plots_list, x='RA', y='DEC', plot_filename=plot_filename, coord=plot_coord, projection=plot_projection)
+    # TO BE CHECKED
+    return {"plot_url": plot_url_for(plot_filename)}
+
 
 @fermifilters.route('/apply_filters', methods=['POST'])
 def apply_filters():
     id = request.form.get('id', None)
-    user_path = os.path.join(os.path.dirname(TMP_DIR), id)
+    user_path = workspaces.open(id)
+    if user_path is None:
+        return unknown_workspace()
     plot_filename = session.get('plot_url')
     ft1_filepath = session.get('ft1_file_name')
     ft2_filepath = session.get('ft2_file_name')
@@ -102,58 +261,272 @@ def apply_filters():
     plot_coord = request.form.get('plot_coord', 'G')
     plot_projection = request.form.get('plot_projection', 'mollweide')
     update_plot = True # request.form.get('update_plot', 'off') == 'on'
-    select_output_filepath = os.path.join(user_path, f"select_{ft1_filename}")
-    mktime_output_filepath = os.path.join(user_path, f"mktime_{ft1_filename}")
-    ecliptic_cut_output_filepath = os.path.join(user_path, f"ecliptic_cut_{ft1_filename}")
+    keep_intermediate = request.form.get('keep_intermediate', 'off') == 'on'
     if not select_dict and not maketime_dict and not ecliptic_cut_dict:
         return jsonify({"plot_url": None})
-    plots_list = [ft1_filepath]
-    if select_dict:
-        if not FiltersEngine().gtselect(select_dict, ft1_filepath, select_output_filepath):
-            return jsonify({"error": "Error during gtselect on FT1."})
-        if update_plot:
-            plots_list.append(select_output_filepath)
-        ft1_filepath = select_output_filepath
-    if maketime_dict:
-        if not FiltersEngine().gtmktime(maketime_dict, ft1_filepath, ft2_filepath, mktime_output_filepath):
-            return jsonify({"error": "Error during gtmktime."})
-        if update_plot:
-            plots_list.append(mktime_output_filepath)
-        ft1_filepath = mktime_output_filepath
-    if ecliptic_cut_dict:
-        if not FiltersEngine().ecliptic_cut(ecliptic_cut_dict, ft1_filepath, ft2_filepath, ecliptic_cut_output_filepath):
-            return jsonify({"error": "Error during ecliptic cut."})
-        if update_plot:
-            plots_list.append(ecliptic_cut_output_filepath)
-    if update_plot:
-        Plotter().plot_ft_data(plots_list, x='RA', y='DEC', plot_filename=plot_filename, coord=plot_coord, projection=plot_projection)
-    # TO BE CHECKED
-    if plot_filename and os.path.exists(plot_filename):
-        static_dir = os.path.join(os.path.dirname(__file__), 'static')
-        rel_path = os.path.relpath(plot_filename, static_dir)
-        plot_url_response = f"/static/{rel_path.replace(os.sep, '/')}"
+    try:
+        stages = FilterPipeline.build_stages(select_dict, maketime_dict, ecliptic_cut_dict)
+    except ValueError as e:
+        return jsonify({"error": str(e)})
+    stage_names = [stage.name for stage in stages] + (['plot'] if update_plot else [])
+    job = jobs.submit('apply_filters', apply_filters_job, stages, ft1_filepath, ft2_filepath, user_path,
+                      ft1_filename, plot_filename, plot_coord, plot_projection, update_plot, keep_intermediate,
+                      stages=stage_names, group=id, supersede=True)
+    job.future.add_done_callback(lambda future: workspaces.request_eviction())
+    return jsonify({"job_id": job.id})
+
+
+def skymap_file(user_path, stage):
+    '''
+    Returns the FT1 file of the session plotted for a stage ('input' or a filter stage),
+    or None if it does not exist.
+    '''
+    ft1_filepath = session.get('ft1_file_name')
+    if not ft1_filepath:
+        return None
+    if stage == 'input':
+        ft_file = ft1_filepath
+    elif stage in SKYMAP_STAGES:
+        ft_file = FilterPipeline.output_path(user_path, stage, os.path.basename(ft1_filepath))
     else:
-        plot_url_response = None
-    return jsonify({"plot_url": plot_url_response})
+        return None
+    return ft_file if os.path.exists(ft_file) else None
+
+
+@fermifilters.route('/skymap', methods=['GET'])
+def skymap():
+    '''
+    Returns the binned count map of a stage as JSON, drawn by the browser (see static/skymap.js).
+
+    Query parameters: 'id' (workspace), 'stage' (input, select, mktime or ecliptic_cut;
+    default input), 'level' (index in 'levels', default the finest) and 'tile' (optional
+    HEALPix base pixel, 0-11). Counts are NESTED, in equatorial coordinates, encoded as
+    base64 little-endian unsigned integers of type 'dtype'. Responses carry an ETag of
+    the file version, so the browser revalidates them instead of downloading them again.
+    '''
+    if hp is None:
+        return jsonify({"error": "Sky maps need healpy."}), 501
+    id = request.args.get('id')
+    user_path = workspaces.open(id)
+    if user_path is None:
+        return unknown_workspace()
+    stage = request.args.get('stage', 'input')
+    ft_file = skymap_file(user_path, stage)
+    if ft_file is None:
+        return jsonify({"error": f"No sky map for stage {stage}."}), 404
+    levels = map_levels()
+    try:
+        level = int(request.args.get('level', len(levels) - 1))
+        tile = request.args.get('tile')
+        tile = int(tile) if tile is not None else None
+    except ValueError:
+        return jsonify({"error": "Invalid level or tile."}), 400
+    if not 0 <= level < len(levels) or (tile is not None and not 0 <= tile < 12):
+        return jsonify({"error": "Invalid level or tile."}), 400
+    stat = os.stat(ft_file)
+    etag = f"{stat.st_size:x}-{stat.st_mtime_ns:x}-{levels[level]}-{tile}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        nside = levels[level]
+        counts = nested_counts(load_count_map(ft_file), nside)
+        first = 0
+        if tile is not None:
+            first = tile * nside ** 2
+            counts = counts[first:first + nside ** 2]
+        dtype, data = encode_counts(counts)
+        response = jsonify({"stage": stage,
+                            "nside": nside,
+                            "ordering": "NESTED",
+                            "frame": "C",
+                            "levels": levels,
+                            "level": level,
+                            "tile": tile,
+                            "first": first,
+                            "total": int(counts.sum()),
+                            "max": int(counts.max()) if len(counts) else 0,
+                            "dtype": dtype,
+                            "counts": data})
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@fermifilters.route('/export_plot', methods=['GET'])
+def export_plot():
+    '''
+    Renders the PNG plot of the input and filtered files of the session.
+
+    Query parameters: 'id' (workspace), 'stages' (optional comma-separated list of the
+    stages plotted, default all the existing ones), 'plot_coord' and 'plot_projection'.
+    '''
+    id = request.args.get('id')
+    user_path = workspaces.open(id)
+    if user_path is None:
+        return unknown_workspace()
+    stages = [stage for stage in request.args.get('stages', '').split(',') if stage] or ['input'] + list(SKYMAP_STAGES)
+    plots_list = [ft_file for ft_file in (skymap_file(user_path, stage) for stage in stages) if ft_file]
+    if not plots_list:
+        return jsonify({"error": "Nothing to plot."}), 404
+    plot_filename = os.path.join(user_path, "plot.png")
+    Plotter().plot_ft_data(plots_list, x='RA', y='DEC', plot_filename=plot_filename,
+                           coord=request.args.get('plot_coord', 'G'),
+                           projection=request.args.get('plot_projection', 'mollweide'))
+    return send_file(plot_filename, mimetype='image/png', as_attachment=True, download_name='fermi_plot.png', max_age=0)
+
+
+def apply_sweep_job(job, variants, ft1_filepath, ft2_filepath, user_path, ft1_filename):
+    '''
+    Runs a parameter sweep and returns its summary table.
+    '''
+    pipeline = FilterPipeline()
+    summary = pipeline.run_sweep(variants, ft1_filepath, ft2_filepath, user_path, ft1_filename=ft1_filename,
+                                 progress_callback=job.progress)
+    job.check_cancelled()
+    if summary is None:
+        job.end('sweep', 'failed')
+        raise RuntimeError(f"Error during the sweep ({pipeline.failed_stage}).")
+    for row in summary:
+        row['output'] = os.path.basename(row['output'])
+    return {"summary": summary,
+            "summary_file": os.path.basename(FilterPipeline.sweep_summary_path(user_path, ft1_filename))}
+
+
+@fermifilters.route('/apply_sweep', methods=['POST'])
+def apply_sweep():
+    '''
+    Submits a parameter sweep: 'variants' is a JSON list of objects with optional
+    'select_dict', 'maketime_dict', 'ecliptic_cut_dict' and 'name' keys. The job
+    result holds the summary table of the event counts of every variant.
+    '''
+    id = request.form.get('id', None)
+    user_path = workspaces.open(id)
+    if user_path is None:
+        return unknown_workspace()
+    ft1_filepath = session.get('ft1_file_name')
+    ft2_filepath = session.get('ft2_file_name')
+    ft1_filename = os.path.basename(ft1_filepath)
+    variants = json.loads(request.form.get('variants', None) or '[]')
+    if not variants:
+        return jsonify({"error": "No variants given."})
+    try:
+        for variant in variants:
+            FilterPipeline.build_stages(variant.get('select_dict'), variant.get('maketime_dict'), variant.get('ecliptic_cut_dict'))
+    except ValueError as e:
+        return jsonify({"error": str(e)})
+    job = jobs.submit('apply_sweep', apply_sweep_job, variants, ft1_filepath, ft2_filepath, user_path, ft1_filename,
+                      stages=['sweep'], group=id)
+    return jsonify({"job_id": job.id})
+
+
+@fermifilters.route('/estimate', methods=['POST'])
+def estimate():
+    '''
+    Estimates the events left by the 'select_dict' and 'maketime_dict' cuts on the files
+    of the workspace 'id' (see FitsReader.estimate_selected_events).
+    '''
+    id = request.form.get('id', None)
+    user_path = workspaces.open(id)
+    if user_path is None:
+        return unknown_workspace()
+    ft1_filepath = session.get('ft1_file_name')
+    ft2_filepath = session.get('ft2_file_name')
+    if not ft1_filepath:
+        return jsonify({"error": "No FT1 file loaded."}), 400
+    select_dict = json.loads(request.form.get('select_dict', None) or '{}')
+    maketime_dict = json.loads(request.form.get('maketime_dict', None) or '{}')
+    if maketime_dict and not ft2_filepath:
+        return jsonify({"error": "No FT2 file loaded."}), 400
+    try:
+        return jsonify(FitsReader().estimate_selected_events(ft1_filepath, ft2_filepath, select_dict, maketime_dict))
+    except (ValueError, OSError) as e:
+        return jsonify({"error": str(e)}), 400
 
 
+@fermifilters.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job."}), 404
+    return jsonify(job.to_dict())
+
+@fermifilters.route('/jobs/<job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+    return jsonify({"cancelled": jobs.cancel(job_id)})
+
+@fermifilters.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job."}), 404
+
+    def stream():
+        version = None
+        while True:
+            new_version = job.wait(version, timeout=15)
+            if new_version == version and not job.is_finished:
+                yield ": keep-alive\n\n"
+                continue
+            version = new_version
+            yield f"data: {json.dumps(job.to_dict())}\n\n"
+            if job.is_finished:
+                return
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@fermifilters.route('/workspaces/usage', methods=['GET'])
+def workspaces_usage():
+    '''
+    Disk usage of the workspaces (see core.workspace.WorkspaceManager.usage), with the
+    usage of the workspace given by the optional 'id' query parameter.
+    '''
+    return jsonify(workspaces.usage(request.args.get('id')))
+
+@fermifilters.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    '''
+    Request and stage metrics in the Prometheus text format.
+    '''
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@fermifilters.route('/metrics/requests/<request_id>', methods=['GET'])
+def request_trace(request_id):
+    '''
+    Per-stage measurements of a recent request (the X-Request-ID of its response) and
+    of the jobs it submitted, with the paths of its profiles.
+    '''
+    trace = metrics.get_trace(request_id)
+    if trace is None:
+        return jsonify({"error": "Unknown or expired request."}), 404
+    return jsonify(trace)
+
 @fermifilters.route('/download_all')
 def download_all():
+    '''
+    Streams a ZIP archive of the workspace results.
+
+    Query parameters: 'id' (workspace), 'stages' (optional comma-separated list of
+    input, merged, select, mktime, ecliptic_cut, sweep, plot; default all) and 'zip64'
+    (optional, '1' to force ZIP64 records). The archive is saved while it is streamed;
+    once complete, the same request is served from the saved file, with Range support.
+    '''
     id = request.args.get('id')
-    user_path = os.path.join(os.path.dirname(TMP_DIR), id)
-    print(user_path)
-    files_to_zip = []
-    for fname in os.listdir(user_path):
-        if fname.endswith('.fits') or fname.endswith('.png'):
-            files_to_zip.append(os.path.join(user_path, fname))
-
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w') as zipf:
-        for file_path in files_to_zip:
-            print(file_path, os.path.basename(file_path))
-            zipf.write(file_path, arcname=os.path.basename(file_path))
-    zip_buffer.seek(0)
-    return send_file(zip_buffer, mimetype='application/zip', as_attachment=True, download_name='fermi_results.zip')
+    user_path = workspaces.open(id)
+    if user_path is None:
+        return unknown_workspace()
+    stages = [stage for stage in request.args.get('stages', '').split(',') if stage]
+    unknown = set(stages) - set(ARCHIVE_STAGES)
+    if unknown:
+        return jsonify({"error": f"Unknown stages: {sorted(unknown)}"}), 400
+    zip64 = request.args.get('zip64', '0') in ('1', 'true', 'on')
+    files_to_zip = archive_files(user_path, stages)
+    zip_path = archive_path(user_path, files_to_zip, zip64)
+    if os.path.exists(zip_path):
+        return send_file(zip_path, mimetype='application/zip', as_attachment=True,
+                         download_name='fermi_results.zip', conditional=True)
+    return Response(stream_zip(files_to_zip, zip_path, zip64), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename=fermi_results.zip'})
 
 if __name__ == '__main__':
     from flask import Flask
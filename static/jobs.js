@@ -0,0 +1,51 @@
+// Background jobs: follow the status of a job submitted to /process_vo or /apply_filters.
+const JOB_FINISHED_STATUSES = ['done', 'failed', 'cancelled'];
+
+// Calls onUpdate(job) at every change and resolves with the finished job.
+// Uses the server-sent events stream and falls back to polling if it is not available.
+function watchJob(jobId, onUpdate) {
+    return new Promise((resolve, reject) => {
+        const handle = (job) => {
+            if (onUpdate) onUpdate(job);
+            if (JOB_FINISHED_STATUSES.includes(job.status)) {
+                resolve(job);
+                return true;
+            }
+            return false;
+        };
+
+        const poll = () => {
+            fetch(`/jobs/${jobId}`)
+                .then(r => r.ok ? r.json() : Promise.reject(new Error(`HTTP ${r.status}`)))
+                .then(job => { if (!handle(job)) setTimeout(poll, 1000); })
+                .catch(reject);
+        };
+
+        if (!window.EventSource) {
+            poll();
+            return;
+        }
+        const source = new EventSource(`/jobs/${jobId}/events`);
+        source.onmessage = (event) => {
+            if (handle(JSON.parse(event.data))) source.close();
+        };
+        source.onerror = () => {
+            source.close();
+            poll();
+        };
+    });
+}
+
+function cancelJob(jobId) {
+    return fetch(`/jobs/${jobId}/cancel`, { method: 'POST' }).then(r => r.json());
+}
+
+// Renders the stages of a job (status, progress and time) inside an element.
+function renderJobStages(job, element) {
+    if (!element) return;
+    element.innerHTML = job.stages.map(stage => {
+        const percent = Math.round(100 * stage.progress);
+        const elapsed = stage.elapsed !== null ? ` (${stage.elapsed.toFixed(1)} s)` : '';
+        return `<div class="job-stage job-stage-${stage.status}">${stage.name}: ${stage.status} ${percent}%${elapsed}</div>`;
+    }).join('');
+}
@@ -1,6 +1,7 @@
 $(function() {
     const overlay = document.getElementById('loading-overlay');
     if (overlay) overlay.style.display = 'none';
+    if (skymapEnabled) updatePlot();
 
     for (const [col, info] of Object.entries(Object.assign({}, info_dict_ft2, info_dict_ft1))) {
         $(`#${col}_slider`).slider({
@@ -75,6 +76,8 @@ $(function() {
             const maketime_dict = $('#ft2_filters_dict').val();
             const ecliptic_cut_dict = $('#ecliptic_cut_dict').val();
             const update_plot = 'on'; //$('#update-plot-btn').is(':checked') ? 'on' : 'off';
+            // The outputs of the stages before the last one are only written on request.
+            const keep_intermediate = $('#keep-intermediate').is(':checked') ? 'on' : 'off';
             const plot_projection = $('#plot-projection').val();
             const plot_coord = $('#plot-coord').val();
             const id = $('#id').val();
@@ -86,30 +89,33 @@ $(function() {
                     select_dict: select_dict,
                     ecliptic_cut_dict: ecliptic_cut_dict,
                     update_plot: update_plot,
+                    keep_intermediate: keep_intermediate,
                     plot_projection: plot_projection,
                     plot_coord: plot_coord,
                     id: id
                 },
                 success: function(resp) {
-                    if (resp.error) {
-                        alert(resp.error);
-                    } else {
-                        if (resp.plot_url && update_plot === 'on') {
-                            $('#plot-image').attr('src', resp.plot_url + '?' + new Date().getTime()).show();
-                            $('#plot-case').html(`<img id="plot-image" src="${resp.plot_url + '?' + new Date().getTime()}" alt="Filtered Data Plot" style="max-width: 100%; max-height: 100%;">`);
-                        } else {
-                            $('#plot-case').html('<p>No available plot</p>');
-                        }
-
-                        let filtersApplied = [];
-                        if (filterExpr) filtersApplied.push(`Filters: ${filterExpr}`);
-                        // if (roicut === 'on') filtersApplied.push('ROI cut');
-
-                        $('#filter-info-text').text(filtersApplied
-                            ? filtersApplied.join(' | ')
-                            : 'No filters applied');
+                    if (!resp.job_id) {
+                        showFilterResult(resp, filterExpr, update_plot);
+                        overlay.style.display = 'none';
+                        return;
                     }
-                    overlay.style.display = 'none';
+                    // A newer submission supersedes this job on the server: only the latest one is followed.
+                    currentFilterJob = resp.job_id;
+                    watchJob(resp.job_id, function(job) {
+                        if (job.id === currentFilterJob) renderJobStages(job, document.getElementById('job-stages'));
+                    }).then(function(job) {
+                        if (job.id !== currentFilterJob) return;
+                        if (job.status === 'done') {
+                            showFilterResult(job.result, filterExpr, update_plot);
+                        } else if (job.status === 'failed') {
+                            alert(job.error || 'Error during plot update.');
+                        }
+                        overlay.style.display = 'none';
+                    }).catch(function() {
+                        alert('Error during plot update.');
+                        overlay.style.display = 'none';
+                    });
                 },
                 error: function() {
                     alert('Error during plot update.');
@@ -119,8 +125,70 @@ $(function() {
     });
 });
 
+var currentFilterJob = null;
+
+function showFilterResult(resp, filterExpr, update_plot) {
+    if (resp.error) {
+        alert(resp.error);
+        return;
+    }
+    if (resp.skymaps && update_plot === 'on') {
+        setSkyMapStages(resp.skymaps);
+    } else if (resp.plot_url && update_plot === 'on') {
+        $('#plot-image').attr('src', resp.plot_url + '?' + new Date().getTime()).show();
+        $('#plot-case').html(`<img id="plot-image" src="${resp.plot_url + '?' + new Date().getTime()}" alt="Filtered Data Plot" style="max-width: 100%; max-height: 100%;">`);
+    } else if (!skymapEnabled) {
+        $('#plot-case').html('<p>No available plot</p>');
+    }
+
+    let filtersApplied = [];
+    if (filterExpr) filtersApplied.push(`Filters: ${filterExpr}`);
+    // if (roicut === 'on') filtersApplied.push('ROI cut');
+
+    $('#filter-info-text').text(filtersApplied
+        ? filtersApplied.join(' | ')
+        : 'No filters applied');
+}
+
 function updatePlot() {
-    $('#apply-filters').click();
+    if (!skymapEnabled) {
+        $('#apply-filters').click();
+        return;
+    }
+    const stage = $('#plot-stage').val() || 'input';
+    const canvas = document.getElementById('skymap-canvas');
+    loadSkyMap(canvas, $('#id').val(), stage, () => $('#plot-projection').val(), () => $('#plot-coord').val(), function(map) {
+        currentSkyMap = map;
+        $('#skymap-info').text(`${stage}: ${map.total} events (nside ${map.nside})`);
+    }).catch(function() {
+        $('#skymap-info').text('No available plot');
+    });
+}
+
+var currentSkyMap = null;
+
+// Lists the stages with a sky map (the input and the filter outputs written) and draws the last one.
+function setSkyMapStages(stages) {
+    const select = $('#plot-stage').empty();
+    stages.forEach(stage => select.append($('<option>').val(stage).text(stage)));
+    select.val(stages[stages.length - 1]);
+    updatePlot();
+}
+
+// Projection and coordinate changes are drawn from the map already loaded.
+function redrawSkyMap() {
+    if (!skymapEnabled || !currentSkyMap) return;
+    drawSkyMap(document.getElementById('skymap-canvas'), currentSkyMap, $('#plot-projection').val(), $('#plot-coord').val());
+}
+
+function exportPlot() {
+    const params = new URLSearchParams({
+        id: $('#id').val(),
+        stages: $('#plot-stage option').map((i, option) => option.value).get().join(','),
+        plot_projection: $('#plot-projection').val(),
+        plot_coord: $('#plot-coord').val()
+    });
+    window.location.href = `/export_plot?${params}`;
 }
 
 function getResolution(info) {
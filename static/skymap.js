@@ -0,0 +1,219 @@
+// Sky maps: draws the binned count maps served by /skymap (NESTED HEALPix, equatorial)
+// on a canvas, so that projection and coordinate changes do not go back to the server.
+// Rotation from galactic to equatorial (J2000) unit vectors.
+const GALACTIC_TO_EQUATORIAL = [
+    [-0.0548755604162154, 0.4941094278755837, -0.8676661490190047],
+    [-0.8734370902348850, -0.4448296299600112, -0.1980763734312015],
+    [-0.4838350155487132, 0.7469822444972189, 0.4559837761750669],
+];
+// Matplotlib 'magma' colormap, sampled at 9 evenly spaced stops.
+const MAGMA = [
+    [0, 0, 4], [28, 16, 68], [79, 18, 123], [129, 37, 129], [181, 54, 122],
+    [229, 80, 100], [251, 135, 97], [254, 194, 135], [252, 253, 191],
+];
+
+const COUNT_SIZES = { uint8: 1, uint16: 2, uint32: 4 };
+
+// Decodes base64 little-endian counts of type dtype ('uint8', 'uint16' or 'uint32').
+function decodeCounts(base64, dtype) {
+    const bytes = atob(base64);
+    const view = new DataView(new ArrayBuffer(bytes.length));
+    for (let i = 0; i < bytes.length; i++) view.setUint8(i, bytes.charCodeAt(i));
+    const size = COUNT_SIZES[dtype || 'uint32'];
+    const counts = new Uint32Array(bytes.length / size);
+    for (let i = 0; i < counts.length; i++) {
+        const o = size * i;
+        counts[i] = size === 1 ? view.getUint8(o) : size === 2 ? view.getUint16(o, true) : view.getUint32(o, true);
+    }
+    return counts;
+}
+
+// Interleaves the bits of a byte with zeros: bit i moves to bit 2i.
+const SPREAD_BYTE = new Uint16Array(256).map((_, v) => {
+    let r = 0;
+    for (let i = 0; i < 8; i++) r |= ((v >> i) & 1) << (2 * i);
+    return r;
+});
+
+// Interleaves the bits of v with zeros (nside <= 2^15).
+function spreadBits(v) {
+    return SPREAD_BYTE[v & 0xff] | (SPREAD_BYTE[(v >> 8) & 0xff] << 16);
+}
+
+// NESTED pixel of a direction given by z = cos(colatitude) and phi (longitude) in radians.
+function ang2pixNest(nside, z, phi) {
+    const za = Math.abs(z);
+    let tt = (phi / (0.5 * Math.PI)) % 4;
+    if (tt < 0) tt += 4;
+    let face, ix, iy;
+    if (za <= 2 / 3) {
+        const temp1 = nside * (0.5 + tt);
+        const temp2 = nside * z * 0.75;
+        const jp = Math.floor(temp1 - temp2);
+        const jm = Math.floor(temp1 + temp2);
+        const ifp = Math.floor(jp / nside);
+        const ifm = Math.floor(jm / nside);
+        face = ifp === ifm ? (ifp | 4) : (ifp < ifm ? ifp : ifm + 8);
+        ix = jm & (nside - 1);
+        iy = nside - (jp & (nside - 1)) - 1;
+    } else {
+        const ntt = Math.min(3, Math.floor(tt));
+        const tp = tt - ntt;
+        const tmp = nside * Math.sqrt(3 * (1 - za));
+        const jp = Math.min(Math.floor(tp * tmp), nside - 1);
+        const jm = Math.min(Math.floor((1 - tp) * tmp), nside - 1);
+        if (z >= 0) {
+            face = ntt;
+            ix = nside - jm - 1;
+            iy = nside - jp - 1;
+        } else {
+            face = ntt + 8;
+            ix = jp;
+            iy = jm;
+        }
+    }
+    return face * nside * nside + spreadBits(ix) + 2 * spreadBits(iy);
+}
+
+// Inverse map projections: canvas coordinates to (lon, lat) in radians, or null outside the sky.
+// x is in [-1, 1] (left to right) and y in [-1, 1] (bottom to top) on a 2:1 frame.
+const PROJECTIONS = {
+    none(x, y) {
+        return [x * Math.PI, y * Math.PI / 2];
+    },
+    mollweide(x, y) {
+        if (x * x + y * y > 1) return null;
+        const theta = Math.asin(y);
+        const lat = Math.asin((2 * theta + Math.sin(2 * theta)) / Math.PI);
+        const c = Math.cos(theta);
+        return [c > 0 ? Math.PI * x / c : 0, lat];
+    },
+    hammer(x, y) {
+        if (x * x + y * y > 1) return null;
+        const hx = 2 * Math.SQRT2 * x;
+        const hy = Math.SQRT2 * y;
+        const z = Math.sqrt(1 - hx * hx / 16 - hy * hy / 4);
+        return [2 * Math.atan2(z * hx, 2 * (2 * z * z - 1)), Math.asin(Math.min(1, Math.max(-1, z * hy)))];
+    },
+    aitoff(x, y) {
+        // Newton iterations on the forward projection, starting from the Hammer inverse.
+        if (x * x + y * y > 1) return null;
+        const target = [Math.PI * x, Math.PI / 2 * y];
+        let [lon, lat] = PROJECTIONS.hammer(x, y);
+        for (let i = 0; i < 20; i++) {
+            const f = aitoffForward(lon, lat);
+            const ex = f[0] - target[0];
+            const ey = f[1] - target[1];
+            if (Math.abs(ex) + Math.abs(ey) < 1e-9) break;
+            const h = 1e-7;
+            const fl = aitoffForward(lon + h, lat);
+            const fb = aitoffForward(lon, lat + h);
+            const a = (fl[0] - f[0]) / h, b = (fb[0] - f[0]) / h;
+            const c = (fl[1] - f[1]) / h, d = (fb[1] - f[1]) / h;
+            const det = a * d - b * c;
+            if (!det) break;
+            lon = Math.max(-Math.PI, Math.min(Math.PI, lon - (d * ex - b * ey) / det));
+            lat = Math.max(-Math.PI / 2, Math.min(Math.PI / 2, lat - (a * ey - c * ex) / det));
+        }
+        return [lon, lat];
+    },
+};
+
+function aitoffForward(lon, lat) {
+    const alpha = Math.acos(Math.cos(lat) * Math.cos(lon / 2));
+    const sinc = alpha ? Math.sin(alpha) / alpha : 1;
+    return [2 * Math.cos(lat) * Math.sin(lon / 2) / sinc, Math.sin(lat) / sinc];
+}
+
+// Pixel of the equatorial map seen at (lon, lat) radians of the frame coord ('G' or 'C').
+function skyPixel(nside, coord, lon, lat) {
+    let x = Math.cos(lat) * Math.cos(lon), y = Math.cos(lat) * Math.sin(lon), z = Math.sin(lat);
+    if (coord === 'G') {
+        const m = GALACTIC_TO_EQUATORIAL;
+        [x, y, z] = [m[0][0] * x + m[0][1] * y + m[0][2] * z,
+                     m[1][0] * x + m[1][1] * y + m[1][2] * z,
+                     m[2][0] * x + m[2][1] * y + m[2][2] * z];
+    }
+    return ang2pixNest(nside, Math.max(-1, Math.min(1, z)), Math.atan2(y, x));
+}
+
+// Map pixel drawn at every canvas pixel (-1 outside the sky). The inverse projections are
+// the costly part of a draw, so the last lookups are kept: changing the stage, or going
+// back to a projection, only recolors the canvas.
+const PIXEL_LOOKUPS = new Map();
+const PIXEL_LOOKUPS_SIZE = 4;
+
+function pixelLookup(width, height, nside, projection, coord) {
+    const key = [width, height, nside, projection, coord].join('/');
+    if (PIXEL_LOOKUPS.has(key)) return PIXEL_LOOKUPS.get(key);
+    const inverse = PROJECTIONS[projection] || PROJECTIONS.mollweide;
+    const lookup = new Int32Array(width * height);
+    for (let row = 0; row < height; row++) {
+        const y = 1 - 2 * (row + 0.5) / height;
+        for (let col = 0; col < width; col++) {
+            const lonlat = inverse(2 * (col + 0.5) / width - 1, y);
+            lookup[row * width + col] = lonlat ? skyPixel(nside, coord, lonlat[0], lonlat[1]) : -1;
+        }
+    }
+    PIXEL_LOOKUPS.set(key, lookup);
+    if (PIXEL_LOOKUPS.size > PIXEL_LOOKUPS_SIZE) PIXEL_LOOKUPS.delete(PIXEL_LOOKUPS.keys().next().value);
+    return lookup;
+}
+
+// RGBA colors of the map pixels, on a log scale of the counts like the PNG plots.
+function pixelColors(map) {
+    const palette = new Uint8Array(4 * 256);
+    for (let i = 0; i < 256; i++) {
+        const s = i / 255 * (MAGMA.length - 1);
+        const j = Math.min(Math.floor(s), MAGMA.length - 2);
+        for (let k = 0; k < 3; k++) palette[4 * i + k] = Math.round(MAGMA[j][k] + (MAGMA[j + 1][k] - MAGMA[j][k]) * (s - j));
+        palette[4 * i + 3] = 255;
+    }
+    const logMax = Math.log(map.max + 1) || 1;
+    const colors = new Uint32Array(map.counts.length);
+    const paletteWords = new Uint32Array(palette.buffer);
+    for (let p = 0; p < colors.length; p++) {
+        colors[p] = paletteWords[Math.round(Math.log(map.counts[p] + 1) / logMax * 255)];
+    }
+    return colors;
+}
+
+// Draws a map ({nside, counts, max}) on a canvas.
+function drawSkyMap(canvas, map, projection, coord) {
+    const ctx = canvas.getContext('2d');
+    const image = ctx.createImageData(canvas.width, canvas.height);
+    const lookup = pixelLookup(canvas.width, canvas.height, map.nside, projection, coord);
+    if (!map.colors) map.colors = pixelColors(map);
+    const pixels = new Uint32Array(image.data.buffer);
+    for (let i = 0; i < lookup.length; i++) {
+        if (lookup[i] >= 0) pixels[i] = map.colors[lookup[i]];
+    }
+    ctx.putImageData(image, 0, 0);
+}
+
+function fetchSkyMap(id, stage, level) {
+    const params = new URLSearchParams({ id: id, stage: stage });
+    if (level !== undefined) params.set('level', level);
+    return fetch(`/skymap?${params}`)
+        .then(r => r.ok ? r.json() : Promise.reject(new Error(`HTTP ${r.status}`)))
+        .then(data => Object.assign(data, { counts: decodeCounts(data.counts, data.dtype) }));
+}
+
+// Loads the map of a stage progressively: the preview level is drawn first, then the
+// finest one. onDraw(map) is called after every draw; returns a promise of the finest map.
+function loadSkyMap(canvas, id, stage, projection, coord, onDraw) {
+    return fetchSkyMap(id, stage, 0).then(preview => {
+        drawSkyMap(canvas, preview, projection(), coord());
+        if (onDraw) onDraw(preview);
+        if (preview.levels.length === 1) return preview;
+        return fetchSkyMap(id, stage).then(map => {
+            drawSkyMap(canvas, map, projection(), coord());
+            if (onDraw) onDraw(map);
+            return map;
+        });
+    });
+}
+
+if (typeof module !== 'undefined') {
+    module.exports = { ang2pixNest, skyPixel, decodeCounts, drawSkyMap, PROJECTIONS };
+}
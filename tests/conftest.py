@@ -0,0 +1,32 @@
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+from pathlib import Path
+import pytest
+
+# The modules import the package as FermiFilters, whatever the checkout is named
+# (see benchmark.measure_import).
+REPO_DIR = Path(__file__).resolve().parent.parent
+if REPO_DIR.name == 'FermiFilters':
+    sys.path.insert(0, str(REPO_DIR.parent))
+else:
+    _path_dir = tempfile.mkdtemp(prefix='fermifilters_tests_')
+    atexit.register(shutil.rmtree, _path_dir, ignore_errors=True)
+    os.symlink(REPO_DIR, os.path.join(_path_dir, 'FermiFilters'))
+    sys.path.insert(0, _path_dir)
+
+
+@pytest.fixture(scope='session')
+def synthetic_files(tmp_path_factory):
+    '''
+    A small synthetic FT1/FT2 pair (see core.synthetic), covering one day of week 9.
+    '''
+    from FermiFilters.core.synthetic import make_ft1, make_ft2, week_start
+    data_dir = tmp_path_factory.mktemp('synthetic')
+    ft1_file, ft2_file = str(data_dir / 'ft1.fits'), str(data_dir / 'ft2.fits')
+    tstart = week_start(9)
+    make_ft2(ft2_file, tstart, tstart + 86400)
+    make_ft1(ft1_file, ft2_file, 20000)
+    return ft1_file, ft2_file
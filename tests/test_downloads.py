@@ -0,0 +1,112 @@
+import os
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from FermiFilters.core.downloads import DownloadError, DownloadManager
+
+CONTENT = bytes(range(256)) * 400
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    '''
+    Serves CONTENT at every path, honouring 'bytes=<start>-' Range headers.
+    '''
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header:
+            start = int(range_header.split('=', 1)[1].rstrip('-'))
+            if start >= len(CONTENT):
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{len(CONTENT)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}")
+        else:
+            self.send_response(200)
+        body = CONTENT[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def url(server, name='lat_photon_weekly_w009_p305_v001.fits'):
+    return f"http://127.0.0.1:{server.server_address[1]}/{name}"
+
+
+def test_download_reports_progress(server, tmp_path):
+    calls = []
+    manager = DownloadManager(chunk_size=10000, progress_callback=lambda *args: calls.append(args))
+    output_file = str(tmp_path / 'w009.fits')
+    results = manager.download([(url(server), output_file)])
+    assert results == {output_file: True}
+    with open(output_file, 'rb') as f:
+        assert f.read() == CONTENT
+    assert not os.path.exists(output_file + '.part')
+    assert calls[-1] == ('w009.fits', len(CONTENT), len(CONTENT))
+    assert [done for _, done, _ in calls] == sorted(done for _, done, _ in calls)
+
+
+def test_download_resumes_part_file(server, tmp_path):
+    output_file = str(tmp_path / 'w009.fits')
+    with open(output_file + '.part', 'wb') as f:
+        f.write(CONTENT[:12345])
+    calls = []
+    manager = DownloadManager(progress_callback=lambda *args: calls.append(args))
+    checksum = 'md5:' + hashlib.md5(CONTENT).hexdigest()
+    assert manager.download_file(url(server), output_file, len(CONTENT), checksum) == output_file
+    assert server.requests[-1]['Range'] == 'bytes=12345-'
+    with open(output_file, 'rb') as f:
+        assert f.read() == CONTENT
+    assert calls[0][1] > 12345 and calls[-1][1] == len(CONTENT)
+
+
+def test_download_complete_part_file(server, tmp_path):
+    output_file = str(tmp_path / 'w009.fits')
+    with open(output_file + '.part', 'wb') as f:
+        f.write(CONTENT)
+    DownloadManager().download_file(url(server), output_file)
+    assert server.requests[-1]['Range'] == f"bytes={len(CONTENT)}-"
+    assert os.path.getsize(output_file) == len(CONTENT)
+
+
+def test_download_size_mismatch(server, tmp_path):
+    output_file = str(tmp_path / 'w009.fits')
+    with pytest.raises(DownloadError):
+        DownloadManager(retries=2).download_file(url(server), output_file, expected_size=len(CONTENT) + 1)
+    assert not os.path.exists(output_file)
+
+
+def test_download_checksum_mismatch(server, tmp_path):
+    output_file = str(tmp_path / 'w009.fits')
+    with pytest.raises(DownloadError):
+        DownloadManager(retries=2).download_file(url(server), output_file, checksum='md5:' + '0' * 32)
+    assert len(server.requests) == 2
+    assert not os.path.exists(output_file)
+    # A corrupted partial file is not resumed.
+    assert not os.path.exists(output_file + '.part')
+    assert 'Range' not in server.requests[-1]
+
+
+def test_download_failure_is_reported(server, tmp_path):
+    output_file = str(tmp_path / 'w009.fits')
+    manager = DownloadManager(retries=1)
+    assert manager.download([{'url': url(server), 'path': output_file, 'checksum': 'sha256:' + '0' * 64}]) == {output_file: False}
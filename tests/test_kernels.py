@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from scipy.interpolate import interp1d
+from FermiFilters.core.kernels import SunTrack, sun_separation
+from FermiFilters.core.synthetic import FT2_STEP, WEEK_9_START, sun_position
+
+# Days after the start of week 9 when the synthetic Sun crosses RA 0 (March equinox).
+EQUINOX_DAY = (360 - 132.2) / 0.98565
+
+
+def ft2_rows(center, n_rows=2880):
+    '''
+    SC_DATA columns of one day of FT2 rows centered on a mission elapsed time.
+    '''
+    start = center + FT2_STEP * (np.arange(n_rows) - n_rows // 2)
+    ra_sun, dec_sun = sun_position(start)
+    # Stored as single precision, like the FT2 files.
+    return {'START': start, 'RA_SUN': ra_sun.astype(np.float32), 'DEC_SUN': dec_sun.astype(np.float32)}
+
+
+def ft1_rows(sc_data, n_events=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    time = rng.uniform(sc_data['START'][0], sc_data['START'][-1], n_events)
+    ra = rng.uniform(0, 360, n_events)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 1, n_events)))
+    # A quarter of the events within about a degree of the Sun, where the separation is small.
+    near = slice(0, n_events // 4)
+    sun_ra, sun_dec = sun_position(time[near])
+    ra[near] = (sun_ra + rng.uniform(-1, 1, len(sun_ra))) % 360
+    dec[near] = np.clip(sun_dec + rng.uniform(-1, 1, len(sun_dec)), -90, 90)
+    return {'TIME': time, 'RA': ra.astype(np.float32), 'DEC': dec.astype(np.float32)}
+
+
+def reference_separation(columns, sc_data):
+    '''
+    interp1d of RA_SUN/DEC_SUN and SkyCoord.separation, in float64.
+
+    RA_SUN is unwrapped before the interpolation, so that segments crossing RA 0 are
+    interpolated the short way.
+    '''
+    ra_sun = np.unwrap(sc_data['RA_SUN'].astype(np.float64), period=360)
+    sun_ra = interp1d(sc_data['START'], ra_sun)(columns['TIME']) % 360
+    sun_dec = interp1d(sc_data['START'], sc_data['DEC_SUN'].astype(np.float64))(columns['TIME'])
+    sun = SkyCoord(sun_ra * u.deg, sun_dec * u.deg)
+    events = SkyCoord(columns['RA'].astype(np.float64) * u.deg, columns['DEC'].astype(np.float64) * u.deg)
+    return events.separation(sun).deg
+
+
+@pytest.mark.parametrize('day, wraps', [(10.0, False), (EQUINOX_DAY, True)])
+def test_sun_separation(day, wraps):
+    sc_data = ft2_rows(WEEK_9_START + day * 86400)
+    assert (np.abs(np.diff(sc_data['RA_SUN'])) > 180).any() == wraps
+    columns = ft1_rows(sc_data)
+    separation = sun_separation(columns, SunTrack.from_ft2(sc_data))
+    reference = reference_separation(columns, sc_data)
+    assert separation.dtype == np.float64
+    assert (reference < 1.5).sum() >= len(reference) // 4
+    np.testing.assert_array_less(np.abs(separation - reference), 1e-9)
+
+
+def test_sun_separation_rows():
+    sc_data = ft2_rows(WEEK_9_START + EQUINOX_DAY * 86400)
+    columns = ft1_rows(sc_data, n_events=1000)
+    sun_track = SunTrack.from_ft2(sc_data)
+    full = sun_separation(columns, sun_track)
+    assert np.array_equal(np.concatenate([sun_separation(columns, sun_track, start, start + 300)
+                                          for start in range(0, 1000, 300)]), full)
@@ -0,0 +1,110 @@
+import time
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from FermiFilters.core.engine import FiltersEngine
+from FermiFilters.core.mktime import FilterExpression, ft2_gti, intersect_gtis, read_gti
+
+FILTER = 'DATA_QUAL>0 && LAT_CONFIG==1'
+ROI = (83.6, 22.0, 10.0, 90.0)
+
+
+@pytest.fixture(scope='module')
+def sc_data(synthetic_files):
+    _, ft2_file = synthetic_files
+    with fits.open(ft2_file) as hdul:
+        return hdul['SC_DATA'].data.copy()
+
+
+def reference_gti(sc_data, mask):
+    '''
+    Merges the runs of contiguous passing FT2 rows, one row at a time.
+    '''
+    gti = []
+    for start, stop in zip(sc_data['START'][mask], sc_data['STOP'][mask]):
+        if gti and start == gti[-1][1]:
+            gti[-1][1] = stop
+        else:
+            gti.append([start, stop])
+    return np.array(gti).T
+
+
+@pytest.mark.parametrize('expr, reference', [
+    (FILTER, lambda d: (d['DATA_QUAL'] > 0) & (d['LAT_CONFIG'] == 1)),
+    ('data_qual.gt.0 .and. .not. in_saa', lambda d: (d['DATA_QUAL'] > 0) & ~d['IN_SAA']),
+    ('!(LAT_CONFIG!=1) || ABS(ROCK_ANGLE) < 10', lambda d: (d['LAT_CONFIG'] == 1) | (np.abs(d['ROCK_ANGLE']) < 10)),
+    ('angsep(RA_ZENITH, DEC_ZENITH, 83.6, 22.0) + 10 <= 90',
+     lambda d: SkyCoord(d['RA_ZENITH'] * u.deg, d['DEC_ZENITH'] * u.deg).separation(SkyCoord(83.6 * u.deg, 22.0 * u.deg)).deg + 10 <= 90),
+    ('10 < LAT_GEO * 2 <= 40', lambda d: (10 < d['LAT_GEO'] * 2) & (d['LAT_GEO'] * 2 <= 40)),
+    ('', lambda d: np.ones(len(d), dtype=bool)),
+])
+def test_filter_expression(sc_data, expr, reference):
+    expected = reference(sc_data)
+    assert 0 < expected.sum()
+    mask = FilterExpression(expr).evaluate(sc_data, len(sc_data))
+    assert np.array_equal(mask, expected)
+
+
+@pytest.mark.parametrize('expr', [
+    '__import__("os")',
+    '__import__("os").system("true")',
+    'DATA_QUAL.real > 0',
+    '().__class__',
+    'DATA_QUAL[0] > 0',
+    '"DATA_QUAL" > 0',
+    '(lambda: 1)()',
+    'ABS(x=DATA_QUAL) > 0',
+    'DATA_QUAL if LAT_CONFIG else 0',
+    'DATA_QUAL > 0 &&',
+    '1' + '0' * 400 + ' > DATA_QUAL',
+])
+def test_filter_expression_rejected(expr):
+    with pytest.raises(ValueError):
+        FilterExpression(expr)
+
+
+def test_filter_expression_float64_constants(sc_data):
+    start = time.perf_counter()
+    # Computed as a Python integer, 9**9**9**9 would never finish.
+    expression = FilterExpression('DATA_QUAL < 9**9**9**9 && LAT_CONFIG * 2**1023 * 2 > 1')
+    mask = expression.evaluate(sc_data, len(sc_data))
+    assert time.perf_counter() - start < 5
+    assert expression.columns == {'DATA_QUAL', 'LAT_CONFIG'}
+    assert np.array_equal(mask, sc_data['LAT_CONFIG'] > 0)
+    third = FilterExpression('ROCK_ANGLE * (1 / 3)').evaluate(sc_data, len(sc_data))
+    assert np.array_equal(third, sc_data['ROCK_ANGLE'] * np.float64(1 / 3) != 0)
+
+
+@pytest.mark.parametrize('roi', [None, ROI])
+def test_ft2_gti(synthetic_files, sc_data, roi):
+    _, ft2_file = synthetic_files
+    mask = (sc_data['DATA_QUAL'] > 0) & (sc_data['LAT_CONFIG'] == 1)
+    if roi is not None:
+        ra, dec, radius, zmax = roi
+        zenith = SkyCoord(sc_data['RA_ZENITH'] * u.deg, sc_data['DEC_ZENITH'] * u.deg)
+        mask &= zenith.separation(SkyCoord(ra * u.deg, dec * u.deg)).deg + radius <= zmax
+    expected = reference_gti(sc_data, mask)
+    gti_start, gti_stop = ft2_gti(ft2_file, FILTER, roi)
+    assert 1 < len(gti_start) < mask.sum()
+    assert np.array_equal(gti_start, expected[0]) and np.array_equal(gti_stop, expected[1])
+
+
+def test_gtmktime_native(synthetic_files, sc_data, tmp_path):
+    ft1_file, ft2_file = synthetic_files
+    output_file = str(tmp_path / 'mktime.fits')
+    assert FiltersEngine(backend='native', workers=1).gtmktime({'filter_expr': FILTER}, ft1_file, ft2_file, output_file)
+    rows_passing = (sc_data['DATA_QUAL'] > 0) & (sc_data['LAT_CONFIG'] == 1)
+    with fits.open(ft1_file) as hdul, fits.open(output_file) as output:
+        events = hdul['EVENTS'].data
+        # The FT2 row of every event, and the FT1 GTI it falls in.
+        rows = np.searchsorted(sc_data['START'], events['TIME'], side='right') - 1
+        gti_start, gti_stop = read_gti(hdul['GTI'])
+        in_gti = np.array([((gti_start <= t) & (t <= gti_stop)).any() for t in events['TIME']])
+        expected = rows_passing[rows] & in_gti
+        assert 0 < expected.sum() < len(events)
+        assert np.array_equal(output['EVENTS'].data['EVENT_ID'], events['EVENT_ID'][expected])
+        gti = intersect_gtis(reference_gti(sc_data, rows_passing), (gti_start, gti_stop))
+        assert np.array_equal(output['GTI'].data['START'], gti[0])
+        assert np.array_equal(output['GTI'].data['STOP'], gti[1])
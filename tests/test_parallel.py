@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import pytest
+from astropy.io import fits
+from FermiFilters.core import parallel
+from FermiFilters.core.engine import FiltersEngine
+from FermiFilters.core.kernels import SunTrack, raw_columns, select_params, selection_mask, sun_separation
+from FermiFilters.core.pipeline import FilterPipeline
+
+# Smaller than the synthetic tables, so that they are split across the workers.
+CHUNK_SIZE = 1500
+
+SELECT = {'energy': [100, 100000], 'zenith_angle': [0, 90], 'ra': 83.6, 'dec': 22.0, 'radius': 60}
+MAKETIME = {'filter_expr': 'DATA_QUAL>0 && LAT_CONFIG==1'}
+ECLIPTIC_CUT = {'eclipticradius': 30, 'eclipticoperator': 'gt'}
+
+
+@pytest.fixture(scope='module', autouse=True)
+def shutdown_pools():
+    yield
+    parallel.shutdown()
+
+
+def n_events(ft1_file):
+    with fits.open(ft1_file) as hdul:
+        return hdul['EVENTS'].header['NAXIS2']
+
+
+def test_parallel_mask(synthetic_files):
+    ft1_file, _ = synthetic_files
+    n_rows = n_events(ft1_file)
+    assert n_rows > 2 * CHUNK_SIZE
+    params = select_params(SELECT)
+    masks = [parallel.parallel_mask(selection_mask, ft1_file, 'EVENTS', n_rows, params,
+                                    chunk_size=CHUNK_SIZE, workers=workers) for workers in (1, 2)]
+    assert masks[0].shape == (n_rows,) and 0 < masks[0].sum() < n_rows
+    assert np.array_equal(masks[0], masks[1])
+
+
+def test_map_chunks(synthetic_files):
+    ft1_file, ft2_file = synthetic_files
+    with fits.open(ft2_file) as hdul:
+        sun_track = SunTrack.from_ft2(raw_columns(hdul['SC_DATA'].data))
+    n_rows = n_events(ft1_file)
+    results = [parallel.map_chunks(sun_separation, ft1_file, 'EVENTS', n_rows, sun_track,
+                                   chunk_size=CHUNK_SIZE, workers=workers) for workers in (1, 2)]
+    assert len(results[0]) == len(results[1]) == len(parallel.row_chunks(n_rows, CHUNK_SIZE))
+    for serial, pooled in zip(*results):
+        assert serial.tobytes() == pooled.tobytes()
+
+
+def test_pipeline_outputs(synthetic_files, tmp_path):
+    ft1_file, ft2_file = synthetic_files
+    stages_outputs = []
+    for workers in (1, 2):
+        output_dir = tmp_path / f'workers_{workers}'
+        output_dir.mkdir()
+        pipeline = FilterPipeline(FiltersEngine(backend='native', chunk_size=CHUNK_SIZE, workers=workers),
+                                  chunk_size=CHUNK_SIZE)
+        stages = pipeline.build_stages(SELECT, MAKETIME, ECLIPTIC_CUT)
+        outputs = pipeline.run(stages, ft1_file, ft2_file, str(output_dir), keep_intermediate=True)
+        assert outputs is not None and list(outputs) == ['select', 'mktime', 'ecliptic_cut']
+        stages_outputs.append(outputs)
+    for stage, serial_file in stages_outputs[0].items():
+        with open(serial_file, 'rb') as serial, open(stages_outputs[1][stage], 'rb') as pooled:
+            assert serial.read() == pooled.read(), stage
+        assert os.path.basename(serial_file) == os.path.basename(stages_outputs[1][stage])
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from FermiFilters.core.engine import FiltersEngine
+from FermiFilters.core.kernels import chunked_mask, raw_columns, select_params, selection_mask
+
+SELECTIONS = [
+    {},
+    {'energy': [100, 10000], 'zenith_angle': [0, 90]},
+    {'energy': [1000, 300000], 'ra': 83.6, 'dec': 22.0, 'radius': 30},
+    {'ra': 359.5, 'dec': 10.0, 'radius': 45, 'evclass': 512, 'evtype': 1},
+    {'zenith_angle': [10, 100], 'evclass': 128 | 1024, 'evtype': 2},
+]
+
+
+def bits(column, mask):
+    '''
+    Rows of a decoded 'nX' column (one boolean per bit, most significant first) with
+    one of the bits of mask set.
+    '''
+    n_bits = column.shape[1]
+    selected = [n_bits - 1 - bit for bit in range(n_bits) if mask >> bit & 1]
+    return column[:, selected].any(axis=1)
+
+
+def reference_mask(data, select_dict):
+    '''
+    The gtselect cuts, written with astropy's decoded columns and SkyCoord.separation.
+    '''
+    params = select_params(select_dict)
+    mask = (data['ENERGY'] >= params['emin']) & (data['ENERGY'] <= params['emax'])
+    mask &= (data['ZENITH_ANGLE'] >= params['zmin']) & (data['ZENITH_ANGLE'] <= params['zmax'])
+    mask &= bits(data['EVENT_CLASS'], params['evclass']) & bits(data['EVENT_TYPE'], params['evtype'])
+    if params['rad'] is not None:
+        events = SkyCoord(data['RA'].astype(np.float64) * u.deg, data['DEC'].astype(np.float64) * u.deg)
+        mask &= events.separation(SkyCoord(params['ra'] * u.deg, params['dec'] * u.deg)).deg <= params['rad']
+    return mask
+
+
+@pytest.mark.parametrize('select_dict', SELECTIONS)
+def test_selection_mask(synthetic_files, select_dict):
+    ft1_file, _ = synthetic_files
+    with fits.open(ft1_file) as hdul:
+        data = hdul['EVENTS'].data
+        reference = reference_mask(data, select_dict)
+        mask = chunked_mask(selection_mask, raw_columns(data), len(data), select_params(select_dict), chunk_size=3000)
+    assert reference.any()
+    assert np.array_equal(mask, reference)
+
+
+@pytest.mark.parametrize('select_dict', SELECTIONS[1:3])
+def test_gtselect_native(synthetic_files, select_dict, tmp_path):
+    ft1_file, _ = synthetic_files
+    output_file = str(tmp_path / 'select.fits')
+    assert FiltersEngine(backend='native', workers=1).gtselect(select_dict, ft1_file, output_file)
+    with fits.open(ft1_file) as hdul, fits.open(output_file) as output:
+        reference = reference_mask(hdul['EVENTS'].data, select_dict)
+        assert np.array_equal(output['EVENTS'].data['EVENT_ID'], hdul['EVENTS'].data['EVENT_ID'][reference])
+        assert np.array_equal(output['GTI'].data, hdul['GTI'].data)
+        header = output['EVENTS'].header
+        dss = {header[f'DSTYP{i}']: header[f'DSVAL{i}'] for i in range(1, header['NDSKEYS'] + 1)}
+    params = select_params(select_dict)
+    assert dss['ENERGY'] == f"{params['emin']:g}:{params['emax']:g}"
+    assert dss['ZENITH_ANGLE'] == f"{params['zmin']:g}:{params['zmax']:g}"
+    if params['rad'] is not None:
+        assert dss['POS(RA,DEC)'] == f"CIRCLE({params['ra']:g},{params['dec']:g},{params['rad']:g})"
@@ -0,0 +1,106 @@
+import os
+import sys
+import stat
+import time
+import pytest
+from FermiFilters.core.tools import ToolError, ToolRunner
+
+# Stand-in for a Fermitools executable: reports its private PFILES directory and its
+# parameters, then sleeps and exits as its parameters ask.
+STUB_TOOL = f'''#!{sys.executable}
+import os, sys, time, subprocess
+params = dict(arg.split('=', 1) for arg in sys.argv[1:])
+pfiles_dir = os.environ['PFILES'].split(';')[0]
+with open(os.path.join(pfiles_dir, 'gtstub.par'), 'w') as f:
+    f.write('checked')
+print('pfiles', pfiles_dir)
+print('params', ' '.join(sys.argv[1:]))
+print('caldb', os.environ.get('CALDB'))
+print('stub error', file=sys.stderr)
+sys.stdout.flush()
+if 'child' in params:
+    child = subprocess.Popen(['sleep', '60'])
+    with open(params['child'], 'w') as f:
+        f.write(str(child.pid))
+time.sleep(float(params.get('sleep', 0)))
+sys.exit(int(params.get('code', 0)))
+'''
+
+
+def make_tool(tools_dir, name, content):
+    path = tools_dir / name
+    path.write_text(content)
+    path.chmod(path.stat().st_mode | stat.S_IXUSR)
+    return path
+
+
+@pytest.fixture
+def runner(tmp_path):
+    tools_dir = tmp_path / 'bin'
+    tools_dir.mkdir()
+    make_tool(tools_dir, 'gtstub', STUB_TOOL)
+    runner = ToolRunner(max_workers=2, timeout=30, tools_dir=str(tools_dir), env={'CALDB': '/caldb'})
+    yield runner
+    runner.shutdown()
+
+
+def output(result, key):
+    return next(line.split(' ', 1)[1] for line in result.stdout.splitlines() if line.startswith(key + ' '))
+
+
+def test_tool_result(runner):
+    result = runner.run('gtstub', {'evfile': 'in.fits', 'apply_filter': True, 'code': 3})
+    assert result.returncode == 3 and not result.ok and not result.timed_out
+    assert output(result, 'params') == 'evfile=in.fits apply_filter=yes code=3 mode=h'
+    assert output(result, 'caldb') == '/caldb'
+    assert result.stderr.strip() == 'stub error'
+    assert 'CALDB' not in os.environ or os.environ['CALDB'] != '/caldb'
+
+
+def test_private_pfiles(runner):
+    futures = [runner.submit('gtstub', {'sleep': 0.5}) for _ in range(2)]
+    results = [future.result() for future in futures]
+    assert all(result.ok for result in results)
+    pfiles_dirs = [output(result, 'pfiles') for result in results]
+    assert pfiles_dirs[0] != pfiles_dirs[1]
+    # The private parameter directories are removed after the run.
+    assert not any(os.path.exists(pfiles_dir) for pfiles_dir in pfiles_dirs)
+
+
+def test_timeout_kills_process_group(runner, tmp_path):
+    child_file = tmp_path / 'child.pid'
+    start = time.monotonic()
+    result = runner.run('gtstub', {'sleep': 60, 'child': child_file}, timeout=1)
+    assert result.timed_out and not result.ok
+    assert time.monotonic() - start < 30
+    child_pid = int(child_file.read_text())
+    for _ in range(50):
+        try:
+            os.kill(child_pid, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.1)
+    else:
+        pytest.fail("the child process of the tool was not killed")
+
+
+def test_missing_tool(runner):
+    with pytest.raises(ToolError):
+        runner.run('gtmissing')
+
+
+def test_tool_that_cannot_start(runner, tmp_path):
+    make_tool(tmp_path / 'bin', 'gtbroken', '#!/nonexistent/interpreter\n')
+    with pytest.raises(ToolError):
+        runner.run('gtbroken')
+
+
+def test_engine_reports_tool_failures(runner, tmp_path):
+    from FermiFilters.core.engine import FiltersEngine
+    make_tool(tmp_path / 'bin', 'gtbroken', '#!/nonexistent/interpreter\n')
+    engine = FiltersEngine(backend='gtapps', tool_runner=runner)
+    output_file = str(tmp_path / 'out.fits')
+    assert engine._run_tool('gtbroken', {}, output_file) is False
+    assert engine._run_tool('gtstub', {'code': 1}, output_file) is False
+    # Exit code 0 without an output file is a failure too.
+    assert engine._run_tool('gtstub', {}, output_file) is False